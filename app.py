@@ -1,63 +1,266 @@
-from flask import Flask, render_template, request, url_for
-from whoosh_crawler import WebCrawler
+from flask import Flask, abort, g, jsonify, render_template, request, url_for
+from werkzeug.exceptions import HTTPException
+from whoosh.index import EmptyIndexError
+from search_index import SearchIndex, DEFAULT_PER_PAGE
+from metrics import REGISTRY, RENDER_SECONDS, SamplingProfiler
+import json
+import logging
 import os
+import threading
 from pathlib import Path
 import traceback
-import sys
 
 app = Flask(__name__)
+log = logging.getLogger(__name__)
+
+# With PROFILING on, adding ?profile=1 to any URL returns the request's
+# sampled stacks instead of its page. Off unless SEARCH_PROFILING=1.
+app.config['PROFILING'] = os.environ.get('SEARCH_PROFILING') == '1'
 
 user = '/u101'
 @app.errorhandler(500)
 def internal_error(exception):
-    print(traceback.format_exc(), file=sys.stderr)  # logging to error log
+    log.exception("Internal error")  # logging to error log
+    if is_api_request():
+        return api_error(500, "internal error")
     return "<pre>" + traceback.format_exc() + "</pre>"
 
 @app.errorhandler(Exception)
 def unhandled_exception(e):
-    print(traceback.format_exc(), file=sys.stderr)  # logging to error log
+    if is_api_request():
+        # JSON clients get a JSON error with the right status, never a page
+        if isinstance(e, HTTPException):
+            return api_error(e.code, e.description)
+        log.exception("Unhandled exception")
+        return api_error(500, "internal error")
+    log.exception("Unhandled exception")  # logging to error log
     return "<pre>" + traceback.format_exc() + "</pre>"
 
+@app.before_request
+def start_profiler():
+    if app.config['PROFILING'] and request.args.get('profile'):
+        g.profiler = SamplingProfiler().start()
+
+@app.after_request
+def profile_response(response):
+    """Answer with the profile, in the folded stack format, if one was taken"""
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    return app.response_class(profiler.stop().collapsed(), mimetype='text/plain')
+
+@app.teardown_request
+def stop_profiler(exception):
+    # Requests that never got a response still stop their profiler
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
 
 
-# Initialize the crawler and build index if needed
+# The index is built by `python manage.py build`, never by the app. Each
+# worker opens it read-only on first use, so importing the app is cheap
+# and workers never race each other for the writer lock.
 BASE_DIR = Path(__file__).resolve().parent
 INDEX_DIR = BASE_DIR / "whoosh_index"
 START_URL = "https://vm009.rz.uos.de/crawl/index.html"
+# Upper bound on the per_page query parameter
+MAX_PER_PAGE = 100
+# Fields of a hit the JSON API can return, and most queries per batch
+API_FIELDS = ('url', 'title', 'teaser')
+MAX_BATCH = 100
+# Seconds clients and proxies may reuse an API response without asking;
+# after that the ETag lets them revalidate it cheaply
+API_MAX_AGE = 60
+# Paths answered with JSON, errors included
+API_PATHS = ('/api/', '/suggest')
 
-def init_crawler():
-    """Initialize or load the crawler index"""
-    crawler = WebCrawler(START_URL, str(INDEX_DIR))
-    if not INDEX_DIR.exists() or not any(INDEX_DIR.iterdir()):
-        print("Building index...")
-        crawler.crawl()
-    return crawler
+_index = None
+_index_lock = threading.Lock()
 
-crawler = init_crawler()
+def get_index():
+    """
+    Open the index read-only the first time it is needed.
+
+    Raises EmptyIndexError while no index has been built; nothing is
+    cached then, so the index is picked up as soon as it exists.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SearchIndex(str(INDEX_DIR))
+    return _index
+
+def render(template, **context):
+    """render_template, timed for /metrics"""
+    with RENDER_SECONDS.time():
+        return render_template(template, **context)
 
 @app.route('/')
 def home():
     """Display search form"""
-    return render_template('search.html')
+    return render('search.html')
+
+def page_args():
+    """Read the page number and page size from the query string"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = request.args.get('per_page', DEFAULT_PER_PAGE, type=int)
+    return page, min(max(per_page, 1), MAX_PER_PAGE)
 
 @app.route('/search')
 def search():
     """Handle search requests"""
     query = request.args.get('q', '')
     if not query:
-        return render_template('search.html')
+        return render('search.html')
+    page, per_page = page_args()
     
     try:
-        results = crawler.search(query)
-        print(f"Query: {query}")  # Debug print
-        print(f"Found {len(results)} results")  # Debug print
-        for url, title, teaser in results:
-            print(f"- {title}: {url}")  # Debug print
-            print(f"  {teaser}")  # Debug print
-        return render_template('search.html', query=query, results=results)
+        results = get_index().search(query, page, per_page)
+        log.debug("Query %r: %d results, showing page %d",
+                  query, results.total, results.page)
+        return render('search.html', query=query, results=results)
     except Exception as e:
-        print(f"Search error: {e}")  # Debug print
-        return render_template('search.html', query=query, error=str(e))
+        log.warning("Search error for %r: %s", query, e)
+        return render('search.html', query=query, error=str(e))
+
+def is_api_request():
+    return request.path.startswith(API_PATHS)
+
+def api_error(status, message):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+@app.errorhandler(EmptyIndexError)
+def index_not_built(e):
+    if is_api_request():
+        return api_error(503, "index not built")
+    return unhandled_exception(e)
+
+def field_args(value):
+    """Parse a comma separated `fields` parameter, all fields if missing"""
+    if not value:
+        return API_FIELDS
+    fields = tuple(name.strip() for name in value.split(',') if name.strip())
+    unknown = set(fields) - set(API_FIELDS)
+    if unknown or not fields:
+        abort(api_error(400, f"fields must be some of {', '.join(API_FIELDS)}"))
+    return fields
+
+def hit_dict(hit, fields):
+    return {name: value for name, value in zip(API_FIELDS, hit) if name in fields}
+
+def page_dict(query, results, fields):
+    return {
+        'query': query,
+        'total': results.total,
+        'page': results.page,
+        'per_page': results.per_page,
+        'page_count': results.page_count,
+        'results': [hit_dict(hit, fields) for hit in results],
+    }
+
+def stream_results(query, fields):
+    """Every hit of a query as newline-delimited JSON, read as it is sent"""
+    hits = get_index().iter_results(query, teasers='teaser' in fields)
+    lines = (json.dumps(hit_dict(hit, fields)) + "\n" for hit in hits)
+    return app.response_class(lines, mimetype='application/x-ndjson')
+
+@app.route('/api/search')
+def api_search():
+    """
+    Search results as JSON: ?q=...&page=&per_page=&fields=url,title,teaser
+
+    Leave teaser out of `fields` to skip highlighting. Responses carry
+    an ETag naming the index generation, so clients can revalidate with
+    If-None-Match and get a 304 until the index changes. With
+    stream=1 every hit is sent as newline-delimited JSON instead.
+    """
+    query = request.args.get('q', '')
+    if not query.strip():
+        return api_error(400, "missing q")
+    fields = field_args(request.args.get('fields'))
+    if request.args.get('stream'):
+        return stream_results(query, fields)
+
+    index = get_index()
+    generation = index.generation_tag()
+    if request.if_none_match.contains(generation):
+        # Nothing was committed since the client's copy: don't search
+        response = app.response_class(status=304)
+        response.set_etag(generation)
+    else:
+        page, per_page = page_args()
+        results = index.search(query, page, per_page, teasers='teaser' in fields)
+        response = jsonify(page_dict(query, results, fields))
+        response.set_etag(results.generation)
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    return response
+
+@app.route('/api/search/batch', methods=['POST'])
+def api_search_batch():
+    """
+    Run many searches in one request, against one index generation.
+
+    Takes {"queries": [...], "page": 1, "per_page": 10, "fields": [...]}
+    and returns {"results": [...]} with one /api/search result per query.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if (not isinstance(queries, list) or not queries or
+            not all(isinstance(query, str) and query.strip() for query in queries)):
+        return api_error(400, "queries must be a list of query strings")
+    if len(queries) > MAX_BATCH:
+        return api_error(400, f"at most {MAX_BATCH} queries per batch")
+    fields = body.get('fields')
+    if isinstance(fields, list) and all(isinstance(name, str) for name in fields):
+        fields = ','.join(fields)
+    elif fields is not None and not isinstance(fields, str):
+        return api_error(400, "fields must be a list of field names")
+    fields = field_args(fields)
+    try:
+        page = max(int(body.get('page', 1)), 1)
+        per_page = min(max(int(body.get('per_page', DEFAULT_PER_PAGE)), 1), MAX_PER_PAGE)
+    except (TypeError, ValueError):
+        return api_error(400, "page and per_page must be numbers")
+
+    pages = get_index().search_many(queries, page, per_page, teasers='teaser' in fields)
+    return jsonify(results=[page_dict(query, results, fields)
+                            for query, results in zip(queries, pages)])
+
+@app.route('/suggest')
+def suggest():
+    """Completions of a partly typed query as JSON, for the search box"""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), MAX_PER_PAGE)
+    suggestions = get_index().suggest(query, limit) if query.strip() else []
+    response = jsonify(query=query, suggestions=[text for text, _ in suggestions])
+    response.cache_control.public = True
+    response.cache_control.max_age = API_MAX_AGE
+    return response
+
+@app.route('/stats')
+def stats():
+    """Search cache counters as JSON, for scraping"""
+    return jsonify(get_index().cache_stats())
+
+@app.route('/metrics')
+def metrics():
+    """Search latencies and counters of this worker, in the Prometheus format"""
+    return app.response_class(REGISTRY.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready')
+def ready():
+    """Readiness probe: 200 once an index can be searched, 503 before"""
+    try:
+        status = get_index().index_status()
+    except EmptyIndexError:
+        return jsonify(ready=False, reason="index not built"), 503
+    return jsonify(ready=True, **status)
 
 if __name__ == '__main__':
     templates_dir = BASE_DIR / "templates"
@@ -152,4 +355,5 @@ if __name__ == '__main__':
 </html>"""
         template_path.write_text(template_content)
     
+    logging.basicConfig(level=logging.DEBUG)
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,1208 @@
+"""
+Benchmarks for the crawlers.
+
+Runs against a local stand-in server that serves a generated site with
+an artificial delay per request, so that round trips dominate the same
+way they do against a real host.
+
+    python bench.py crawl --pages 200 --latency 0.05
+    python bench.py parse --pages 200 --paragraphs 500
+    python bench.py extract --depth 50
+    python bench.py index-memory --pages 100000
+    python bench.py index-load --pages 10000
+    python bench.py suggest --pages 2000
+    python bench.py intersect --pages 50000
+    python bench.py rank --pages 50000 --k 10
+    python bench.py schema --pages 2000
+    python bench.py segments --commits 100
+    python bench.py polite --hosts 4 --rate 20
+    python bench.py fetch --megabytes 50
+    python bench.py dedup --articles 200
+    python bench.py links --pages 1000000 --links 10
+    python bench.py shards --pages 100000 --shards 1,2,4
+    python bench.py suite --json before.json
+    python bench.py compare before.json after.json
+
+`suite` runs the figures worth tracking between commits for both
+crawlers on one generated site: crawl pages/s, extraction MB/s, index
+build time and size, and search p50/p99. With --json it writes them
+with the commit and machine they came from, and `compare` flags the
+ones that got worse by more than a threshold.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from bs4 import BeautifulSoup
+
+from compact_index import CompactIndex
+from crawler import WebCrawler as SimpleCrawler
+from fetcher import AsyncFetcher, SkippedPage, fetch_page, make_session
+from frontier import Frontier
+import link_graph
+from link_graph import LinkGraph, LinkGraphBuilder, pagerank
+from politeness import HostScheduler
+from ranking import BM25
+from parsing import parse_page, available_backends, default_backend, default_workers
+from maintenance import MERGE_POLICIES, segment_stats, optimize
+from search_index import (SearchIndex, live_dir, make_schema, stage_generation,
+                          publish_generation)
+from whoosh.index import create_in
+from whoosh_crawler import WebCrawler as WhooshCrawler
+
+
+def new_index(index_dir, profile='lean'):
+    """Publish an empty index, for benchmarks that add pages to it directly"""
+    publish_generation(index_dir, stage_generation(index_dir, profile))
+
+
+def make_site(pages=200, fanout=5, depth=0, page_bytes=0, seed=0):
+    """
+    Generate a site as a dict of path -> HTML, every page linked.
+
+    Every page links to `fanout` others. Its text sits `depth` divs
+    deep, and is padded with about `page_bytes` bytes of words drawn
+    from a Zipf distribution, w0 being the commonest, so that queries
+    for w<rank> match more pages the lower the rank.
+    """
+    rng = random.Random(seed)
+    words = [f"w{rank}" for rank in range(20000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    site = {}
+    for i in range(pages):
+        links = "\n".join(
+            f'<a href="/page{(i * fanout + k + 1) % pages}.html">next</a>'
+            for k in range(fanout))
+        filler = ""
+        if page_bytes:
+            # Words average a little under 6 bytes with their space
+            filler = "<p>" + " ".join(rng.choices(words, cum_weights=cum_weights,
+                                                  k=page_bytes // 6)) + "</p>"
+        site[f"/page{i}.html"] = f"""
+            <html>
+                <head><title>Page {i}</title></head>
+                <body>
+                    {links}
+                    {"<div>" * depth}
+                    <p>This is page number {i} about python and web crawling</p>
+                    {filler}
+                    {"</div>" * depth}
+                </body>
+            </html>
+        """
+    return site
+
+
+class _BenchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops the connections of a concurrent
+    # crawl, which then stall for seconds on SYN retransmits
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hang up early on purpose, e.g. fetch_page on pages over
+        # its size limit; anything else is still reported
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class SiteServer:
+    """
+    Serve a generated site on localhost with a fixed delay per request.
+
+    Records when each request arrived. With `max_rate`, requests beyond
+    that many in the last second are answered 429, like a host that
+    protects itself from aggressive crawlers.
+    """
+
+    def __init__(self, site, latency=0.0, max_rate=None):
+        # Encoded up front, so serving allocates nothing per request
+        self.site = {path: body.encode('utf-8') for path, body in site.items()}
+        self.latency = latency
+        self.max_rate = max_rate
+        self.arrivals = []
+        self.rejected = 0
+        lock = threading.Lock()
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    now = time.monotonic()
+                    recent = sum(1 for t in outer.arrivals[-100:] if now - t < 1.0)
+                    outer.arrivals.append(now)
+                    if outer.max_rate and recent >= outer.max_rate:
+                        outer.rejected += 1
+                        throttled = True
+                    else:
+                        throttled = False
+                if throttled:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                time.sleep(outer.latency)
+                # Query strings don't change the page, as with tracking links
+                data = outer.site.get(self.path.split('?')[0])
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _BenchHTTPServer(('localhost', 0), Handler)
+        self.base_url = f'http://localhost:{self.server.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AsyncSiteServer:
+    """
+    SiteServer on an asyncio event loop.
+
+    A response waiting out its latency holds no thread, so the server
+    keeps up with any number of concurrent requests. Speaks just enough
+    HTTP/1.1 for the crawlers: GET and HEAD on kept-alive connections.
+    """
+
+    def __init__(self, site, latency=0.0):
+        self.site = {path: body.encode('utf-8') for path, body in site.items()}
+        self.latency = latency
+        self.arrivals = []
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, 'localhost', 0))
+        port = self._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://localhost:{port}'
+        self._thread = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b'\r\n\r\n')
+                self.arrivals.append(time.monotonic())
+                method, target, _ = request.split(b' ', 2)
+                await asyncio.sleep(self.latency)
+                data = self.site.get(target.decode('latin-1').split('?')[0])
+                status = b'200 OK' if data is not None else b'404 Not Found'
+                data = data or b''
+                writer.write(b'HTTP/1.1 %s\r\nContent-Type: text/html; charset=utf-8\r\n'
+                             b'Content-Length: %d\r\n\r\n' % (status, len(data)))
+                if method != b'HEAD':
+                    writer.write(data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._server.close()
+        self._loop.run_until_complete(self._server.wait_closed())
+        self._loop.close()
+
+
+def make_duplicate_site(articles=200, words=400, fanout=3):
+    """
+    Generate a site where every article also appears under other URLs:
+    with tracking parameters, as a print view with rel=canonical, and
+    as a lightly edited mirror copy.
+    """
+    rng = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    site = {}
+    for i in range(articles):
+        text = ' '.join(rng.choice(vocabulary) for _ in range(words))
+        links = []
+        for k in range(1, fanout + 1):
+            j = (i * fanout + k) % articles
+            links.append(f'<a href="/article{j}.html?utm_source=related&amp;utm_medium={k}">'
+                         f'next</a><a href="/article{j}.html">next</a>'
+                         f'<a href="/print/article{j}.html">print</a>'
+                         f'<a href="/mirror/article{j}.html">mirror</a>')
+        links = ''.join(links)
+        site[f"/article{i}.html"] = (
+            f"<html><head><title>Article {i}</title></head>"
+            f"<body>{links}<p>{text}</p></body></html>")
+        site[f"/print/article{i}.html"] = (
+            f'<html><head><title>Article {i}</title>'
+            f'<link rel="canonical" href="/article{i}.html"></head>'
+            f"<body><p>Printer friendly version</p><p>{text}</p></body></html>")
+        site[f"/mirror/article{i}.html"] = (
+            f"<html><head><title>Article {i} (mirror)</title></head>"
+            f"<body>{links}<p>Mirrored on {rng.randrange(1, 29)} May</p>"
+            f"<p>{text}</p></body></html>")
+    return site
+
+
+def bench_dedup(args):
+    """Pages indexed, index size and crawl time with and without dedup"""
+    site = make_duplicate_site(args.articles, args.words)
+    with SiteServer(site, args.latency) as server:
+        for dedup in (False, True):
+            index_dir = tempfile.mkdtemp(prefix='bench_index_')
+            try:
+                crawler = WhooshCrawler(server.base_url + '/article0.html', index_dir,
+                                        rate=None, dedup=dedup)
+                start = time.perf_counter()
+                crawler.crawl()
+                elapsed = time.perf_counter() - start
+                with crawler.ix.searcher() as searcher:
+                    indexed = searcher.doc_count()
+                size = directory_size(live_dir(index_dir))
+                print(f"dedup {'on ' if dedup else 'off'}: {len(crawler.frontier.seen):5} URLs "
+                      f"{indexed:5} pages indexed  {size / 1e6:6.2f} MB  "
+                      f"{elapsed:6.2f}s  skipped {crawler.dedup_stats}")
+            finally:
+                shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def time_whoosh_crawl(start_url, rate=None, **crawl_args):
+    """Crawl into a throwaway index and return (seconds, pages visited)"""
+    index_dir = tempfile.mkdtemp(prefix='bench_index_')
+    try:
+        # Unthrottled unless asked: these runs measure the crawler itself
+        crawler = WhooshCrawler(start_url, index_dir, rate=rate)
+        start = time.perf_counter()
+        if crawl_args:
+            crawler.crawl_async(**crawl_args)
+        else:
+            crawler.crawl()
+        return time.perf_counter() - start, len(crawler.visited_urls)
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def bench_crawl(args):
+    """Compare the sequential and the concurrent Whoosh crawl"""
+    site = make_site(args.pages, args.fanout)
+    with SiteServer(site, args.latency) as server:
+        start_url = server.base_url + '/page0.html'
+        seq_time, seq_pages = time_whoosh_crawl(start_url)
+        async_time, async_pages = time_whoosh_crawl(
+            start_url, concurrency=args.concurrency, per_host=args.concurrency)
+
+    print(f"sequential: {seq_pages} pages in {seq_time:.2f}s "
+          f"({seq_pages / seq_time:.1f} pages/s)")
+    print(f"async:      {async_pages} pages in {async_time:.2f}s "
+          f"({async_pages / async_time:.1f} pages/s)")
+    print(f"speedup:    {seq_time / async_time:.1f}x")
+
+
+def make_large_page(i, paragraphs=500):
+    """Generate a page heavy enough that parsing dominates"""
+    body = "\n".join(
+        f'<div class="row"><p>Paragraph {k} of page {i} about python, '
+        f'search engines and <a href="/page{k}.html">link {k}</a></p></div>'
+        for k in range(paragraphs))
+    return f"<html><head><title>Page {i}</title></head><body>{body}</body></html>"
+
+
+def bench_parse(args):
+    """Measure parse throughput per backend and per number of processes"""
+    pages = [make_large_page(i, args.paragraphs) for i in range(args.pages)]
+    megabytes = sum(len(page) for page in pages) / 1e6
+
+    for backend in available_backends():
+        start = time.perf_counter()
+        for page in pages:
+            parse_page(page, 'http://localhost/', backend)
+        elapsed = time.perf_counter() - start
+        print(f"{backend:12} 1 thread:   {args.pages / elapsed:7.1f} pages/s "
+              f"({megabytes / elapsed:.1f} MB/s)")
+
+    backend = available_backends()[0]
+    workers = 1
+    while workers <= args.workers:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            # Warm up the workers so start-up cost is not measured
+            list(pool.map(parse_page, pages[:workers],
+                          ['http://localhost/'] * workers, [backend] * workers))
+            start = time.perf_counter()
+            list(pool.map(parse_page, pages, ['http://localhost/'] * len(pages),
+                          [backend] * len(pages), chunksize=4))
+            elapsed = time.perf_counter() - start
+        print(f"{backend:12} {workers} processes: {args.pages / elapsed:7.1f} pages/s "
+              f"({megabytes / elapsed:.1f} MB/s)")
+        workers *= 2
+
+
+def make_nested_page(depth=50, paragraphs=20):
+    """Generate a page whose text sits `depth` divs deep"""
+    text = "".join(
+        f"<p>Paragraph {k} about python and deeply nested layouts</p>"
+        for k in range(paragraphs))
+    return ("<html><head><title>Nested</title></head><body>"
+            + "<div>" * depth + text + "</div>" * depth + "</body></html>")
+
+
+def legacy_extract(html_content):
+    """The region extraction crawler.WebCrawler used before the single pass"""
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for script in soup(['script', 'style']):
+        script.decompose()
+    main_content = ""
+    for tag in ['main', 'article', 'div', 'p']:
+        for element in soup.find_all(tag):
+            main_content += " " + element.get_text()
+    return main_content
+
+
+def measure(func, repeat):
+    """Return (seconds per call, peak bytes allocated) for func()"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_extract(args):
+    """Compare legacy and single-pass text extraction on a nested page"""
+    page = make_nested_page(args.depth, args.paragraphs)
+    crawler = SimpleCrawler('http://localhost/', parser='html.parser')
+    url = 'http://localhost/'
+
+    legacy = lambda: crawler.process_text(legacy_extract(page))
+    single = lambda: crawler.count_words(crawler.extract_fields(page, url)[0])
+
+    legacy_time, legacy_peak = measure(legacy, args.repeat)
+    single_time, single_peak = measure(single, args.repeat)
+    legacy_python = legacy().count('python')
+    single_python = single()['python']
+
+    print(f"page: {len(page) / 1e3:.1f} kB, {args.depth} levels of nesting")
+    print(f"legacy:      {legacy_time * 1e3:7.2f} ms  peak {legacy_peak / 1e6:6.2f} MB  "
+          f"tf(python)={legacy_python}")
+    print(f"single pass: {single_time * 1e3:7.2f} ms  peak {single_peak / 1e6:6.2f} MB  "
+          f"tf(python)={single_python}")
+    print(f"speedup:     {legacy_time / single_time:.1f}x, "
+          f"memory {legacy_peak / single_peak:.1f}x less")
+
+
+def zipf_documents(pages, vocabulary=50000, terms_per_page=150, seed=0):
+    """
+    Yield (url, word_counts) for synthetic pages whose words follow a
+    Zipf distribution, like the words of natural-language text.
+    """
+    rng = random.Random(seed)
+    words = [f"w{rank}" for rank in range(vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    for page in range(pages):
+        word_counts = {}
+        for word in rng.choices(words, cum_weights=cum_weights, k=terms_per_page):
+            word_counts[word] = word_counts.get(word, 0) + 1
+        yield f"https://example.com/section/{page % 100}/page{page}.html", word_counts
+
+
+def build_legacy_index(documents):
+    """The dict-of-dicts index crawler.WebCrawler used before CompactIndex"""
+    index = defaultdict(lambda: defaultdict(int))
+    for url, word_counts in documents:
+        for word, count in word_counts.items():
+            index[word][url] = count
+    return index
+
+
+def build_compact_index(documents):
+    index = CompactIndex()
+    for url, word_counts in documents:
+        index.add_document(url, word_counts)
+    index.compact()
+    return index
+
+
+def traced_size(build, documents):
+    """Return (object, bytes still allocated) after building it"""
+    tracemalloc.start()
+    built = build(documents)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return built, size
+
+
+def bench_index_memory(args):
+    """Compare memory per posting of the legacy and the compact index"""
+    documents = list(zipf_documents(args.pages))
+    legacy, legacy_size = traced_size(build_legacy_index, documents)
+    del legacy
+    compact, compact_size = traced_size(build_compact_index, documents)
+    postings = compact.posting_count()
+
+    print(f"{args.pages} pages, {len(compact)} terms, {postings} postings")
+    print(f"legacy:  {legacy_size / 1e6:8.1f} MB  {legacy_size / postings:6.1f} bytes/posting")
+    print(f"compact: {compact_size / 1e6:8.1f} MB  {compact_size / postings:6.1f} bytes/posting")
+    print(f"ratio:   {legacy_size / compact_size:.1f}x")
+
+
+def bench_index_load(args):
+    """Time to save, load and first query a CompactIndex, against pickle"""
+    start = time.perf_counter()
+    index = build_compact_index(zipf_documents(args.pages))
+    build_time = time.perf_counter() - start
+    queries = [["w3", "w30"], ["w100", "w1000"], ["w7"]]
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'index.bin')
+        start = time.perf_counter()
+        index.save(path)
+        save_time = time.perf_counter() - start
+        pickle_path = os.path.join(tmp, 'index.pickle')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        def load_mapped():
+            return CompactIndex.load(path)
+
+        def load_pickled():
+            with open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+
+        print(f"{index.posting_count()} postings, {len(index.urls)} pages, "
+              f"{len(index)} terms; built in {build_time:.2f}s, saved in {save_time:.2f}s")
+        for name, load, size in (('mmap', load_mapped, os.path.getsize(path)),
+                                 ('pickle', load_pickled, os.path.getsize(pickle_path))):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                loaded = load()
+            load_time = (time.perf_counter() - start) / args.repeat
+            start = time.perf_counter()
+            for words in queries:
+                loaded.match_all(words)
+            query_time = (time.perf_counter() - start) / len(queries)
+            print(f"{name:6}: {size / 1e6:6.2f} MB  load {load_time * 1e3:8.2f} ms  "
+                  f"first queries {query_time * 1e3:6.2f} ms each")
+            del loaded
+    finally:
+        shutil.rmtree(tmp)
+
+
+def legacy_match_all(index, words):
+    """Set intersection in typed order, as crawler.WebCrawler.search did"""
+    url_sets = [set(index.postings(word)[0]) for word in words]
+    result = url_sets[0]
+    for urls in url_sets[1:]:
+        result &= urls
+    return sorted(result)
+
+
+def bench_intersect(args):
+    """Time multi-term AND queries with set and galloping intersection"""
+    index = build_compact_index(zipf_documents(args.pages))
+    by_df = sorted(index.terms(), key=index.doc_frequency, reverse=True)
+    common = by_df[:10]
+    medium = by_df[200:210]
+    rare = [term for term in by_df if index.doc_frequency(term) >= 3][-10:]
+    queries = {
+        'rare + common': [[r, c] for r, c in zip(rare, common)],
+        'rare + 2 common': [[c, r, c2] for r, c, c2 in zip(rare, common, common[1:])],
+        'medium + common': [[c, m] for m, c in zip(medium, common)],
+        'common + common': [[c, c2] for c, c2 in zip(common, common[1:])],
+        'unknown + common': [[c, 'notaword'] for c in common],
+    }
+
+    print(f"{args.pages} pages; df common ~{index.doc_frequency(common[0])}, "
+          f"medium ~{index.doc_frequency(medium[0])}, rare ~{index.doc_frequency(rare[0])}")
+    for name, word_lists in queries.items():
+        timings = []
+        for match in (legacy_match_all, CompactIndex.match_all):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for words in word_lists:
+                    match(index, words)
+            timings.append((time.perf_counter() - start) / (args.repeat * len(word_lists)))
+        for words in word_lists:
+            assert list(index.match_all(words)) == legacy_match_all(index, words)
+        legacy_time, galloping_time = timings
+        print(f"{name:17} set: {legacy_time * 1e6:9.1f} us  galloping: "
+              f"{galloping_time * 1e6:8.1f} us  ({legacy_time / galloping_time:.0f}x)")
+
+
+def score_everything(scorer, words):
+    """Score every matching document and sort them all (any word matches)"""
+    scores = defaultdict(float)
+    for word in words:
+        idf, _, doc_ids, freqs = scorer.term(word)
+        for doc_id, freq in zip(doc_ids, freqs):
+            scores[doc_id] += scorer._score(idf, freq, doc_id)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+def bench_rank(args):
+    """Time BM25 top-k against scoring and sorting every match"""
+    index = build_compact_index(zipf_documents(args.pages))
+    scorer = BM25(index)
+    by_df = sorted(index.terms(), key=index.doc_frequency, reverse=True)
+    queries = {
+        'common + rare (any)': ([by_df[0], by_df[5000]], False),
+        '3 common (any)': (by_df[1:4], False),
+        'medium + common (any)': ([by_df[2], by_df[300]], False),
+        '2 common (all)': (by_df[1:3], True),
+    }
+    # Upper bounds are computed once per term; keep that out of the timings
+    for words, _ in queries.values():
+        for word in words:
+            scorer.term(word)
+
+    print(f"{args.pages} pages, k={args.k}")
+    for name, (words, match_all) in queries.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            full = score_everything(scorer, words)
+        full_time = (time.perf_counter() - start) / args.repeat
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            top = scorer.top_k(words, args.k, match_all)
+        top_time = (time.perf_counter() - start) / args.repeat
+        print(f"{name:22} score all {len(full):6} matches: {full_time * 1e3:8.2f} ms  "
+              f"top-k: {top_time * 1e3:8.2f} ms  ({full_time / top_time:.1f}x)")
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def bench_schema(args):
+    """Compare index size, commit time and highlighting of the schema profiles"""
+    documents = [(url, " ".join(word for word, count in word_counts.items()
+                                for _ in range(count)))
+                 for url, word_counts in zipf_documents(args.pages, terms_per_page=600)]
+    queries = [f"w{rank}" for rank in (3, 30, 300)] + ["w5 w50", '"w1 w2"']
+    for profile in ('debug', 'lean'):
+        index_dir = tempfile.mkdtemp()
+        try:
+            new_index(index_dir, profile)
+            crawler = WhooshCrawler('http://localhost/', index_dir, profile=profile)
+            start = time.perf_counter()
+            writer = crawler.open_writer()
+            for url, text in documents:
+                writer.add_document(url=url, title=url, content=text)
+                if crawler.snippets is not None:
+                    crawler.snippets.put(url, text)
+            crawler.commit(writer)
+            commit_time = time.perf_counter() - start
+            size = directory_size(live_dir(index_dir))
+            snippet_size = os.path.getsize(crawler.snippets.path) if crawler.snippets else 0
+
+            index = SearchIndex(index_dir)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                for query in queries:
+                    index.result_cache.clear()
+                    index.search(query)
+            search_time = (time.perf_counter() - start) / (args.repeat * len(queries))
+            print(f"{profile:5}: segments {(size - snippet_size) / 1e6:6.2f} MB  "
+                  f"snippets {snippet_size / 1e6:6.2f} MB  build {commit_time:5.2f} s  "
+                  f"search+highlight {search_time * 1e3:6.2f} ms/page")
+        finally:
+            shutil.rmtree(index_dir)
+
+
+def bench_suggest(args):
+    """Suggester build and update time, and completion vs search latency"""
+    documents = [(url, " ".join(word for word, count in word_counts.items()
+                                for _ in range(count)))
+                 for url, word_counts in zipf_documents(args.pages, terms_per_page=300)]
+    index_dir = tempfile.mkdtemp()
+    try:
+        new_index(index_dir)
+        crawler = WhooshCrawler('http://localhost/', index_dir)
+        writer = crawler.open_writer()
+        for i, (url, text) in enumerate(documents):
+            writer.add_document(url=url, title=f"Page {i} {text[:20]}", content=text)
+        crawler.commit(writer)
+        index = SearchIndex(index_dir, refresh_interval=0)
+
+        start = time.perf_counter()
+        index.suggest("w")
+        print(f"build:  {time.perf_counter() - start:7.3f} s for "
+              f"{len(index.suggester)} completions")
+
+        # One more small commit, as a checkpoint during a crawl would add
+        writer = crawler.open_writer()
+        for url, text in documents[:args.pages // 100]:
+            writer.add_document(url=url + "?new", title="New page", content=text)
+        crawler.commit(writer)
+        start = time.perf_counter()
+        index.suggest("w")
+        print(f"update: {time.perf_counter() - start:7.3f} s after a commit of "
+              f"{args.pages // 100} pages")
+
+        index.refresh_interval = 1.0
+        rng = random.Random(0)
+        words = [text.split()[rng.randrange(50)] for _, text in documents[:200]]
+        # Each word as it is typed: w, w1, w12, ...
+        prefixes = [word[:length] for word in words for length in range(1, len(word) + 1)]
+        latencies = []
+        for prefix in prefixes:
+            start = time.perf_counter()
+            index.suggest(prefix)
+            latencies.append(time.perf_counter() - start)
+        print(f"suggest: p50 {percentile(latencies, 0.5) * 1e6:7.1f} us  "
+              f"p99 {percentile(latencies, 0.99) * 1e6:7.1f} us  "
+              f"over {len(prefixes)} keystrokes")
+        latencies = []
+        # Shorter prefixes expand to too many terms to search at all
+        for prefix in [prefix for prefix in prefixes if len(prefix) >= 3][:50]:
+            index.result_cache.clear()
+            start = time.perf_counter()
+            index.search(prefix + "*")
+            latencies.append(time.perf_counter() - start)
+        print(f"search:  p50 {percentile(latencies, 0.5) * 1e6:7.1f} us  "
+              f"p99 {percentile(latencies, 0.99) * 1e6:7.1f} us  "
+              f"for the 3+ character prefixes as wildcard queries")
+    finally:
+        shutil.rmtree(index_dir)
+
+
+def max_rss_mb():
+    """Peak resident memory of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_links(args):
+    """Link graph build, PageRank and load time and memory on a large graph"""
+    rng = random.Random(0)
+    urls = [f"http://example.com/{i}" for i in range(args.pages)]
+    # Links favour popular pages, the way real sites link their home page
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.pages)))
+    print(f"{args.pages} pages, {args.links} links each; "
+          f"NumPy {'on' if link_graph.np is not None else 'off'}")
+
+    builder = LinkGraphBuilder()
+    elapsed = 0.0
+    for url in urls:
+        links = [urls[target] for target in rng.choices(
+            range(args.pages), cum_weights=cumulative, k=args.links)]
+        start = time.perf_counter()
+        builder.add_page(url, links)
+        elapsed += time.perf_counter() - start
+    print(f"record: {elapsed:7.2f} s   peak {max_rss_mb():7.0f} MB")
+
+    start = time.perf_counter()
+    graph = builder.build()
+    del builder
+    print(f"build:  {time.perf_counter() - start:7.2f} s   peak {max_rss_mb():7.0f} MB  "
+          f"{graph.edge_count} distinct links")
+
+    start = time.perf_counter()
+    graph.rank()
+    print(f"rank:   {time.perf_counter() - start:7.2f} s   peak {max_rss_mb():7.0f} MB")
+    if args.python:
+        numpy, link_graph.np = link_graph.np, None
+        try:
+            start = time.perf_counter()
+            pagerank(graph.offsets, graph.targets)
+            print(f"rank without NumPy: {time.perf_counter() - start:7.2f} s")
+        finally:
+            link_graph.np = numpy
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'links.graph')
+        start = time.perf_counter()
+        graph.save(path)
+        print(f"save:   {time.perf_counter() - start:7.2f} s   "
+              f"{os.path.getsize(path) / 1e6:7.1f} MB file")
+        start = time.perf_counter()
+        loaded = LinkGraph.load(path)
+        scores = list(loaded.scores_of(sorted(rng.sample(urls, 10000))))
+        print(f"load and look up {len(scores)} pages: {time.perf_counter() - start:7.3f} s")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_shards(args):
+    """Index build throughput with the writer sharded over processes"""
+    tmp = tempfile.mkdtemp()
+    try:
+        # Written out first, so the builds replay pages from disk rather
+        # than generate them
+        corpus = os.path.join(tmp, 'corpus.jsonl')
+        with open(corpus, 'w') as f:
+            for i, (url, word_counts) in enumerate(zipf_documents(args.pages)):
+                content = " ".join(word for word, count in word_counts.items()
+                                   for _ in range(count))
+                f.write(json.dumps({'url': url, 'title': f"Page {i}", 'content': content}))
+                f.write("\n")
+        print(f"{args.pages} pages, {os.path.getsize(corpus) / 1e6:.1f} MB corpus, "
+              f"{default_workers()} cores")
+
+        baseline = None
+        for shards in args.shards:
+            index_dir = os.path.join(tmp, f'index-{shards}')
+            new_index(index_dir)
+            crawler = WhooshCrawler('http://localhost/', index_dir, dedup=False,
+                                    shards=shards)
+            start, start_cpu = time.perf_counter(), time.process_time()
+            writer = crawler.open_writer()
+            with open(corpus) as f:
+                for line in f:
+                    page = json.loads(line)
+                    crawler.add_page(writer, page['url'], page['title'], page['content'])
+            crawler.commit(writer)
+            elapsed = time.perf_counter() - start
+            # What is left on this process bounds the speedup more cores give
+            cpu = time.process_time() - start_cpu
+            rate = args.pages / elapsed
+            baseline = baseline or rate
+            stats = segment_stats(crawler.ix)
+            print(f"{shards:3} shards: {elapsed:7.2f} s  {rate:7.0f} pages/s  "
+                  f"{rate / baseline:4.1f}x  main process CPU {cpu:6.2f} s  "
+                  f"{stats['segment_count']} segments, {stats['documents']} pages")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def time_queries(ix, queries, repeat):
+    from whoosh.qparser import QueryParser
+    parser = QueryParser("content", ix.schema)
+    parsed = [parser.parse(query) for query in queries]
+    with ix.searcher() as searcher:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for query in parsed:
+                searcher.search(query, limit=10)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def bench_segments(args):
+    """Query latency as checkpointed commits age an index, per merge policy"""
+    documents = [(url, " ".join(word_counts))
+                 for url, word_counts in zipf_documents(args.pages, vocabulary=5000)]
+    queries = ["w3", "w30", "w300", "w5 w50"]
+    rng = random.Random(0)
+    for name in ('none', 'small', 'tiered', 'tiered+optimize'):
+        index_dir = tempfile.mkdtemp()
+        try:
+            ix = create_in(index_dir, make_schema())
+            policy = MERGE_POLICIES[name.split('+')[0]]
+            checkpoints = []
+            for commit in range(args.commits):
+                # Each commit recrawls a few pages: new ones and changed ones
+                writer = ix.writer()
+                for url, text in rng.sample(documents, args.batch):
+                    writer.update_document(url=url, content=text)
+                writer.commit(mergetype=policy)
+                if name.endswith('optimize') and segment_stats(ix)['segment_count'] > 10:
+                    optimize(ix)
+                if (commit + 1) % (args.commits // 4) == 0:
+                    stats = segment_stats(ix)
+                    checkpoints.append(f"{stats['segment_count']:3} segs "
+                                       f"{time_queries(ix, queries, args.repeat) * 1e3:5.2f} ms")
+            print(f"{name:16} " + " | ".join(checkpoints))
+        finally:
+            shutil.rmtree(index_dir)
+
+
+
+async def fetch_all(queue, fetcher, concurrency):
+    """Fetch every (url, depth) popped from `queue`, up to concurrency * 4 at once"""
+    pending = set()
+    while queue or pending:
+        while queue and len(pending) < concurrency * 4:
+            url, _ = queue.pop()
+            pending.add(asyncio.ensure_future(fetcher.fetch(url)))
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+
+def peak_rate(arrivals, window=1.0):
+    """Most requests seen in any `window` seconds"""
+    peak, start = 0, 0
+    for end, t in enumerate(arrivals):
+        while t - arrivals[start] >= window:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak
+
+
+def bench_polite(args):
+    """Per-host rate limits and aggregate throughput over several hosts"""
+    site = make_site(args.pages)
+    servers = [SiteServer(site, args.latency, max_rate=args.server_limit)
+               for _ in range(args.hosts)]
+    for server in servers:
+        server.__enter__()
+    try:
+        urls = [server.base_url + path for server in servers for path in site]
+        for interleave in (False, True):
+            for server in servers:
+                server.arrivals.clear()
+                server.rejected = 0
+            if interleave:
+                queue = Frontier()
+                queue.extend(urls)
+            else:
+                # URLs in the order they were found: one host after the other
+                queue = [(url, 0) for url in reversed(urls)]
+
+            async def run():
+                fetcher = AsyncFetcher(args.concurrency, args.concurrency,
+                                       scheduler=HostScheduler(args.rate, args.burst))
+                try:
+                    await fetch_all(queue, fetcher, args.concurrency)
+                finally:
+                    fetcher.close()
+
+            start = time.perf_counter()
+            asyncio.run(run())
+            elapsed = time.perf_counter() - start
+            peaks = [peak_rate(server.arrivals) for server in servers]
+            rejected = sum(server.rejected for server in servers)
+            print(f"{'interleaved' if interleave else 'host by host':12}: "
+                  f"{len(urls)} pages in {elapsed:6.2f}s ({len(urls) / elapsed:6.1f} pages/s), "
+                  f"peak per host {max(peaks)}/s (limit {args.rate:g}/s + burst {args.burst}), "
+                  f"{rejected} answered 429")
+    finally:
+        for server in servers:
+            server.__exit__(None, None, None)
+
+
+
+def percentile(values, fraction):
+    """The value below which `fraction` of the values lie"""
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """Crawl, extraction, indexing and search figures for both crawlers"""
+    site = make_site(args.pages, args.fanout, args.depth, args.page_bytes)
+    results = {}
+
+    def record(name, value, unit, better):
+        results[name] = {'value': value, 'unit': unit, 'better': better}
+        print(f"{name:32} {value:12.3f} {unit}")
+
+    def crawl_rate(crawl, visited):
+        start = time.perf_counter()
+        crawl()
+        return len(visited()) / (time.perf_counter() - start)
+
+    # Crawl throughput, against the stand-in server, unthrottled
+    server_class = AsyncSiteServer if args.server == 'async' else SiteServer
+    with server_class(site, args.latency) as server:
+        start_url = server.base_url + '/page0.html'
+        simple = SimpleCrawler(start_url, rate=None)
+        record('crawl.simple.pages_per_s',
+               crawl_rate(simple.crawl, lambda: simple.visited_urls), 'pages/s', 'higher')
+        seconds, pages = time_whoosh_crawl(start_url)
+        record('crawl.whoosh.pages_per_s', pages / seconds, 'pages/s', 'higher')
+        seconds, pages = time_whoosh_crawl(
+            start_url, concurrency=args.concurrency, per_host=args.concurrency)
+        record('crawl.whoosh_async.pages_per_s', pages / seconds, 'pages/s', 'higher')
+
+    # Extraction throughput over the same pages
+    pages = [(f"http://localhost{path}", html) for path, html in site.items()]
+    megabytes = sum(len(html) for _, html in pages) / 1e6
+    for backend in available_backends():
+        start = time.perf_counter()
+        for url, html in pages:
+            parse_page(html, url, backend)
+        record(f'extract.{backend}.mb_per_s',
+               megabytes / (time.perf_counter() - start), 'MB/s', 'higher')
+    start = time.perf_counter()
+    word_counts = [(url, simple.count_words(simple.extract_fields(html, url)[0]))
+                   for url, html in pages]
+    record('extract.regions.mb_per_s',
+           megabytes / (time.perf_counter() - start), 'MB/s', 'higher')
+
+    # Index build time and size, from pages already parsed
+    parsed = [(url, parse_page(html, url, default_backend())) for url, html in pages]
+    tmp = tempfile.mkdtemp(prefix='bench_index_')
+    try:
+        index_dir = os.path.join(tmp, 'whoosh')
+        new_index(index_dir)
+        crawler = WhooshCrawler('http://localhost/', index_dir)
+        start = time.perf_counter()
+        writer = crawler.open_writer()
+        for url, (title, content, _) in parsed:
+            crawler.add_page(writer, url, title, content)
+        crawler.commit(writer)
+        record('build.whoosh.seconds', time.perf_counter() - start, 's', 'lower')
+        record('size.whoosh.bytes', directory_size(live_dir(index_dir)), 'bytes', 'lower')
+
+        start = time.perf_counter()
+        index = build_compact_index(word_counts)
+        record('build.compact.seconds', time.perf_counter() - start, 's', 'lower')
+        index_path = os.path.join(tmp, 'compact.bin')
+        index.save(index_path)
+        record('size.compact.bytes', os.path.getsize(index_path), 'bytes', 'lower')
+
+        # Search latency; the result cache is cleared so every search runs
+        queries = ['python', 'w0', 'w5', 'w50', 'w500', 'w5000',
+                   'w1 w2', 'w10 w100', 'python w3', 'page w20 w200']
+        search_index = SearchIndex(index_dir)
+        latencies = []
+        for _ in range(args.repeat):
+            for query in queries:
+                search_index.result_cache.clear()
+                start = time.perf_counter()
+                search_index.search(query)
+                latencies.append(time.perf_counter() - start)
+        record('search.whoosh.p50_ms', percentile(latencies, 0.5) * 1e3, 'ms', 'lower')
+        record('search.whoosh.p99_ms', percentile(latencies, 0.99) * 1e3, 'ms', 'lower')
+
+        simple.index = index
+        simple.scorer()
+        latencies = []
+        for _ in range(args.repeat):
+            for query in queries:
+                start = time.perf_counter()
+                simple.rank(query.split(), 10)
+                latencies.append(time.perf_counter() - start)
+        record('search.simple.p50_ms', percentile(latencies, 0.5) * 1e3, 'ms', 'lower')
+        record('search.simple.p99_ms', percentile(latencies, 0.99) * 1e3, 'ms', 'lower')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if args.json:
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'args': {name: value for name, value in vars(args).items()
+                     if isinstance(value, (int, float, str))},
+            'results': results,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def bench_compare(args):
+    """Compare two suite reports, exiting with 1 if anything regressed"""
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before.get('args') != after.get('args'):
+        print("Warning: the two runs used different options")
+    print(f"{'':32} {before.get('commit') or 'before':>12} {after.get('commit') or 'after':>12}")
+    regressions = []
+    for name, result in after['results'].items():
+        old = before['results'].get(name)
+        if old is None or not old['value']:
+            print(f"{name:32} {'':>12} {result['value']:12.3f}")
+            continue
+        change = result['value'] / old['value'] - 1
+        worse = -change if result['better'] == 'higher' else change
+        flag = ''
+        if worse > args.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:32} {old['value']:12.3f} {result['value']:12.3f} "
+              f"{change:+8.1%} {result['unit']}{flag}")
+    if regressions:
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+        sys.exit(1)
+
+
+def bench_fetch(args):
+    """Time and memory spent fetching a huge page, buffered and streamed"""
+    size = args.megabytes * 1024 * 1024
+    site = {
+        # Served as HTML by SiteServer, so only the size limit stops it
+        '/huge.html': '<p>' + 'x' * size + '</p>',
+    }
+    with SiteServer(site) as server:
+        session = make_session()
+
+        def legacy(url):
+            response = session.get(url)
+            return len(response.content), 'text/html' in response.headers.get('content-type', '')
+
+        def streaming(url):
+            try:
+                page = fetch_page(session, url)
+                return len(page.content), True
+            except SkippedPage:
+                return 0, False
+
+        for name, fetch in (('get + .text', legacy), ('fetch_page', streaming)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            read, kept = fetch(server.base_url + '/huge.html')
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{name:12}: {elapsed:6.2f}s  peak {peak / 1e6:7.1f} MB  "
+                  f"body kept {read / 1e6:6.1f} MB  indexed: {kept}")
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    crawl = commands.add_parser('crawl', help=bench_crawl.__doc__)
+    crawl.add_argument('--pages', type=int, default=200)
+    crawl.add_argument('--fanout', type=int, default=5)
+    crawl.add_argument('--latency', type=float, default=0.05,
+                       help='seconds the server waits before each response')
+    crawl.add_argument('--concurrency', type=int, default=32)
+    crawl.set_defaults(func=bench_crawl)
+
+    parse = commands.add_parser('parse', help=bench_parse.__doc__)
+    parse.add_argument('--pages', type=int, default=200)
+    parse.add_argument('--paragraphs', type=int, default=500)
+    parse.add_argument('--workers', type=int, default=default_workers(),
+                       help='largest process pool to try')
+    parse.set_defaults(func=bench_parse)
+
+    extract = commands.add_parser('extract', help=bench_extract.__doc__)
+    extract.add_argument('--depth', type=int, default=50)
+    extract.add_argument('--paragraphs', type=int, default=20)
+    extract.add_argument('--repeat', type=int, default=20)
+    extract.set_defaults(func=bench_extract)
+
+    memory = commands.add_parser('index-memory', help=bench_index_memory.__doc__)
+    memory.add_argument('--pages', type=int, default=20000)
+    memory.set_defaults(func=bench_index_memory)
+
+    suggest = commands.add_parser('suggest', help=bench_suggest.__doc__)
+    suggest.add_argument('--pages', type=int, default=2000)
+    suggest.set_defaults(func=bench_suggest)
+
+    load = commands.add_parser('index-load', help=bench_index_load.__doc__)
+    load.add_argument('--pages', type=int, default=10000)
+    load.add_argument('--repeat', type=int, default=5)
+    load.set_defaults(func=bench_index_load)
+
+    intersect = commands.add_parser('intersect', help=bench_intersect.__doc__)
+    intersect.add_argument('--pages', type=int, default=50000)
+    intersect.add_argument('--repeat', type=int, default=5)
+    intersect.set_defaults(func=bench_intersect)
+
+    rank = commands.add_parser('rank', help=bench_rank.__doc__)
+    rank.add_argument('--pages', type=int, default=50000)
+    rank.add_argument('--k', type=int, default=10)
+    rank.add_argument('--repeat', type=int, default=3)
+    rank.set_defaults(func=bench_rank)
+
+    schema = commands.add_parser('schema', help=bench_schema.__doc__)
+    schema.add_argument('--pages', type=int, default=2000)
+    schema.add_argument('--repeat', type=int, default=20)
+    schema.set_defaults(func=bench_schema)
+
+    segments = commands.add_parser('segments', help=bench_segments.__doc__)
+    segments.add_argument('--pages', type=int, default=2000)
+    segments.add_argument('--commits', type=int, default=100)
+    segments.add_argument('--batch', type=int, default=20,
+                          help='pages written per commit')
+    segments.add_argument('--repeat', type=int, default=20)
+    segments.set_defaults(func=bench_segments)
+
+    polite = commands.add_parser('polite', help=bench_polite.__doc__)
+    polite.add_argument('--hosts', type=int, default=4)
+    polite.add_argument('--pages', type=int, default=100, help='pages per host')
+    polite.add_argument('--rate', type=float, default=20, help='requests/s per host')
+    polite.add_argument('--burst', type=int, default=4)
+    polite.add_argument('--latency', type=float, default=0.02)
+    polite.add_argument('--concurrency', type=int, default=16)
+    polite.add_argument('--server-limit', type=int, default=None,
+                        help='answer 429 beyond this many requests/s per host')
+    polite.set_defaults(func=bench_polite)
+
+    fetch = commands.add_parser('fetch', help=bench_fetch.__doc__)
+    fetch.add_argument('--megabytes', type=int, default=50)
+    fetch.set_defaults(func=bench_fetch)
+
+    suite = commands.add_parser('suite', help=bench_suite.__doc__)
+    suite.add_argument('--pages', type=int, default=300)
+    suite.add_argument('--fanout', type=int, default=5)
+    suite.add_argument('--depth', type=int, default=10, help='divs around the text')
+    suite.add_argument('--page-bytes', type=int, default=8000)
+    suite.add_argument('--latency', type=float, default=0.0,
+                       help='seconds the server waits before each response')
+    suite.add_argument('--server', choices=('thread', 'async'), default='thread')
+    suite.add_argument('--concurrency', type=int, default=16)
+    suite.add_argument('--repeat', type=int, default=5, help='runs of each query')
+    suite.add_argument('--json', help='write the results to this file')
+    suite.set_defaults(func=bench_suite)
+
+    compare = commands.add_parser('compare', help=bench_compare.__doc__)
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='largest acceptable change for the worse, e.g. 0.1')
+    compare.set_defaults(func=bench_compare)
+
+    dedup = commands.add_parser('dedup', help=bench_dedup.__doc__)
+    dedup.add_argument('--articles', type=int, default=200)
+    dedup.add_argument('--words', type=int, default=400, help='words per article')
+    dedup.add_argument('--latency', type=float, default=0.0)
+    dedup.set_defaults(func=bench_dedup)
+
+    links = commands.add_parser('links', help=bench_links.__doc__)
+    links.add_argument('--pages', type=int, default=1000000)
+    links.add_argument('--links', type=int, default=10, help='links per page')
+    links.add_argument('--python', action='store_true',
+                       help='also time PageRank without NumPy')
+    links.set_defaults(func=bench_links)
+
+    shards = commands.add_parser('shards', help=bench_shards.__doc__)
+    shards.add_argument('--pages', type=int, default=100000)
+    shards.add_argument('--shards', type=lambda value: [int(n) for n in value.split(',')],
+                        default=sorted({1, 2, default_workers()}),
+                        help='comma-separated shard counts to try')
+    shards.set_defaults(func=bench_shards)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import os
+import zlib
+
+from frontier import Frontier, normalize_url
+
+
+def save_checkpoint(path, frontier, visited, in_flight=()):
+    """
+    Persist crawl progress so an interrupted crawl can resume.
+
+    The state is written as zlib-compressed lines, one per URL: visited
+    pages, queued pages with their depth, and pages that were seen but
+    neither queued nor indexed (non-HTML pages and errors). URLs that
+    were taken off the frontier but are not committed to the index yet
+    are passed as `in_flight` (url, depth) pairs and saved as queued.
+    The file is replaced atomically, so a crash while saving leaves the
+    previous checkpoint intact.
+    """
+    in_flight = dict(in_flight)
+    queued = dict(frontier)
+    queued.update(in_flight)
+    # Queued URLs are kept as spelled; seen and visited ones normalized
+    queued_keys = {normalize_url(url) for url in queued}
+    visited = set(visited) - queued_keys
+
+    lines = [f"V\t{url}" for url in visited]
+    lines.extend(f"Q\t{depth}\t{url}" for url, depth in queued.items())
+    lines.extend(f"S\t{url}" for url in frontier.seen
+                 if url not in visited and url not in queued_keys)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(zlib.compress('\n'.join(lines).encode('utf-8')))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, by_depth=False):
+    """Read a checkpoint back; return (frontier, visited_urls)"""
+    with open(path, 'rb') as f:
+        lines = zlib.decompress(f.read()).decode('utf-8').split('\n')
+
+    frontier = Frontier(by_depth=by_depth)
+    visited = set()
+    for line in lines:
+        kind, _, rest = line.partition('\t')
+        if kind == 'Q':
+            depth, _, url = rest.partition('\t')
+            frontier.add(url, int(depth))
+        elif kind == 'V':
+            visited.add(rest)
+            frontier.seen.add(rest)
+        elif kind == 'S':
+            frontier.seen.add(rest)
+    return frontier, visited
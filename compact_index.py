@@ -0,0 +1,410 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+EMPTY = array('I')
+
+# On-disk format written by CompactIndex.save, see save_sections(): the
+# header's own fields are the frequency typecode and the total document
+# length.
+INDEX_MAGIC = b'CIDX'
+FORMAT_VERSION = 1
+SECTIONS = ('doc_lengths', 'url_offsets', 'urls', 'term_offsets', 'terms',
+            'offsets', 'doc_ids', 'freqs', 'metadata')
+_INDEX_FIELDS = 'c6xQ'
+_BYTE_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+# Narrowest array typecode able to hold each range of term frequencies
+FREQ_TYPECODES = ((0xFF, 'B'), (0xFFFF, 'H'), (0xFFFFFFFF, 'I'))
+
+
+def _freq_typecode(max_freq):
+    for limit, typecode in FREQ_TYPECODES:
+        if max_freq <= limit:
+            return typecode
+    raise OverflowError(f"Term frequency too large: {max_freq}")
+
+
+# Gallop into a postings list only when it is this many times longer than
+# the candidates; below that a C-level set intersection wins
+GALLOP_RATIO = 32
+
+
+def gallop(seq, target, lo=0):
+    """
+    Return the first position at or after `lo` whose value is >= target.
+
+    Probes lo, lo + 1, lo + 3, lo + 7, ... until it overshoots and then
+    bisects the last gap, so the cost grows with the log of the distance
+    skipped rather than with the length of `seq`.
+    """
+    n = len(seq)
+    hi = lo
+    step = 1
+    while hi < n and seq[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(seq, target, lo, min(hi, n))
+
+
+def intersect(postings_lists):
+    """
+    Intersect sorted doc ID sequences, shortest first.
+
+    When the next list is much longer than the running result, each
+    candidate is looked up in it by galloping forward from the previous
+    match, so only a few of the long list's entries are touched. Lists
+    of similar length are intersected as sets instead, which is faster
+    in Python when most entries have to be visited anyway. Stops as
+    soon as the result is empty.
+    """
+    if not postings_lists:
+        return EMPTY
+    postings_lists = sorted(postings_lists, key=len)
+    result = postings_lists[0]
+    for other in postings_lists[1:]:
+        if not len(result):
+            break
+        if len(other) < GALLOP_RATIO * len(result):
+            result = array('I', sorted(set(result).intersection(other)))
+            continue
+        matches = array('I')
+        pos, n = 0, len(other)
+        for doc_id in result:
+            pos = gallop(other, doc_id, pos)
+            if pos == n:
+                break
+            if other[pos] == doc_id:
+                matches.append(doc_id)
+                pos += 1
+        result = matches
+    return result
+
+
+def _header(names, fields):
+    return struct.Struct('=4sIc' + fields + 'QQ' * len(names))
+
+
+def save_sections(path, magic, version, names, sections, fields='7x', values=()):
+    """
+    Write named byte sections to a file that load_sections() can map.
+
+    The file is a header, then the sections in the order of `names`,
+    each starting at a multiple of 8 bytes so that it can be cast to
+    an array in place. The header holds the magic, format version and
+    byte order, the format's own `fields` (struct codes, padded to 8
+    bytes) with their `values`, and the (offset, length) of every
+    section. The file is replaced atomically, so processes that mapped
+    the old one keep using it undisturbed.
+    """
+    header = _header(names, fields)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(bytes(header.size))
+        table = []
+        for name in names:
+            f.write(bytes(-f.tell() % 8))
+            table.extend((f.tell(), len(sections[name])))
+            f.write(sections[name])
+        f.seek(0)
+        f.write(header.pack(magic, version, _BYTE_ORDER, *values, *table))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_sections(path, magic, version, names, fields='7x'):
+    """
+    Map a file written by save_sections(). Returns the mapping, which
+    must stay open while the sections are used, the header's `fields`
+    values and a dict of the sections as memoryviews. Nothing but the
+    header is read.
+    """
+    header = _header(names, fields)
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, file_version, byte_order, *values = header.unpack_from(mapped)
+    if file_magic != magic:
+        raise ValueError(f"{path} is not a {magic.decode('ascii')} file")
+    if file_version != version or byte_order != _BYTE_ORDER:
+        raise ValueError(f"{path} has an unsupported format or byte order")
+    table = values[len(values) - 2 * len(names):]
+    view = memoryview(mapped)
+    sections = {name: view[table[2 * i]:table[2 * i] + table[2 * i + 1]]
+                for i, name in enumerate(names)}
+    return mapped, values[:len(values) - len(table)], sections
+
+
+class StringTable:
+    """
+    Read-only sequence of strings packed into one UTF-8 buffer.
+
+    String i is the bytes between offsets[i] and offsets[i + 1]; it is
+    decoded when it is looked up, so a table mapped from a file costs
+    nothing until it is used. Sorted tables can be searched with bisect.
+    """
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string table index out of range")
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @staticmethod
+    def pack(strings):
+        """Return (offsets, data) bytes for a sequence of strings"""
+        offsets = array('Q', [0])
+        data = bytearray()
+        for string in strings:
+            data += string.encode('utf-8')
+            offsets.append(len(data))
+        return offsets.tobytes(), bytes(data)
+
+
+class CompactIndex:
+    """
+    Inverted index with integer document IDs and array-backed postings.
+
+    Each URL is stored once and referred to by its position in `urls`.
+    Postings are parallel arrays of document IDs and term frequencies,
+    with document IDs in ascending order: documents get increasing IDs
+    as they are added, so postings never need re-sorting.
+
+    The index has two tiers. Documents are first added to a growable
+    tier with a pair of arrays per term. `compact()` folds those into
+    the compacted tier: a sorted vocabulary whose postings all live in
+    two shared arrays, addressed by per-term offsets, with frequencies
+    in the narrowest integer type that fits. That costs a little over
+    four bytes per posting with no per-term container overhead.
+
+    `save()` writes an index to a file in the same layout, and `load()`
+    maps such a file into memory instead of reading it: the compacted
+    tier is used in place, and terms, URLs and postings are only decoded
+    when a query touches them. Processes loading the same file share
+    its pages through the OS page cache.
+    """
+
+    def __init__(self):
+        # Doc ID -> URL, and back (built on first use for loaded indexes)
+        self.urls = []
+        self._doc_ids = {}
+        # Doc ID -> number of indexed words, for length normalization
+        self.doc_lengths = array('I')
+        self.total_length = 0
+
+        # Compacted tier: term i's postings are at [offsets[i], offsets[i + 1])
+        self._terms = []
+        self._offsets = array('Q', [0])
+        self._doc_array = array('I')
+        self._freq_array = array('B')
+
+        # Growable tier: term -> (doc IDs, frequencies) since the last compact
+        self._pending = {}
+
+        # Extra data saved with the index, and the file a loaded index maps
+        self._metadata = {}
+        self._mmap = None
+
+    @property
+    def doc_ids(self):
+        if self._doc_ids is None:
+            self._doc_ids = {url: doc_id for doc_id, url in enumerate(self.urls)}
+        return self._doc_ids
+
+    @property
+    def metadata(self):
+        """JSON-compatible dict saved along with the index"""
+        if isinstance(self._metadata, memoryview):
+            self._metadata = json.loads(str(self._metadata, 'utf-8'))
+        return self._metadata
+
+    def add_document(self, url, word_counts):
+        """Index a page given its word -> frequency counts; return its doc ID"""
+        if isinstance(self.urls, StringTable):
+            # Loaded from a file: copy the document table into memory
+            self.urls = list(self.urls)
+            self.doc_lengths = array('I', self.doc_lengths)
+        if url in self.doc_ids:
+            raise ValueError(f"Document already indexed: {url}")
+        doc_id = len(self.urls)
+        self.urls.append(url)
+        self.doc_ids[url] = doc_id
+        length = sum(word_counts.values())
+        self.doc_lengths.append(length)
+        self.total_length += length
+
+        for word, count in word_counts.items():
+            postings = self._pending.get(word)
+            if postings is None:
+                postings = self._pending[word] = (array('I'), array('I'))
+            postings[0].append(doc_id)
+            postings[1].append(count)
+        return doc_id
+
+    def _compacted_postings(self, term):
+        i = bisect_left(self._terms, term)
+        if i == len(self._terms) or self._terms[i] != term:
+            return None
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return (memoryview(self._doc_array)[start:end],
+                memoryview(self._freq_array)[start:end])
+
+    def postings(self, term):
+        """
+        Return (doc IDs, frequencies) for a term as sorted sequences;
+        empty if the term is unknown. Never modifies the index.
+        """
+        compacted = self._compacted_postings(term)
+        pending = self._pending.get(term)
+        if pending is None:
+            return compacted or (EMPTY, EMPTY)
+        if compacted is None:
+            return pending
+        # Compacted doc IDs are all lower than pending ones
+        return (array('I', compacted[0]) + pending[0],
+                array('I', compacted[1]) + pending[1])
+
+    def match_all(self, terms):
+        """
+        Return the sorted doc IDs of documents containing every term.
+
+        Terms are intersected rarest first, and a term that is not in the
+        index ends the evaluation without looking at the others.
+        """
+        postings_lists = []
+        for term in set(terms):
+            doc_ids, _ = self.postings(term)
+            if not len(doc_ids):
+                return EMPTY
+            postings_lists.append(doc_ids)
+        return intersect(postings_lists)
+
+    def compact(self):
+        """Fold documents added since the last call into the compacted tier"""
+        if not self._pending:
+            return
+        terms = sorted(set(self._terms).union(self._pending))
+        max_freq = max(max(freqs) for _, freqs in self._pending.values())
+        if self._freq_array:
+            max_freq = max(max_freq, max(self._freq_array))
+
+        offsets = array('Q', [0])
+        doc_array = array('I')
+        freq_array = array(_freq_typecode(max_freq))
+        for term in terms:
+            doc_ids, freqs = self.postings(term)
+            doc_array.extend(doc_ids)
+            # array.extend only takes arrays of its own typecode
+            freq_array.extend(freqs.tolist())
+            offsets.append(len(doc_array))
+
+        self._terms = terms
+        self._offsets = offsets
+        self._doc_array = doc_array
+        self._freq_array = freq_array
+        self._pending = {}
+
+    def doc_frequency(self, term):
+        """Number of documents containing a term"""
+        return len(self.postings(term)[0])
+
+    def frequency(self, term, url):
+        """How often a term occurs in a page, 0 if it does not"""
+        doc_id = self.doc_ids.get(url)
+        if doc_id is None:
+            return 0
+        doc_ids, freqs = self.postings(term)
+        # Postings are sorted, so the doc ID can be found by bisection
+        i = bisect_left(doc_ids, doc_id)
+        if i < len(doc_ids) and doc_ids[i] == doc_id:
+            return freqs[i]
+        return 0
+
+    def terms(self):
+        """The vocabulary in sorted order"""
+        if not self._pending:
+            return self._terms
+        return sorted(set(self._terms).union(self._pending))
+
+    def __contains__(self, term):
+        return term in self._pending or self._compacted_postings(term) is not None
+
+    def __len__(self):
+        return len(self.terms())
+
+    def posting_count(self):
+        """Total number of (term, document) pairs in the index"""
+        return len(self._doc_array) + sum(
+            len(doc_ids) for doc_ids, _ in self._pending.values())
+
+    def save(self, path, metadata=None):
+        """
+        Write the index to a file that `load()` can map.
+
+        Pending documents are compacted first. `metadata` is a JSON-
+        compatible dict stored alongside, e.g. page titles. The file is
+        replaced atomically, so processes that loaded the old one keep
+        using it undisturbed.
+        """
+        self.compact()
+        if metadata is not None:
+            self._metadata = metadata
+        url_offsets, urls = StringTable.pack(self.urls)
+        term_offsets, terms = StringTable.pack(self._terms)
+        sections = {
+            'doc_lengths': bytes(self.doc_lengths),
+            'url_offsets': url_offsets,
+            'urls': urls,
+            'term_offsets': term_offsets,
+            'terms': terms,
+            'offsets': bytes(self._offsets),
+            'doc_ids': bytes(self._doc_array),
+            'freqs': bytes(self._freq_array),
+            'metadata': json.dumps(self.metadata).encode('utf-8'),
+        }
+
+        typecode = self._freq_array.format if isinstance(
+            self._freq_array, memoryview) else self._freq_array.typecode
+        save_sections(path, INDEX_MAGIC, FORMAT_VERSION, SECTIONS, sections,
+                      _INDEX_FIELDS, (typecode.encode('ascii'), self.total_length))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map an index written by `save()`.
+
+        Takes about as long for a large index as for a small one: nothing
+        but the header is read until the index is queried. The mapping
+        is read-only; adding documents copies the index into memory.
+        """
+        mapped, (typecode, total_length), sections = load_sections(
+            path, INDEX_MAGIC, FORMAT_VERSION, SECTIONS, _INDEX_FIELDS)
+        index = cls()
+        index._mmap = mapped
+        index.urls = StringTable(sections['url_offsets'].cast('Q'), sections['urls'])
+        index._doc_ids = None
+        index.doc_lengths = sections['doc_lengths'].cast('I')
+        index.total_length = total_length
+        index._terms = StringTable(sections['term_offsets'].cast('Q'), sections['terms'])
+        index._offsets = sections['offsets'].cast('Q')
+        index._doc_array = sections['doc_ids'].cast('I')
+        index._freq_array = sections['freqs'].cast(typecode.decode('ascii'))
+        index._metadata = sections['metadata']
+        return index
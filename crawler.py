@@ -1,55 +1,100 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from collections import defaultdict
+from urllib.parse import urlparse
+import logging
+import os
 import re
+import sys
+
+from compact_index import CompactIndex
+from ranking import BM25
+from fetcher import SkippedPage, make_session, polite_get, has_binary_extension, is_html_type
+from frontier import Frontier, normalize_url
+from metrics import ERRORS, INDEX_WRITE_SECONDS, PARSE_SECONDS, SEARCH_SECONDS
+from politeness import DEFAULT_RATE, HostScheduler, RobotsCache
+from parsing import HAVE_LXML, REGIONS, available_backends, extract_fields
+
+# How much a word counts towards a page's term frequency, by page region.
+# Titles are kept out of the index by default; they are shown, not searched.
+DEFAULT_REGION_WEIGHTS = {'title': 0, 'headings': 1, 'main': 1, 'body': 1}
+
+# Where main() keeps the index between runs
+INDEX_FILE = 'crawler_index.bin'
+
+log = logging.getLogger(__name__)
 
 class WebCrawler:
-    def __init__(self, start_url):
+    def __init__(self, start_url, by_depth=False, parser=None, region_weights=None,
+                 rate=DEFAULT_RATE, obey_robots=True):
         # Initialize the crawler with a start URL
         self.start_url = start_url
         self.base_domain = urlparse(start_url).netloc
         self.visited_urls = set()
-        # Word -> {url: frequency}
-        self.index = defaultdict(lambda: defaultdict(int))
+        # URLs still to crawl, deduplicated when they are queued
+        self.frontier = Frontier(by_depth=by_depth)
+        # Word -> postings of (doc ID, frequency), doc IDs map to URLs
+        self.index = CompactIndex()
+        # BM25 scorer, recreated when the index grows
+        self._scorer = None
         # Store page titles for better search results
         self.page_titles = {}
+        # HTML parser backend, see parsing.available_backends(); lxml is
+        # much faster than html.parser when installed
+        self.parser = parser or ('lxml' if HAVE_LXML else 'html.parser')
+        if self.parser not in available_backends():
+            raise ValueError(f"Parser backend not available: {self.parser}")
+        # Integer weight per page region, e.g. {'title': 3, 'headings': 2}
+        self.region_weights = dict(DEFAULT_REGION_WEIGHTS, **(region_weights or {}))
+        # Paces requests per host (`rate` per second) and applies robots.txt
+        self.scheduler = HostScheduler(
+            rate, robots=RobotsCache() if obey_robots else None)
     
     def is_valid_url(self, url):
-        """Check if URL belongs to the same domain and hasn't been visited"""
+        """
+        Check if URL belongs to the same domain, hasn't been visited and
+        isn't a file type that can't be HTML
+        """
         parsed = urlparse(url)
         return (parsed.netloc == self.base_domain and 
-                url not in self.visited_urls)
+                url not in self.visited_urls and
+                not has_binary_extension(url))
     
-    def extract_text_and_links(self, html_content, current_url):
-        """Extract text content and links from HTML"""
-        soup = BeautifulSoup(html_content, 'html.parser')
+    def extract_fields(self, html_content, current_url, base_url=None):
+        """
+        Extract per-region text and links from HTML in a single pass.
+        Links are resolved against `base_url`, the URL the page was
+        fetched from, if given. Returns ({region: text}, links), see
+        parsing.extract_fields.
+        """
+        with PARSE_SECONDS.time():
+            fields, links = extract_fields(html_content, base_url or current_url,
+                                           self.parser)
         
         # Store the page title
-        title = soup.find('title')
-        if title:
-            self.page_titles[current_url] = title.get_text().strip()
-        
-        # Extract text content (excluding script and style elements)
-        for script in soup(['script', 'style']):
-            script.decompose()
-            
-        # Get text from specific content areas with higher weight
-        main_content = ""
-        for tag in ['main', 'article', 'div', 'p']:
-            for element in soup.find_all(tag):
-                main_content += " " + element.get_text()
-        
-        # Extract all links and convert to absolute URLs
-        links = []
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href:
-                absolute_url = urljoin(current_url, href)
-                links.append(absolute_url)
+        if fields['title']:
+            self.page_titles[current_url] = fields['title']
         
+        return fields, links
+
+    def extract_text_and_links(self, html_content, current_url):
+        """Extract text content and links from HTML"""
+        fields, links = self.extract_fields(html_content, current_url)
+        main_content = " ".join(
+            fields[region] for region in REGIONS if self.region_weights[region])
         return main_content, links
     
+    def count_words(self, fields):
+        """
+        Count word frequencies for a page, each region scaled by its weight.
+        Regions are counted separately instead of repeating their text.
+        """
+        word_counts = {}
+        for region, text in fields.items():
+            weight = self.region_weights[region]
+            if not weight:
+                continue
+            for word in self.process_text(text):
+                word_counts[word] = word_counts.get(word, 0) + weight
+        return word_counts
+
     def process_text(self, text):
         """Process text content into words"""
         # Convert to lowercase and split into words
@@ -58,56 +103,90 @@ class WebCrawler:
     
     def crawl(self):
         """Start crawling from the initial URL"""
-        urls_to_visit = [self.start_url]
+        self.frontier.add(self.start_url)
+        session = make_session()
         
-        while urls_to_visit:
-            current_url = urls_to_visit.pop(0)
-            
-            if not self.is_valid_url(current_url):
-                continue
+        while self.frontier:
+            fetch_url, depth = self.frontier.pop()
+            current_url = normalize_url(fetch_url)
                 
             try:
                 # Fetch and process the page
-                response = requests.get(current_url)
+                response = polite_get(session, self.scheduler, fetch_url)
                 
                 # Only process HTML responses
-                if 'text/html' not in response.headers.get('content-type', ''):
+                if not response.ok or not is_html_type(response.headers.get('content-type', '')):
                     continue
                     
                 self.visited_urls.add(current_url)
                 
                 # Extract text and links
-                text_content, links = self.extract_text_and_links(
-                    response.text, current_url)
+                fields, links = self.extract_fields(response.text, current_url,
+                                                    response.url)
                 
-                # Process text and update index with word frequencies
-                words = self.process_text(text_content)
                 # Count word frequencies for this page
-                word_counts = {}
-                for word in words:
-                    word_counts[word] = word_counts.get(word, 0) + 1
+                word_counts = self.count_words(fields)
                 
                 # Update the index with word frequencies
-                for word, count in word_counts.items():
-                    self.index[word][current_url] = count
+                with INDEX_WRITE_SECONDS.time():
+                    self.index.add_document(current_url, word_counts)
                 
                 # Add new links to visit
-                urls_to_visit.extend(
-                    [url for url in links if url not in self.visited_urls])
+                self.frontier.extend(
+                    [url for url in links if self.is_valid_url(url)], depth + 1)
                     
+            except SkippedPage as e:
+                log.debug("Skipping %s", e)
             except Exception as e:
-                print(f"Error processing {current_url}: {e}")
+                ERRORS.inc()
+                log.warning("Error processing %s: %s", current_url, e)
+
+        session.close()
+        # Pack the postings gathered during the crawl
+        self.index.compact()
     
-    def search(self, words):
+    def save_index(self, path=INDEX_FILE):
+        """Write the index and page titles to a file, see CompactIndex.save"""
+        self.index.save(path, {'titles': self.page_titles})
+
+    def load_index(self, path=INDEX_FILE):
+        """
+        Search an index saved earlier instead of crawling. The file is
+        memory mapped, so this is quick however large the index is.
+        """
+        self.index = CompactIndex.load(path)
+        self.page_titles = self.index.metadata.get('titles', {})
+        self._scorer = None
+
+    def scorer(self):
+        """Return a BM25 scorer for the index as it is now"""
+        if self._scorer is None or self._scorer.doc_count != len(self.index.urls):
+            self._scorer = BM25(self.index)
+        return self._scorer
+
+    def rank(self, words, k=10, match_all=True):
+        """
+        Return the k best pages for the words as (url, score) pairs,
+        best first, scored with BM25. With match_all=False a page only
+        needs to contain one of the words.
+        """
+        words = [word.lower() for word in words]
+        with SEARCH_SECONDS.time():
+            return [(self.index.urls[doc_id], score)
+                    for doc_id, score in self.scorer().top_k(words, k, match_all)]
+
+    def search(self, words, limit=None):
         """
         Search for pages containing all words in the list.
         Returns a list of URLs that contain all the search words.
         
         Args:
             words (list): List of words to search for
+            limit (int): Return at most this many URLs
             
         Returns:
-            list: List of URLs containing all search words
+            list: List of URLs containing all search words, best match
+            first by BM25 score
         """
         if not words:
             return []
@@ -115,31 +194,26 @@ class WebCrawler:
         # Convert search words to lowercase
         words = [word.lower() for word in words]
         
-        # Get URLs containing each word
-        url_sets = []
-        for word in words:
-            urls = set(self.index[word].keys())
-            url_sets.append(urls)
-            
-        # Find intersection of all URL sets
-        if url_sets:
-            result_urls = url_sets[0]
-            for urls in url_sets[1:]:
-                result_urls &= urls
-            return sorted(list(result_urls))
-        
-        return []
+        if limit is None:
+            limit = len(self.index.urls)
+        return [url for url, _ in self.rank(words, limit)]
 
 def main():
     """Interactive testing of the WebCrawler"""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
     # Create crawler instance
     start_url = "https://vm009.rz.uos.de/crawl/index.html"
     crawler = WebCrawler(start_url)
     
-    # Crawl the website
-    print("Starting crawl...")
-    crawler.crawl()
-    print(f"Crawl complete. Visited {len(crawler.visited_urls)} pages")
+    # Reuse the index from an earlier run unless asked to crawl again
+    if os.path.exists(INDEX_FILE) and '--recrawl' not in sys.argv[1:]:
+        crawler.load_index()
+        print(f"Loaded {len(crawler.index.urls)} pages from {INDEX_FILE}")
+    else:
+        print("Starting crawl...")
+        crawler.crawl()
+        print(f"Crawl complete. Visited {len(crawler.visited_urls)} pages")
+        crawler.save_index()
     
     # Interactive search
     print("\nEnter words to search (separated by spaces), or 'quit' to exit")
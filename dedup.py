@@ -0,0 +1,129 @@
+import hashlib
+import re
+from array import array
+
+# Number of minimum hashes per signature, and the words in each shingle
+MINHASH_SIZE = 64
+SHINGLE_WORDS = 3
+# LSH bands a signature is split into; pages sharing any one band are
+# compared, so pages with a Jaccard similarity s are compared with
+# probability 1 - (1 - s ** (MINHASH_SIZE / LSH_BANDS)) ** LSH_BANDS
+LSH_BANDS = 16
+# Pages whose shingle sets are at least this similar are duplicates
+DUPLICATE_SIMILARITY = 0.8
+# Texts with fewer shingles get no signature: a few words say too little
+# about a page to call it a copy of another
+MIN_SHINGLES = 8
+
+_WORD = re.compile(r'\w+')
+_HASH_BITS = 64
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    """The set of overlapping runs of `size` words in a text, lowercased"""
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def minhash(text, size=MINHASH_SIZE, min_shingles=MIN_SHINGLES):
+    """
+    MinHash signature of a text's word shingles, as bytes, or None if it
+    has fewer than `min_shingles` of them.
+
+    Uses one permutation hashing: each shingle is hashed once, the top
+    bits of the hash pick one of `size` bins and every bin keeps its
+    smallest value, so the cost is one hash per shingle rather than
+    `size`. Empty bins borrow from the next bin that isn't. Two
+    signatures agree in a fraction of their positions that estimates
+    the Jaccard similarity of the two shingle sets. The hash is stable
+    across processes, so signatures can be stored in the index.
+    """
+    shift = _HASH_BITS - (size.bit_length() - 1)
+    low = (1 << shift) - 1
+    empty = 1 << shift
+    bins = [empty] * size
+    text_shingles = shingles(text)
+    if not text_shingles or len(text_shingles) < min_shingles:
+        return None
+    for shingle in text_shingles:
+        h = int.from_bytes(
+            hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        i = h >> shift
+        if h & low < bins[i]:
+            bins[i] = h & low
+    values = array('I')
+    for i in range(size):
+        # An empty bin takes the next filled bin's value, offset by the
+        # distance so that different donors never look alike
+        step = 0
+        while bins[(i + step) % size] == empty:
+            step += 1
+        # 32 bits of each minimum are plenty to tell minima apart
+        values.append((bins[(i + step) % size] + step * 0x9e3779b1) & 0xffffffff)
+    return values.tobytes()
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of the texts two signatures came from"""
+    a, b = array('I', a), array('I', b)
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class DuplicateIndex:
+    """
+    Finds near-duplicate pages by their MinHash in sublinear time.
+
+    Signatures are split into `bands` bands, and every page is bucketed
+    by each of its bands. Only pages that share a bucket with a new page
+    are compared with it, so similar pages are found without looking at
+    the whole collection; the comparison then checks the estimated
+    similarity against `threshold`.
+    """
+
+    def __init__(self, threshold=DUPLICATE_SIMILARITY, bands=LSH_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        # URL -> signature, and one {band bytes: set of URLs} per band
+        self.signatures = {}
+        self._buckets = [{} for _ in range(bands)]
+
+    def _keys(self, signature):
+        width = len(signature) // self.bands
+        return [signature[i * width:(i + 1) * width] for i in range(self.bands)]
+
+    def add(self, url, signature):
+        """Remember a page's signature, replacing any earlier one"""
+        self.remove(url)
+        self.signatures[url] = signature
+        for buckets, key in zip(self._buckets, self._keys(signature)):
+            buckets.setdefault(key, set()).add(url)
+
+    def remove(self, url):
+        signature = self.signatures.pop(url, None)
+        if signature is None:
+            return
+        for buckets, key in zip(self._buckets, self._keys(signature)):
+            bucket = buckets[key]
+            bucket.discard(url)
+            if not bucket:
+                del buckets[key]
+
+    def find(self, signature, exclude=None):
+        """Return the URL of a page the signature duplicates, or None"""
+        compared = {exclude}
+        for buckets, key in zip(self._buckets, self._keys(signature)):
+            for url in buckets.get(key, ()):
+                if url in compared:
+                    continue
+                compared.add(url)
+                if similarity(self.signatures[url], signature) >= self.threshold:
+                    return url
+        return None
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, url):
+        return url in self.signatures
@@ -0,0 +1,281 @@
+import asyncio
+import codecs
+import posixpath
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import brotli  # noqa: F401  (lets urllib3 decode br responses)
+    HAVE_BROTLI = True
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        HAVE_BROTLI = True
+    except ImportError:
+        HAVE_BROTLI = False
+
+from metrics import BYTES_DOWNLOADED, FETCH_SECONDS, PAGES_FETCHED, PAGES_SKIPPED
+from politeness import (USER_AGENT, BACKOFF_STATUSES, MAX_RETRIES,
+                        HostScheduler, RobotsCache, retry_after)
+
+# Seconds to wait for a connection or a read before giving up on a page
+DEFAULT_TIMEOUT = 10
+# Largest page body read, after decompression; larger pages are skipped
+MAX_BODY_BYTES = 5 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+ACCEPT_ENCODING = 'gzip, deflate, br' if HAVE_BROTLI else 'gzip, deflate'
+
+# Links to these are never queued: they can't be HTML pages
+BINARY_EXTENSIONS = frozenset("""
+    .7z .avi .bin .bmp .bz2 .css .csv .dmg .doc .docx .eot .epub .exe .flac
+    .gif .gz .ico .iso .jar .jpeg .jpg .js .m4a .m4v .mkv .mov .mp3 .mp4
+    .mpeg .mpg .msi .odp .ods .odt .ogg .otf .pdf .png .ppt .pptx .ps .rar
+    .rpm .svg .tar .tgz .tif .tiff .ttf .wav .webm .webp .wmv .woff .woff2
+    .xls .xlsx .xz .zip
+""".split())
+# Extensions that are HTML, or usually generate it; anything else is
+# checked with a HEAD request first when head_check is on
+HTML_EXTENSIONS = frozenset("""
+    .htm .html .xhtml .shtml .php .asp .aspx .jsp .cgi .pl
+""".split())
+
+_HEADER_CHARSET = re.compile(r'charset=["\']?([\w-]+)', re.IGNORECASE)
+_META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+def url_extension(url):
+    return posixpath.splitext(urlparse(url).path)[1].lower()
+
+
+def has_binary_extension(url):
+    """Whether a URL's path ends in an extension that can't be HTML"""
+    return url_extension(url) in BINARY_EXTENSIONS
+
+
+def is_html_type(content_type):
+    return any(kind in content_type.lower() for kind in HTML_TYPES)
+
+
+def make_session(pool_size=10):
+    """Create a requests session with a connection pool of the given size"""
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    session.headers['Accept'] = 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.1'
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class SkippedPage(Exception):
+    """A page that is deliberately not fetched or not read"""
+
+
+class Disallowed(SkippedPage):
+    """robots.txt does not allow fetching a URL"""
+
+
+class Page:
+    """
+    A fetched page: the parts of a response the crawlers use. `url` is
+    where the page was found, after redirects, and the base of its
+    relative links.
+
+    The body is only read for successful HTML responses; for anything
+    else `content` and `text` are empty.
+    """
+
+    def __init__(self, url, status_code, headers, content=b'', text=''):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.text = text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+
+def _charset(content_type, head):
+    """The page's declared charset, from its header or a <meta> tag in `head`"""
+    match = _HEADER_CHARSET.search(content_type)
+    if match is not None:
+        name = match.group(1)
+    else:
+        match = _META_CHARSET.search(head)
+        name = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return 'utf-8'
+
+
+def fetch_page(session, url, timeout=DEFAULT_TIMEOUT, max_bytes=MAX_BODY_BYTES,
+               head_check=False, headers=None):
+    """
+    GET a page, reading its body only if it is an HTML page small enough.
+
+    The status and Content-Type are checked before any of the body is
+    downloaded, and the body is streamed and decoded chunk by chunk,
+    decompressed by urllib3 (gzip, deflate, and brotli when available).
+    The charset comes from the headers or a <meta> tag, never from
+    guessing over the whole body.
+
+    With `head_check`, URLs whose extension doesn't say HTML are checked
+    with a HEAD request first. Raises SkippedPage for non-HTML pages and
+    for pages over `max_bytes`. Other responses are returned without a
+    body.
+    """
+    with FETCH_SECONDS.time():
+        try:
+            page = _fetch_page(session, url, timeout, max_bytes, head_check, headers)
+        except SkippedPage:
+            PAGES_SKIPPED.inc()
+            raise
+    PAGES_FETCHED.inc()
+    return page
+
+
+def _fetch_page(session, url, timeout, max_bytes, head_check, headers):
+    if head_check and url_extension(url) not in HTML_EXTENSIONS and url_extension(url):
+        head = session.head(url, timeout=timeout, headers=headers, allow_redirects=True)
+        if head.ok:
+            _check_headers(url, head.headers, max_bytes)
+
+    with session.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        try:
+            if not (200 <= response.status_code < 300):
+                return Page(response.url, response.status_code, response.headers)
+            _check_headers(url, response.headers, max_bytes)
+
+            chunks, texts = [], []
+            decoder = None
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise SkippedPage(f"{url}: larger than {max_bytes} bytes")
+                if decoder is None:
+                    encoding = _charset(response.headers.get('content-type', ''),
+                                        chunk[:2048])
+                    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                chunks.append(chunk)
+                texts.append(decoder.decode(chunk))
+            if decoder is not None:
+                texts.append(decoder.decode(b'', True))
+        finally:
+            # Bytes as they came over the wire, however the page ended up
+            BYTES_DOWNLOADED.inc(response.raw.tell())
+
+    content, text = b''.join(chunks), ''.join(texts)
+    return Page(response.url, response.status_code, response.headers, content, text)
+
+
+def _check_headers(url, headers, max_bytes):
+    content_type = headers.get('content-type', '')
+    if not is_html_type(content_type):
+        raise SkippedPage(f"{url}: not HTML ({content_type or 'no content type'})")
+    length = headers.get('content-length')
+    # Compressed bodies only grow when decoded, so this holds either way
+    if length and length.isdigit() and int(length) > max_bytes:
+        raise SkippedPage(f"{url}: larger than {max_bytes} bytes")
+
+
+def polite_get(session, scheduler, url, **kwargs):
+    """
+    Fetch a page from blocking code, pacing requests with a HostScheduler.
+
+    Waits for the host's next slot, and retries responses asking us to
+    slow down up to MAX_RETRIES times. Takes fetch_page's arguments and
+    returns a Page. Raises Disallowed if robots.txt forbids the URL, and
+    SkippedPage for pages that are not read.
+    """
+    if not scheduler.allowed(url):
+        PAGES_SKIPPED.inc()
+        raise Disallowed(f"{url}: disallowed by robots.txt")
+    for attempt in range(MAX_RETRIES + 1):
+        scheduler.wait(url)
+        start = time.monotonic()
+        page = fetch_page(session, url, **kwargs)
+        scheduler.record(url, page.status_code, time.monotonic() - start,
+                         retry_after(page))
+        if page.status_code not in BACKOFF_STATUSES:
+            break
+    return page
+
+
+class AsyncFetcher:
+    """
+    Fetch pages from asyncio code with bounded concurrency.
+
+    All requests go through one shared requests session, so connections
+    are pooled and reused across the whole crawl. The blocking calls run
+    on a thread pool that is exactly as large as the number of requests
+    allowed in flight, and each host gets its own, smaller limit.
+
+    Requests are paced per host by a HostScheduler. A request waiting for
+    its host's next slot holds no connection and no concurrency slot, so
+    other hosts keep the fetcher busy in the meantime.
+    """
+
+    def __init__(self, concurrency=16, per_host=4, timeout=DEFAULT_TIMEOUT,
+                 scheduler=None, max_bytes=MAX_BODY_BYTES, head_check=False):
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.head_check = head_check
+        self.session = make_session(concurrency)
+        self.scheduler = scheduler or HostScheduler(
+            robots=RobotsCache(self.session.get, timeout=timeout))
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._global_limit = asyncio.Semaphore(concurrency)
+        self._host_limits = {}
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    async def fetch(self, url):
+        """
+        Fetch a URL and return a Page, see fetch_page.
+
+        Responses asking us to slow down are retried after the host's
+        backoff. Raises Disallowed if robots.txt forbids the URL, and
+        SkippedPage for pages that are not read.
+        """
+        loop = asyncio.get_running_loop()
+        # The first request to a host fetches its robots.txt
+        if not await loop.run_in_executor(None, self.scheduler.allowed, url):
+            PAGES_SKIPPED.inc()
+            raise Disallowed(f"{url}: disallowed by robots.txt")
+        for attempt in range(MAX_RETRIES + 1):
+            await self.scheduler.wait_async(url)
+            async with self._host_limit(url), self._global_limit:
+                start = time.monotonic()
+                response = await loop.run_in_executor(
+                    self._executor,
+                    partial(fetch_page, self.session, url, timeout=self.timeout,
+                            max_bytes=self.max_bytes, head_check=self.head_check))
+            self.scheduler.record(url, response.status_code,
+                                  time.monotonic() - start, retry_after(response))
+            if response.status_code not in BACKOFF_STATUSES:
+                break
+        return response
+
+    def close(self):
+        """Release the thread pool and the pooled connections"""
+        self._executor.shutdown(wait=True)
+        self.session.close()
@@ -0,0 +1,161 @@
+import heapq
+from collections import OrderedDict, deque
+from itertools import count
+from urllib.parse import unquote_plus, urldefrag, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Query parameters that track visitors or sessions rather than select
+# content; URLs that differ only in these are the same page
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid',
+                   'sid', 'sessionid', 'session_id', 'phpsessid', 'jsessionid'}
+TRACKING_PREFIXES = ('utm_',)
+
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PREFIXES)
+
+
+def normalize_url(url):
+    """
+    Bring a URL into a canonical form so that equivalent spellings of
+    the same page are only crawled once.
+
+    Lowercases the scheme and host, drops the fragment and the default
+    port, strips trailing slashes and ;jsessionid= from paths, and
+    drops tracking and session parameters from the query and sorts the
+    rest. The result is only good as a key: without its trailing slash,
+    a directory URL is no base for resolving the page's relative links.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if ':' in host:
+        # An IPv6 address, which keeps its brackets
+        host = f"[{host}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    if parts.username:
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ':' + parts.password
+        host = f"{userinfo}@{host}"
+
+    path = parts.path.split(';jsessionid=')[0] or '/'
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+
+    # Parameters are kept as spelled, so that "?x" stays "?x"
+    query = '&'.join(sorted(
+        param for param in parts.query.split('&')
+        if param and not is_tracking_param(unquote_plus(param.partition('=')[0]))))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+class Frontier:
+    """
+    Queue of URLs still to be crawled.
+
+    URLs are deduplicated by their normalized form when they are added,
+    so every page is queued at most once no matter how many pages link
+    to it. They are handed out as they were added, minus any fragment,
+    so that they can be fetched and serve as the base of their page's
+    relative links.
+    By default the frontier is a plain FIFO; with `by_depth=True` the
+    shallowest URL is always handed out first, which keeps the crawl
+    breadth-first even when pages finish out of order.
+
+    Each host has its own queue and hosts take turns, so a run of links
+    to one host can't fill the crawl's concurrency while other hosts
+    wait. With one host this is exactly the order described above.
+    """
+
+    def __init__(self, by_depth=False):
+        self.by_depth = by_depth
+        # Host -> a heap of (depth, order, url) or a deque of (depth, url),
+        # in the order the hosts take turns
+        self._hosts = OrderedDict()
+        self._size = 0
+        self._order = count()
+        self.seen = set()
+        self.enqueued = 0
+        self.dequeued = 0
+        self.duplicates = 0
+
+    def add(self, url, depth=0):
+        """Queue a URL unless it was queued before; return True if added"""
+        key = normalize_url(url)
+        if key in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen.add(key)
+        url = urldefrag(url.strip())[0]
+        host = urlsplit(key).netloc
+        queue = self._hosts.get(host)
+        if queue is None:
+            queue = self._hosts[host] = [] if self.by_depth else deque()
+        if self.by_depth:
+            heapq.heappush(queue, (depth, next(self._order), url))
+        else:
+            queue.append((depth, url))
+        self._size += 1
+        self.enqueued += 1
+        return True
+
+    def mark_seen(self, url):
+        """Record a URL as crawled without queueing it"""
+        self.seen.add(normalize_url(url))
+
+    def extend(self, urls, depth=0):
+        """Queue several URLs found at the same depth"""
+        for url in urls:
+            self.add(url, depth)
+
+    def pop(self):
+        """Remove and return the next (url, depth) pair"""
+        if not self._size:
+            raise IndexError("pop from an empty frontier")
+        if self.by_depth:
+            # The shallowest host queue; min keeps the first of equals,
+            # which is the host whose turn it is
+            host = min(self._hosts, key=lambda host: self._hosts[host][0][0])
+            queue = self._hosts[host]
+            depth, _, url = heapq.heappop(queue)
+        else:
+            host, queue = next(iter(self._hosts.items()))
+            depth, url = queue.popleft()
+        if queue:
+            self._hosts.move_to_end(host)
+        else:
+            del self._hosts[host]
+        self._size -= 1
+        self.dequeued += 1
+        return url, depth
+
+    def hosts(self):
+        """Number of hosts with URLs queued"""
+        return len(self._hosts)
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Iterate over queued (url, depth) pairs without removing them"""
+        for queue in self._hosts.values():
+            for entry in queue:
+                yield entry[-1], entry[0]
+
+    def __contains__(self, url):
+        return normalize_url(url) in self.seen
+
+    def stats(self):
+        """Return frontier size and enqueue/dequeue counters"""
+        return {
+            'size': self._size,
+            'seen': len(self.seen),
+            'hosts': len(self._hosts),
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'duplicates': self.duplicates,
+        }
@@ -0,0 +1,328 @@
+import json
+import os
+import struct
+import zlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from compact_index import StringTable, gallop, load_sections, save_sections
+
+# Link graph saved in each index generation, next to the segments
+GRAPH_FILE = 'links.graph'
+
+# On-disk format written by LinkGraph.save, see compact_index.save_sections()
+GRAPH_MAGIC = b'LGRF'
+FORMAT_VERSION = 1
+SECTIONS = ('url_offsets', 'urls', 'offsets', 'targets', 'scores')
+
+# PageRank: probability of following a link rather than jumping to a
+# random page, and when to stop iterating (total change in rank)
+DAMPING = 0.85
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+# Edges handled at once by the NumPy power iteration, which bounds the
+# memory it needs on top of the graph itself
+EDGE_CHUNK = 1 << 22
+
+
+def pagerank(offsets, targets, damping=DAMPING, tolerance=TOLERANCE,
+             max_iterations=MAX_ITERATIONS):
+    """
+    PageRank of every node of a graph in CSR form, as an array('d')
+    summing to 1.
+
+    Node i links to targets[offsets[i]:offsets[i + 1]]. The rank of
+    nodes without links is spread over all nodes. Uses NumPy if it is
+    installed, and plain Python otherwise.
+    """
+    n = len(offsets) - 1
+    if n <= 0:
+        return array('d')
+    if np is not None:
+        return _pagerank_numpy(offsets, targets, n, damping, tolerance, max_iterations)
+    return _pagerank_python(offsets, targets, n, damping, tolerance, max_iterations)
+
+
+def _pagerank_python(offsets, targets, n, damping, tolerance, max_iterations):
+    rank = [1.0 / n] * n
+    for _ in range(max_iterations):
+        incoming = [0.0] * n
+        dangling = 0.0
+        for node in range(n):
+            start, end = offsets[node], offsets[node + 1]
+            if start == end:
+                dangling += rank[node]
+                continue
+            share = rank[node] / (end - start)
+            for target in targets[start:end]:
+                incoming[target] += share
+        base = (1.0 - damping + damping * dangling) / n
+        new_rank = [base + damping * value for value in incoming]
+        change = sum(abs(new - old) for new, old in zip(new_rank, rank))
+        rank = new_rank
+        if change < tolerance:
+            break
+    return array('d', rank)
+
+
+def _pagerank_numpy(offsets, targets, n, damping, tolerance, max_iterations):
+    offsets = np.frombuffer(offsets, dtype=np.uint64)
+    targets = np.frombuffer(targets, dtype=np.uint32)
+    degrees = np.diff(offsets).astype(np.int64)
+    # The source of every edge, to gather each edge's share of rank
+    sources = np.repeat(np.arange(n, dtype=np.uint32), degrees)
+    dangling = degrees == 0
+    inverse_degrees = np.zeros(n)
+    np.divide(1.0, degrees, out=inverse_degrees, where=~dangling)
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iterations):
+        shares = rank * inverse_degrees
+        incoming = np.zeros(n)
+        for start in range(0, len(targets), EDGE_CHUNK):
+            end = start + EDGE_CHUNK
+            incoming += np.bincount(targets[start:end], weights=shares[sources[start:end]],
+                                    minlength=n)
+        base = (1.0 - damping + damping * rank[dangling].sum()) / n
+        new_rank = base + damping * incoming
+        change = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if change < tolerance:
+            break
+    return array('d', rank.tobytes())
+
+
+class LinkGraph:
+    """
+    The links between a site's pages, in compressed sparse row form.
+
+    Pages are numbered in URL order. Page i links to the pages in
+    targets[offsets[i]:offsets[i + 1]], so the whole graph is two
+    integer arrays and a packed URL table: 4 bytes per link and a few
+    more per page. `scores` holds each page's PageRank times the number
+    of pages, so that an average page scores 1, once `rank()` has run.
+    """
+
+    def __init__(self, urls, offsets, targets, scores=None):
+        self.urls = urls
+        self.offsets = offsets
+        self.targets = targets
+        self.scores = scores
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.urls)
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def links(self, page):
+        """Numbers of the pages page number `page` links to"""
+        return self.targets[self.offsets[page]:self.offsets[page + 1]]
+
+    def find(self, url, lo=0):
+        """Number of the page with this URL, or None; URLs before `lo` are skipped"""
+        i = gallop(self.urls, url, lo)
+        return i if i < len(self.urls) and self.urls[i] == url else None
+
+    def rank(self, **options):
+        """Compute the PageRank scores; see pagerank() for the options"""
+        ranks = pagerank(self.offsets, self.targets, **options)
+        self.scores = array('f', (rank * len(ranks) for rank in ranks))
+        return self.scores
+
+    def score(self, url, default=1.0):
+        """A page's score, or `default` for pages not in the graph"""
+        i = self.find(url)
+        return default if i is None or self.scores is None else self.scores[i]
+
+    def scores_of(self, urls, default=1.0):
+        """
+        Yield the scores of several URLs, given in sorted order. Each
+        lookup starts where the last one ended, so this is much faster
+        than score() on each.
+        """
+        position = 0
+        for url in urls:
+            position = gallop(self.urls, url, position)
+            if (self.scores is not None and position < len(self.urls)
+                    and self.urls[position] == url):
+                yield self.scores[position]
+            else:
+                yield default
+
+    def save(self, path):
+        """Write the graph to a file that `load()` can map, atomically"""
+        url_offsets, urls = StringTable.pack(self.urls)
+        sections = {
+            'url_offsets': url_offsets,
+            'urls': urls,
+            'offsets': bytes(self.offsets),
+            'targets': bytes(self.targets),
+            'scores': bytes(self.scores) if self.scores is not None else b'',
+        }
+        save_sections(path, GRAPH_MAGIC, FORMAT_VERSION, SECTIONS, sections)
+
+    @classmethod
+    def load(cls, path):
+        """Map a graph written by `save()`; nothing is read until it is used"""
+        mapped, _, sections = load_sections(path, GRAPH_MAGIC, FORMAT_VERSION, SECTIONS)
+        graph = cls(StringTable(sections['url_offsets'].cast('Q'), sections['urls']),
+                    sections['offsets'].cast('Q'), sections['targets'].cast('I'),
+                    sections['scores'].cast('f') if len(sections['scores']) else None)
+        graph._mmap = mapped
+        return graph
+
+
+class LinkGraphBuilder:
+    """
+    Collects the links of crawled pages, for building a LinkGraph.
+
+    Pages get integer IDs in the order they are first seen, as a page or
+    as a link target, and their links are appended to one array, so a
+    crawl holds 4 bytes per link and one dict entry per URL. Adding a
+    page again (when it changed) supersedes its earlier links without
+    rewriting anything. Only pages that were added, and not removed,
+    end up in the graph, along with the links between them.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.urls = []
+        # Index of each page's latest batch of links, -1 if it has none
+        self._latest = array('q')
+        # Batch b is the links of page _batch_pages[b], stored in
+        # _targets[_batch_starts[b]:_batch_starts[b + 1]]
+        self._batch_pages = array('I')
+        self._batch_starts = array('Q', [0])
+        self._targets = array('I')
+        # Pages and batches written by the last save_batches()
+        self._saved = (0, 0)
+
+    def node(self, url):
+        """The ID of a URL, assigning one if it is new"""
+        node = self.ids.get(url)
+        if node is None:
+            node = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+            self._latest.append(-1)
+        return node
+
+    def _add(self, page, targets):
+        self._latest[page] = len(self._batch_pages)
+        self._batch_pages.append(page)
+        self._targets.extend(targets)
+        self._batch_starts.append(len(self._targets))
+
+    def add_page(self, url, links):
+        """Record a page's links, replacing those recorded before"""
+        page = self.node(url)
+        # Each link counts once, and links to the page itself not at all
+        targets = dict.fromkeys(self.node(link) for link in links)
+        targets.pop(page, None)
+        self._add(page, targets)
+
+    def remove_page(self, url):
+        """Leave a page, and links to it, out of the graph"""
+        page = self.ids.get(url)
+        if page is not None:
+            self._latest[page] = -1
+
+    def __len__(self):
+        """Number of pages in the graph, not counting unvisited link targets"""
+        return sum(1 for batch in self._latest if batch >= 0)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """A builder holding a saved graph's pages, to update it"""
+        builder = cls()
+        for url in graph.urls:
+            builder.node(url)
+        for page in range(len(graph)):
+            builder._add(page, graph.links(page))
+        builder._saved = (len(builder.urls), len(builder._batch_pages))
+        return builder
+
+    def build(self):
+        """The LinkGraph of the pages added so far, without scores"""
+        pages = sorted((url for url, node in self.ids.items() if self._latest[node] >= 0))
+        # Old ID -> new ID, -1 for pages left out
+        new_ids = array('q', [-1]) * len(self.urls)
+        for new_id, url in enumerate(pages):
+            new_ids[self.ids[url]] = new_id
+        batches = array('Q', (self._latest[self.ids[url]] for url in pages))
+        if np is not None:
+            offsets, targets = self._csr_numpy(new_ids, batches)
+        else:
+            offsets, targets = array('Q', [0]), array('I')
+            starts, all_targets = self._batch_starts, self._targets
+            for batch in batches:
+                for target in all_targets[starts[batch]:starts[batch + 1]]:
+                    target = new_ids[target]
+                    if target >= 0:
+                        targets.append(target)
+                offsets.append(len(targets))
+        return LinkGraph(pages, offsets, targets)
+
+    def _csr_numpy(self, new_ids, batches):
+        # IDs fit 32 bits, as targets are stored in 32 bits anyway
+        new_ids = np.frombuffer(new_ids, dtype=np.int64).astype(np.int32)
+        batches = np.frombuffer(batches, dtype=np.uint64).astype(np.int64)
+        batch_starts = np.frombuffer(self._batch_starts, dtype=np.uint64).astype(np.int64)
+        all_targets = np.frombuffer(self._targets, dtype=np.uint32)
+        starts, lengths = batch_starts[batches], batch_starts[batches + 1] - batch_starts[batches]
+        # Positions in _targets of every kept batch's links, in page order
+        first = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - first, lengths) + np.arange(lengths.sum())
+        targets = new_ids[all_targets[positions]]
+        kept = targets >= 0
+        pages = np.repeat(np.arange(len(batches), dtype=np.int32), lengths)[kept]
+        offsets = np.zeros(len(batches) + 1, dtype=np.uint64)
+        np.cumsum(np.bincount(pages, minlength=len(batches)), out=offsets[1:])
+        return (array('Q', offsets.tobytes()),
+                array('I', targets[kept].astype(np.uint32).tobytes()))
+
+    def save_batches(self, path):
+        """
+        Append the pages and links added since the last call to a file,
+        so that a crawl resumed from a checkpoint can `replay()` them.
+        Costs as much as the links added, however large the graph.
+        """
+        pages, batches = self._saved
+        starts = self._batch_starts
+        chunk = {
+            'urls': self.urls[pages:],
+            'batches': [[self._batch_pages[b], list(self._targets[starts[b]:starts[b + 1]])]
+                        for b in range(batches, len(self._batch_pages))],
+        }
+        data = zlib.compress(json.dumps(chunk).encode('utf-8'))
+        with open(path, 'ab') as f:
+            f.write(struct.pack('=Q', len(data)))
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._saved = (len(self.urls), len(self._batch_pages))
+
+    def replay(self, path):
+        """Add the pages and links saved by `save_batches()` calls"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        position = 0
+        while position + 8 <= len(data):
+            size, = struct.unpack_from('=Q', data, position)
+            chunk = data[position + 8:position + 8 + size]
+            position += 8 + size
+            if len(chunk) < size:
+                # Cut short by a crash while appending
+                break
+            chunk = json.loads(zlib.decompress(chunk))
+            # IDs in the file were numbered from the same starting graph
+            for url in chunk['urls']:
+                self.node(url)
+            for page, targets in chunk['batches']:
+                self._add(page, targets)
+        self._saved = (len(self.urls), len(self._batch_pages))
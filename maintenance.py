@@ -0,0 +1,121 @@
+from collections import defaultdict
+
+from whoosh.index import TOC
+from whoosh.reading import SegmentReader
+from whoosh.writing import MERGE_SMALL, NO_MERGE
+
+# Optimize once the index has more segments than this...
+MAX_SEGMENTS = 10
+# ...or once this fraction of its documents are deleted
+MAX_DELETED_RATIO = 0.2
+
+
+class TieredMerge:
+    """
+    Merge policy that keeps the segment count logarithmic in index size.
+
+    Segments are grouped into tiers by size: tier 0 holds segments of
+    fewer than `min_docs` documents, and each tier after that segments
+    `factor` times larger. When a tier fills up with `factor` segments
+    they are merged into one segment of the next tier, so a commit only
+    ever rewrites segments of similar size and large segments are
+    rewritten rarely. Segments with more than `max_deleted` of their
+    documents deleted are rewritten too, to drop the deleted documents.
+
+    Instances are passed to whoosh as `writer.commit(mergetype=...)`.
+    """
+
+    def __init__(self, factor=10, min_docs=100, max_deleted=0.3):
+        self.factor = factor
+        self.min_docs = min_docs
+        self.max_deleted = max_deleted
+
+    def tier(self, segment):
+        count = segment.doc_count_all()
+        tier, limit = 0, self.min_docs
+        while count >= limit:
+            tier += 1
+            limit *= self.factor
+        return tier
+
+    def __call__(self, writer, segments):
+        tiers = defaultdict(list)
+        for segment in segments:
+            tiers[self.tier(segment)].append(segment)
+
+        merge = set()
+        for tier_segments in tiers.values():
+            if len(tier_segments) >= self.factor:
+                merge.update(segment.segment_id() for segment in tier_segments)
+        for segment in segments:
+            total = segment.doc_count_all()
+            if total and segment.deleted_count() / total > self.max_deleted:
+                merge.add(segment.segment_id())
+
+        kept = []
+        for segment in segments:
+            if segment.segment_id() in merge:
+                reader = SegmentReader(writer.storage, writer.schema, segment)
+                writer.add_reader(reader)
+                reader.close()
+            else:
+                kept.append(segment)
+        return kept
+
+
+# Merge policies by the names used on the command line
+MERGE_POLICIES = {
+    'tiered': TieredMerge(),
+    'small': MERGE_SMALL,
+    'none': NO_MERGE,
+}
+
+
+def segment_stats(ix):
+    """
+    Describe the segments of an index's latest generation.
+
+    Returns a dict with the segment count, document and deleted document
+    totals, the deleted ratio, the size in bytes, and a 'segments' list
+    with the same numbers per segment.
+    """
+    storage = ix.storage
+    toc = TOC.read(storage, ix.indexname)
+    segments = []
+    for segment in toc.segments:
+        segments.append({
+            'id': segment.segment_id(),
+            'documents': segment.doc_count_all(),
+            'deleted': segment.deleted_count(),
+            'bytes': sum(storage.file_length(name)
+                         for name in segment.list_files(storage)),
+        })
+    documents = sum(segment['documents'] for segment in segments)
+    deleted = sum(segment['deleted'] for segment in segments)
+    return {
+        'generation': toc.generation,
+        'segment_count': len(segments),
+        'documents': documents,
+        'deleted': deleted,
+        'deleted_ratio': deleted / documents if documents else 0.0,
+        'bytes': sum(segment['bytes'] for segment in segments),
+        'segments': segments,
+    }
+
+
+def optimize_due(stats, max_segments=MAX_SEGMENTS, max_deleted_ratio=MAX_DELETED_RATIO):
+    """Whether segment_stats() describe an index worth optimizing"""
+    return (stats['segment_count'] > max_segments or
+            stats['deleted_ratio'] > max_deleted_ratio)
+
+
+def optimize(ix, lock_timeout=0):
+    """
+    Merge all segments of an index into one, dropping deleted documents.
+
+    Takes the write lock like any writer, and raises LockError if a crawl
+    holds it for longer than `lock_timeout` seconds. Searchers keep
+    using the segments they opened until they are refreshed.
+    """
+    writer = ix.writer(timeout=lock_timeout)
+    writer.commit(optimize=True)
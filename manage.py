@@ -0,0 +1,147 @@
+"""
+Index maintenance jobs, run separately from the web app.
+
+    python manage.py build [--async] [--shards N] [--start-url URL]
+    python manage.py recrawl
+    python manage.py migrate [--profile lean|debug]
+    python manage.py segments
+    python manage.py optimize [--if-needed]
+    python manage.py maintain [--interval SECONDS]
+
+The app only ever opens the index read-only, so these can run while it
+is serving. `build` crawls into a new index generation and swaps it in
+when done; workers switch to it on their next refresh.
+
+Pass --metrics-file to leave the crawl's counters and latency histograms
+in a file for the node exporter's textfile collector, and -v to log
+every page.
+"""
+import argparse
+import logging
+import time
+
+from app import INDEX_DIR, START_URL
+from metrics import REGISTRY
+from maintenance import (MAX_SEGMENTS, MAX_DELETED_RATIO, segment_stats,
+                         optimize_due, optimize as optimize_index)
+from search_index import PROFILES, live_dir, migrate as migrate_index
+from whoosh.index import LockError, open_dir
+from whoosh_crawler import WebCrawler
+
+log = logging.getLogger(__name__)
+
+
+def build(args):
+    crawler = WebCrawler(args.start_url, args.index_dir, shards=args.shards)
+    print("Building index...")
+    crawler.rebuild(use_async=args.use_async)
+    print(f"Crawl complete. Visited {len(crawler.visited_urls)} pages")
+
+
+def recrawl(args):
+    crawler = WebCrawler(args.start_url, args.index_dir)
+    print("Refreshing index...")
+    stats = crawler.recrawl()
+    print(", ".join(f"{count} {kind}" for kind, count in stats.items()))
+
+
+def migrate(args):
+    print(f"Migrating index to the {args.profile} schema...")
+    count = migrate_index(args.index_dir, args.profile)
+    if count is None:
+        print(f"Index already uses the {args.profile} schema")
+    else:
+        print(f"Copied {count} pages into a new index generation")
+
+
+def segments(args):
+    stats = segment_stats(open_dir(live_dir(args.index_dir), readonly=True))
+    for segment in stats['segments']:
+        print(f"{segment['id']:32} {segment['documents']:8} docs "
+              f"{segment['deleted']:8} deleted {segment['bytes'] / 1e6:9.2f} MB")
+    print(f"{stats['segment_count']} segments, {stats['documents']} docs, "
+          f"{stats['deleted_ratio']:.1%} deleted, {stats['bytes'] / 1e6:.2f} MB")
+
+
+def run_optimize(args):
+    """Optimize the live index; return whether it was"""
+    ix = open_dir(live_dir(args.index_dir))
+    stats = segment_stats(ix)
+    if args.if_needed and not optimize_due(stats, args.max_segments, args.max_deleted):
+        print(f"Not needed: {stats['segment_count']} segments, "
+              f"{stats['deleted_ratio']:.1%} deleted")
+        return False
+    start = time.monotonic()
+    optimize_index(ix, args.lock_timeout)
+    print(f"Optimized {stats['segment_count']} segments in "
+          f"{time.monotonic() - start:.1f}s")
+    return True
+
+
+def maintain(args):
+    # Meant to run as its own long-lived process, next to the app
+    args.if_needed = True
+    while True:
+        try:
+            run_optimize(args)
+        except LockError:
+            # A crawl is writing; try again on the next round
+            log.warning("Index is locked, not optimized")
+        time.sleep(args.interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--index-dir', default=str(INDEX_DIR))
+    parser.add_argument('--start-url', default=START_URL)
+    parser.add_argument('--metrics-file', help="write metrics here when done")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every page")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = commands.add_parser('build', help="crawl and index the site")
+    build_parser.add_argument('--async', dest='use_async', action='store_true',
+                              help="fetch pages concurrently")
+    build_parser.add_argument('--shards', type=int, default=1,
+                              help="index pages on this many processes")
+    build_parser.set_defaults(func=build)
+
+    recrawl_parser = commands.add_parser('recrawl', help="refresh changed pages")
+    recrawl_parser.set_defaults(func=recrawl)
+
+    migrate_parser = commands.add_parser(
+        'migrate', help="copy the index into a new generation with another schema")
+    migrate_parser.add_argument('--profile', choices=PROFILES, default='lean')
+    migrate_parser.set_defaults(func=migrate)
+
+    segments_parser = commands.add_parser(
+        'segments', help="show segment count, deleted ratio and size")
+    segments_parser.set_defaults(func=segments)
+
+    for name, func, help in (
+            ('optimize', run_optimize, "merge all segments into one"),
+            ('maintain', maintain, "optimize whenever needed, forever")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('--max-segments', type=int, default=MAX_SEGMENTS)
+        command.add_argument('--max-deleted', type=float, default=MAX_DELETED_RATIO,
+                             help="largest acceptable ratio of deleted documents")
+        command.add_argument('--lock-timeout', type=float, default=60,
+                             help="seconds to wait for a running crawl")
+        command.set_defaults(func=func)
+    commands.choices['optimize'].add_argument(
+        '--if-needed', action='store_true',
+        help="only optimize when over --max-segments or --max-deleted")
+    commands.choices['maintain'].add_argument(
+        '--interval', type=float, default=3600, help="seconds between checks")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    try:
+        args.func(args)
+    finally:
+        if args.metrics_file:
+            REGISTRY.write_textfile(args.metrics_file)
+
+
+if __name__ == '__main__':
+    main()
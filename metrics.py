@@ -0,0 +1,204 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """A value that only goes up, e.g. pages fetched"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, with their sum and count.
+
+    Observing is a bisect and three additions, so histograms can sit on
+    hot paths. `buckets` are the bucket upper bounds in ascending order.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # One count per bucket, and a last one for values above them all
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds its block takes"""
+        return _Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f'{self.name}_sum', self.sum
+        yield f'{self.name}_count', self.count
+
+
+class Registry:
+    """
+    The metrics of one process, rendered in the Prometheus text format.
+
+    Every process has its own: the app's workers each report their own
+    searches, and a crawl run by manage.py writes its metrics to a file
+    for the node exporter's textfile collector when it is done.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics to a file, replacing it atomically"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+# Crawling
+FETCH_SECONDS = REGISTRY.histogram(
+    'crawler_fetch_seconds', "Time to fetch a page, body included")
+PARSE_SECONDS = REGISTRY.histogram(
+    'crawler_parse_seconds', "Time to parse a page's text and links")
+INDEX_WRITE_SECONDS = REGISTRY.histogram(
+    'crawler_index_write_seconds', "Time to add a parsed page to the index")
+PAGES_FETCHED = REGISTRY.counter(
+    'crawler_pages_fetched_total', "Responses received, whatever their status")
+PAGES_SKIPPED = REGISTRY.counter(
+    'crawler_pages_skipped_total', "Pages not read: not HTML, too large or disallowed")
+ERRORS = REGISTRY.counter(
+    'crawler_errors_total', "Pages that failed to fetch or index")
+BYTES_DOWNLOADED = REGISTRY.counter(
+    'crawler_downloaded_bytes_total', "Response body bytes received, before decompression")
+
+# Searching
+QUERY_PARSE_SECONDS = REGISTRY.histogram(
+    'search_query_parse_seconds', "Time to parse a query string not in the query cache")
+SEARCH_SECONDS = REGISTRY.histogram(
+    'search_seconds', "Time to answer a search, cached or not")
+HIGHLIGHT_SECONDS = REGISTRY.histogram(
+    'search_highlight_seconds', "Time to build the teasers of one result page")
+RENDER_SECONDS = REGISTRY.histogram(
+    'app_render_seconds', "Time to render a page template")
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for one thread.
+
+    While running, a background thread looks at the profiled thread's
+    stack every `interval` seconds and counts how often each stack was
+    seen. The profiled code runs unmodified, so the overhead is that of
+    the sampling thread alone, and nothing at all while stopped.
+    `collapsed()` returns the counts in the folded format read by
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id=None, interval=0.001):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """One "outermost;...;innermost count" line per stack, commonest first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
@@ -0,0 +1,195 @@
+import os
+import re
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup, NavigableString
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml  # noqa: F401  (only needed as a BeautifulSoup tree builder)
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+# rel values are case-insensitive
+_CANONICAL = re.compile(r'^canonical$', re.I)
+
+# Fastest first; html.parser ships with Python and is always available
+BACKENDS = ('selectolax', 'lxml', 'html.parser')
+
+
+def available_backends():
+    """Return the parser backends that can be used on this machine"""
+    available = []
+    if HTMLParser is not None:
+        available.append('selectolax')
+    if HAVE_LXML:
+        available.append('lxml')
+    available.append('html.parser')
+    return available
+
+
+def default_backend():
+    """Return the fastest installed parser backend"""
+    return available_backends()[0]
+
+
+def parse_page(html_content, current_url, backend='html.parser'):
+    """
+    Extract (title, text, links) from an HTML page.
+
+    Script and style contents are left out of the text and links are
+    made absolute. This is a plain function so it can run in a process
+    pool.
+    """
+    return parse_document(html_content, current_url, backend)[:3]
+
+
+def parse_document(html_content, current_url, backend='html.parser'):
+    """
+    Extract (title, text, links, canonical) from an HTML page, where
+    `canonical` is the absolute URL of its rel=canonical link, or None.
+    """
+    if backend == 'selectolax':
+        return _parse_selectolax(html_content, current_url)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
+
+    soup = BeautifulSoup(html_content, backend)
+    canonical = soup.find('link', rel=_CANONICAL, href=True)
+    canonical = urljoin(current_url, canonical['href']) if canonical else None
+
+    # Get the page title
+    title = soup.find('title')
+    title_text = title.get_text().strip() if title else ""
+
+    # Extract text content (excluding script and style elements)
+    for script in soup(['script', 'style']):
+        script.decompose()
+    text_content = soup.get_text(' ', strip=True)
+
+    # Extract all links and convert to absolute URLs
+    links = []
+    for link in soup.find_all('a'):
+        href = link.get('href')
+        if href:
+            links.append(urljoin(current_url, href))
+
+    return title_text, text_content, links, canonical
+
+
+def _parse_selectolax(html_content, current_url):
+    tree = HTMLParser(html_content)
+    canonical = tree.css_first('link[rel~="canonical"][href]')
+    canonical = (urljoin(current_url, canonical.attributes['href'])
+                 if canonical else None)
+
+    title = tree.css_first('title')
+    title_text = title.text().strip() if title else ""
+
+    tree.strip_tags(['script', 'style'])
+    text_content = tree.root.text(separator=' ', strip=True) if tree.root else ""
+
+    links = []
+    for link in tree.css('a'):
+        href = link.attributes.get('href')
+        if href:
+            links.append(urljoin(current_url, href))
+
+    return title_text, text_content, links, canonical
+
+
+def default_workers():
+    """Number of parse processes to use: one per core"""
+    return os.cpu_count() or 1
+
+
+# Tags whose text counts as page content, and the region each one opens.
+# The innermost region wins, so a heading inside a div is a heading.
+REGION_TAGS = {
+    'title': 'title',
+    'h1': 'headings', 'h2': 'headings', 'h3': 'headings',
+    'h4': 'headings', 'h5': 'headings', 'h6': 'headings',
+    'main': 'main', 'article': 'main',
+    'div': 'body', 'p': 'body',
+}
+REGIONS = ('title', 'headings', 'main', 'body')
+SKIP_TAGS = {'script', 'style', 'template'}
+
+
+def extract_fields(html_content, current_url, backend='html.parser'):
+    """
+    Split a page into per-region text in a single pass over the tree.
+
+    Returns ({region: text}, links) where the regions are 'title',
+    'headings', 'main' (main and article elements) and 'body' (div and p
+    elements). Every text node is visited once and belongs to exactly
+    one region, that of its innermost region tag, so nested containers
+    never repeat text. Text outside any region tag is ignored.
+    """
+    if backend == 'selectolax':
+        return _extract_fields_selectolax(html_content, current_url)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
+
+    soup = BeautifulSoup(html_content, backend)
+    parts = {region: [] for region in REGIONS}
+    links = []
+
+    # Depth-first walk; children are pushed reversed to keep document order
+    stack = [(soup, None)]
+    while stack:
+        node, region = stack.pop()
+        if isinstance(node, NavigableString):
+            # Comments, CDATA and doctypes are NavigableString subclasses
+            if region and type(node) is NavigableString:
+                text = node.strip()
+                if text:
+                    parts[region].append(text)
+            continue
+        if node.name in SKIP_TAGS:
+            continue
+        if node.name == 'a':
+            href = node.get('href')
+            if href:
+                links.append(urljoin(current_url, href))
+        region = REGION_TAGS.get(node.name, region)
+        stack.extend((child, region) for child in reversed(node.contents))
+
+    fields = {region: ' '.join(texts) for region, texts in parts.items()}
+    return fields, links
+
+
+def _extract_fields_selectolax(html_content, current_url):
+    tree = HTMLParser(html_content)
+    parts = {region: [] for region in REGIONS}
+    links = []
+
+    # The same walk as extract_fields(); text nodes are tagged '-text',
+    # comments '-comment'
+    stack = [(tree.root, None)] if tree.root else []
+    while stack:
+        node, region = stack.pop()
+        tag = node.tag
+        if tag == '-text':
+            if region:
+                text = node.text_content.strip()
+                if text:
+                    parts[region].append(text)
+            continue
+        if tag in SKIP_TAGS or tag.startswith('-'):
+            continue
+        if tag == 'a':
+            href = node.attributes.get('href')
+            if href:
+                links.append(urljoin(current_url, href))
+        region = REGION_TAGS.get(tag, region)
+        children = list(node.iter(include_text=True))
+        stack.extend((child, region) for child in reversed(children))
+
+    fields = {region: ' '.join(texts) for region, texts in parts.items()}
+    return fields, links
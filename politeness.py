@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+# Sent with every request, and the name looked up in robots.txt
+USER_AGENT = 'AiWebTask2-crawler'
+
+# Default steady request rate per host (requests per second) and how many
+# requests may go out back to back before the rate applies
+DEFAULT_RATE = 8.0
+DEFAULT_BURST = 4
+# Longest delay between two requests to one host, however slow it gets
+MAX_DELAY = 60.0
+# Responses asking us to slow down, and how often such a page is retried
+BACKOFF_STATUSES = (429, 503)
+MAX_RETRIES = 3
+# How long a host's robots.txt is trusted before it is fetched again
+ROBOTS_TTL = 24 * 3600
+# A host counts as slowing down once its recent latency is this many
+# times its best latency so far
+LATENCY_FACTOR = 2.0
+
+
+def host_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def retry_after(response):
+    """Seconds a response's Retry-After header asks us to wait, or None"""
+    value = response.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RobotsCache:
+    """
+    Parsed robots.txt files, fetched once per host and kept for `ttl`.
+
+    A missing robots.txt (any 4xx but 401/403) allows everything, one
+    behind authentication disallows everything, and a host whose
+    robots.txt can't be fetched at all is treated as allowing everything
+    until the file is tried again after `retry` seconds.
+    """
+
+    def __init__(self, fetch=requests.get, user_agent=USER_AGENT,
+                 ttl=ROBOTS_TTL, retry=300, timeout=10):
+        self.fetch = fetch
+        self.user_agent = user_agent
+        self.ttl = ttl
+        self.retry = retry
+        self.timeout = timeout
+        # Host -> (RobotFileParser, expiry time)
+        self._rules = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    def rules(self, url):
+        """Return the RobotFileParser for a URL's host, fetching it if needed"""
+        host = host_of(url)
+        entry = self._rules.get(host)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        # Concurrent first requests to a host fetch its robots.txt once
+        with host_lock:
+            entry = self._rules.get(host)
+            if entry is None or entry[1] <= time.monotonic():
+                entry = self._rules[host] = self._load(host)
+            return entry[0]
+
+    def _load(self, host):
+        parser = RobotFileParser(host + '/robots.txt')
+        ttl = self.ttl
+        try:
+            response = self.fetch(parser.url, timeout=self.timeout,
+                                  headers={'User-Agent': self.user_agent})
+        except requests.RequestException:
+            parser.allow_all = True
+            return parser, time.monotonic() + self.retry
+        if response.status_code in (401, 403):
+            parser.disallow_all = True
+        elif response.status_code >= 500:
+            parser.allow_all = True
+            ttl = self.retry
+        elif response.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(response.text.splitlines())
+        # can_fetch answers False for files it believes were never read
+        parser.modified()
+        return parser, time.monotonic() + ttl
+
+    def allowed(self, url):
+        return self.rules(url).can_fetch(self.user_agent, url)
+
+    def crawl_delay(self, url):
+        """The host's Crawl-delay (or Request-rate interval) in seconds, or None"""
+        rules = self.rules(url)
+        delay = rules.crawl_delay(self.user_agent)
+        rate = rules.request_rate(self.user_agent)
+        if rate is not None and rate.requests:
+            delay = max(delay or 0, rate.seconds / rate.requests)
+        return float(delay) if delay is not None else None
+
+
+class _HostState:
+    __slots__ = ('base_interval', 'interval', 'tokens', 'updated',
+                 'latency', 'best_latency', 'backoffs', 'backed_off_at', 'slowed_at')
+
+    def __init__(self, interval, burst):
+        self.base_interval = interval
+        self.interval = interval
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.latency = None
+        self.best_latency = None
+        self.backoffs = 0
+        self.backed_off_at = float('-inf')
+        self.slowed_at = float('-inf')
+
+
+class HostScheduler:
+    """
+    Per-host token buckets that keep a crawl polite without serializing it.
+
+    Every host gets a bucket of `burst` tokens refilled at `rate` tokens
+    per second; a request takes a token, and `acquire()` tells the caller
+    how long to wait for one. Requests to different hosts never wait for
+    each other. A host's interval grows to its robots.txt Crawl-delay,
+    doubles on 429 and 503 responses (pausing for Retry-After), and grows
+    more gently while its latency is well above the best seen; it then
+    decays back to the base rate as responses come back healthy.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_delay=MAX_DELAY,
+                 robots=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.burst = burst
+        self.max_delay = max_delay
+        # A RobotsCache, or None to ignore robots.txt
+        self.robots = robots
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            interval = self.interval
+            if self.robots is not None:
+                delay = self.robots.crawl_delay(host + '/')
+                if delay:
+                    interval = max(interval, min(delay, self.max_delay))
+            state = self._hosts.setdefault(host, _HostState(interval, self.burst))
+        return state
+
+    def allowed(self, url):
+        """Whether robots.txt lets us fetch the URL"""
+        return self.robots is None or self.robots.allowed(url)
+
+    def acquire(self, url):
+        """
+        Take a token for the URL's host if one is free and return 0;
+        otherwise take nothing and return the seconds until one will be.
+        Callers wait that long and ask again, so a host that slows down
+        holds back its waiting requests straight away.
+        """
+        state = self._state(host_of(url))
+        with self._lock:
+            now = time.monotonic()
+            if state.interval:
+                state.tokens = min(float(self.burst), state.tokens +
+                                   (now - state.updated) / state.interval)
+            else:
+                state.tokens = float(self.burst)
+            state.updated = now
+            if state.tokens >= 1:
+                state.tokens -= 1
+                return 0.0
+            return (1 - state.tokens) * state.interval
+
+    async def wait_async(self, url):
+        """Wait until a request to the URL's host may go out"""
+        while True:
+            wait = self.acquire(url)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def wait(self, url):
+        """Block until a request to the URL's host may go out"""
+        while True:
+            wait = self.acquire(url)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def record(self, url, status, elapsed, wait=None):
+        """
+        Adapt the host's pace to a response: its status, the seconds it
+        took, and the seconds its Retry-After header asked for, if any.
+        """
+        state = self._state(host_of(url))
+        with self._lock:
+            if status in BACKOFF_STATUSES:
+                now = time.monotonic()
+                state.backoffs += 1
+                # Requests that were already in flight when we backed off
+                # report the same overload; only back off again once the
+                # slower pace has had a chance to show
+                if now - state.backed_off_at >= state.interval:
+                    state.interval = min(max(state.interval * 2, 0.5), self.max_delay)
+                    state.backed_off_at = now
+                # Nothing more goes out for an interval, or for as long as
+                # Retry-After asked, whichever pause ends later
+                pause = min(max(wait or 0, state.interval), self.max_delay)
+                state.tokens = 0.0
+                state.updated = max(state.updated, now + pause - state.interval)
+                return
+
+            state.latency = (elapsed if state.latency is None
+                             else 0.8 * state.latency + 0.2 * elapsed)
+            if state.best_latency is None or state.latency < state.best_latency:
+                state.best_latency = state.latency
+            now = time.monotonic()
+            if state.latency > LATENCY_FACTOR * state.best_latency + 0.01:
+                # As with backoffs, responses to requests sent before we
+                # slowed down can't show whether that helped; and an
+                # unpaced host is only slowed down when it asks to be
+                if state.base_interval and now - state.slowed_at >= state.interval:
+                    state.interval = min(state.interval * 1.5, self.max_delay)
+                    state.slowed_at = now
+            elif state.interval > state.base_interval:
+                state.interval = max(state.interval * 0.8, state.base_interval)
+
+    def stats(self):
+        """Current interval, latency and backoff count per host"""
+        with self._lock:
+            return {host: {'interval': state.interval,
+                           'latency': state.latency,
+                           'backoffs': state.backoffs}
+                    for host, state in self._hosts.items()}
+
@@ -0,0 +1,173 @@
+import heapq
+import math
+from array import array
+from collections import defaultdict
+
+from compact_index import gallop, intersect
+
+# Standard BM25 parameters: term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# Rough cost of visiting a posting document-at-a-time relative to
+# accumulating it term-at-a-time
+DAAT_COST = 5
+
+
+class BM25:
+    """
+    BM25 top-k retrieval over a CompactIndex.
+
+    Document length norms are computed once when the scorer is created,
+    and each term's upper bound (the best score it can contribute to any
+    document) once per term. The bounds let the search skip documents
+    that cannot enter the current top k without scoring them fully:
+    MaxScore for queries matching any term, and early termination of
+    per-document scoring for queries matching all terms. Only the best
+    k documents are kept, in a bounded heap, and only they are sorted.
+
+    A scorer describes the index as it was when the scorer was created;
+    make a new one after adding documents.
+    """
+
+    def __init__(self, index, k1=K1, b=B):
+        self.index = index
+        self.k1 = k1
+        self.doc_count = len(index.urls)
+        avg_length = index.total_length / self.doc_count if self.doc_count else 0
+        # Doc ID -> k1 * (1 - b + b * length / average length)
+        self.norms = array('d', (
+            k1 * (1 - b + b * length / avg_length) if avg_length else k1
+            for length in index.doc_lengths))
+        # Term -> (idf, upper bound, doc IDs, frequencies)
+        self._terms = {}
+
+    def term(self, word):
+        """Return (idf, upper bound, doc IDs, frequencies) for a term"""
+        stats = self._terms.get(word)
+        if stats is None:
+            doc_ids, freqs = self.index.postings(word)
+            df = len(doc_ids)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            norms, k1 = self.norms, self.k1
+            best = max((freq * (k1 + 1) / (freq + norms[doc_id])
+                        for doc_id, freq in zip(doc_ids, freqs)), default=0.0)
+            stats = self._terms[word] = (idf, idf * best, doc_ids, freqs)
+        return stats
+
+    def _score(self, idf, freq, doc_id):
+        return idf * freq * (self.k1 + 1) / (freq + self.norms[doc_id])
+
+    def top_k(self, words, k=10, match_all=True):
+        """
+        Return up to k (doc ID, score) pairs, best first.
+
+        With match_all, only documents containing every word are ranked,
+        as in CompactIndex.match_all; otherwise any word is enough.
+        """
+        terms = [self.term(word) for word in sorted(set(words))]
+        if not terms or k <= 0:
+            return []
+        if match_all:
+            heap = self._top_k_all(terms, k)
+        else:
+            heap = self._top_k_any(terms, k)
+        return [(doc_id, score) for score, _, doc_id in
+                sorted(heap, key=lambda entry: (-entry[0], entry[2]))]
+
+    def _offer(self, heap, k, score, doc_id):
+        # Heap entries are (score, -doc ID, doc ID): on equal scores the
+        # higher doc ID is evicted first, keeping results deterministic
+        entry = (score, -doc_id, doc_id)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def _top_k_all(self, terms, k):
+        if any(not len(doc_ids) for _, _, doc_ids, _ in terms):
+            return []
+        candidates = intersect([doc_ids for _, _, doc_ids, _ in terms])
+
+        # Score the terms able to contribute most first, so hopeless
+        # documents are given up on as early as possible
+        terms.sort(key=lambda term: term[1], reverse=True)
+        remaining = [sum(term[1] for term in terms[i + 1:]) for i in range(len(terms))]
+        cursors = [0] * len(terms)
+        heap = []
+        for doc_id in candidates:
+            score = 0.0
+            for i, (idf, _, doc_ids, freqs) in enumerate(terms):
+                pos = cursors[i] = gallop(doc_ids, doc_id, cursors[i])
+                score += self._score(idf, freqs[pos], doc_id)
+                if len(heap) == k and score + remaining[i] <= heap[0][0]:
+                    break
+            else:
+                self._offer(heap, k, score, doc_id)
+        return heap
+
+    def _top_k_any(self, terms, k):
+        # MaxScore: terms sorted by upper bound; once the k-th best score
+        # exceeds the bounds of the weakest terms combined, those terms
+        # can no longer put a document into the top k on their own and
+        # are only probed for documents found through the others
+        terms = [term for term in terms if len(term[2])]
+        terms.sort(key=lambda term: term[1])
+        bounds = []
+        total = 0.0
+        for term in terms:
+            total += term[1]
+            bounds.append(total)
+
+        # MaxScore pays off when one term can outscore all the others
+        # together and its postings are short, so the long lists soon
+        # become non-essential and are only probed. Otherwise it would
+        # step through most postings one document at a time, which in
+        # Python is several times slower than accumulating scores a term
+        # at a time.
+        total = sum(len(term[2]) for term in terms)
+        if (len(terms) < 2 or bounds[-2] >= terms[-1][1] or
+                len(terms[-1][2]) * DAAT_COST > total):
+            return self._accumulate(terms, k)
+
+        cursors = [0] * len(terms)
+        heap = []
+        threshold = 0.0
+        first_essential = 0
+        while True:
+            while first_essential < len(terms) and bounds[first_essential] <= threshold:
+                first_essential += 1
+            doc_id = min((terms[i][2][cursors[i]] for i in range(first_essential, len(terms))
+                          if cursors[i] < len(terms[i][2])), default=None)
+            if doc_id is None:
+                break
+
+            score = 0.0
+            for i in range(first_essential, len(terms)):
+                idf, _, doc_ids, freqs = terms[i]
+                pos = cursors[i]
+                if pos < len(doc_ids) and doc_ids[pos] == doc_id:
+                    score += self._score(idf, freqs[pos], doc_id)
+                    cursors[i] = pos + 1
+            for i in range(first_essential - 1, -1, -1):
+                if score + bounds[i] <= threshold:
+                    break
+                idf, _, doc_ids, freqs = terms[i]
+                pos = cursors[i] = gallop(doc_ids, doc_id, cursors[i])
+                if pos < len(doc_ids) and doc_ids[pos] == doc_id:
+                    score += self._score(idf, freqs[pos], doc_id)
+
+            self._offer(heap, k, score, doc_id)
+            if len(heap) == k:
+                threshold = heap[0][0]
+        return heap
+
+    def _accumulate(self, terms, k):
+        scores = defaultdict(float)
+        norms = self.norms
+        for idf, _, doc_ids, freqs in terms:
+            weight = idf * (self.k1 + 1)
+            for doc_id, freq in zip(doc_ids, freqs):
+                scores[doc_id] += weight * freq / (freq + norms[doc_id])
+        return heapq.nlargest(k, ((score, -doc_id, doc_id)
+                                  for doc_id, score in scores.items()))
@@ -0,0 +1,565 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+
+from cache import LRUCache
+from link_graph import GRAPH_FILE, LinkGraph
+from metrics import HIGHLIGHT_SECONDS, QUERY_PARSE_SECONDS, SEARCH_SECONDS
+from snippet_store import SnippetStore
+from suggest import DEFAULT_SUGGESTIONS, Suggester
+
+from whoosh.index import (create_in, open_dir, exists_in, EmptyIndexError,
+                         _DEF_INDEX_NAME)
+from whoosh.fields import Schema, TEXT, ID, STORED
+from whoosh.filedb.filestore import FileStorage
+from whoosh.qparser import MultifieldParser
+from whoosh import highlight, scoring
+
+# Names the generation directory that readers should search
+CURRENT_FILE = 'CURRENT'
+# Prefix of the directories holding full index generations
+GENERATION_PREFIX = 'gen-'
+# Left in a generation once it has been published, so that clean-up
+# never takes a build that is still running for an abandoned one
+PUBLISHED_FILE = 'PUBLISHED'
+
+# Search results shown per page unless the caller asks for another size
+DEFAULT_PER_PAGE = 10
+# How much links count: a page's text score is multiplied by its PageRank
+# relative to the average page, raised to this power; 0 ignores links
+LINK_WEIGHT = 0.2
+
+log = logging.getLogger(__name__)
+
+
+# Schema profiles: 'lean' keeps page texts in a SnippetStore next to the
+# index, 'debug' stores them, with character offsets, in the index itself
+PROFILES = ('lean', 'debug')
+
+
+def make_schema(profile='lean'):
+    """The schema shared by the crawler that writes and the readers"""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown schema profile: {profile}")
+    if profile == 'debug':
+        content = TEXT(stored=True, chars=True)  # Store content for debugging
+    else:
+        # Positions are kept for phrase queries, nothing else
+        content = TEXT(stored=False)
+    return Schema(
+        url=ID(stored=True, unique=True),
+        title=TEXT(stored=True),
+        content=content,
+        # Validators for conditional GETs when recrawling
+        etag=STORED,
+        last_modified=STORED,
+        content_hash=STORED,
+        # MinHash of the content, for near-duplicate detection
+        minhash=STORED
+    )
+
+
+def stores_content(ix):
+    """Whether an index keeps page texts itself rather than in a SnippetStore"""
+    return ix.schema['content'].stored
+
+
+def live_dir(index_dir):
+    """
+    Return the directory holding the index readers should search.
+
+    That is the generation named in the CURRENT file, or `index_dir`
+    itself for indexes built before generations were introduced.
+    """
+    try:
+        with open(os.path.join(index_dir, CURRENT_FILE)) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return index_dir
+    return os.path.join(index_dir, name)
+
+
+def stage_generation(index_dir, profile='lean'):
+    """Create an empty index in a new staging directory and return its path"""
+    os.makedirs(index_dir, exist_ok=True)
+    staged = tempfile.mkdtemp(prefix=GENERATION_PREFIX, dir=index_dir)
+    create_in(staged, make_schema(profile))
+    if profile == 'lean':
+        SnippetStore(staged).close()
+    return staged
+
+
+def is_locked(path):
+    """Whether a writer holds the write lock of the index in `path`"""
+    lock = FileStorage(path).lock(_DEF_INDEX_NAME + '_WRITELOCK')
+    if not lock.acquire(blocking=False):
+        return True
+    lock.release()
+    return False
+
+
+def is_published(path):
+    """Whether the generation in `path` has been published"""
+    return os.path.exists(os.path.join(path, PUBLISHED_FILE))
+
+
+def _mark_published(path):
+    open(os.path.join(path, PUBLISHED_FILE), 'w').close()
+
+
+def publish_generation(index_dir, staged):
+    """
+    Make a staged generation the one readers search.
+
+    The CURRENT pointer is replaced atomically, so a reader sees either
+    the old generation or the new one and never a half-built index.
+    The previous generation is kept for readers still searching it.
+    Older published generations are removed unless a writer still holds
+    them; generations never published, which may belong to a build or
+    migration running in another process, are left alone.
+    """
+    previous = live_dir(index_dir)
+    name = os.path.basename(staged)
+    _mark_published(staged)
+    if previous != index_dir and os.path.isdir(previous):
+        # Published before generations were marked
+        _mark_published(previous)
+    tmp_path = os.path.join(index_dir, CURRENT_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(index_dir, CURRENT_FILE))
+
+    for entry in os.listdir(index_dir):
+        path = os.path.join(index_dir, entry)
+        if (entry.startswith(GENERATION_PREFIX) and
+                entry not in (name, os.path.basename(previous)) and
+                is_published(path) and not is_locked(path)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def migrate(index_dir, profile='lean'):
+    """
+    Copy the live index into a new generation with another schema profile.
+
+    Page texts move between the index and the snippet store as needed;
+    nothing is refetched. Returns the number of pages copied, or None if
+    the index already uses that profile.
+    """
+    source_dir = live_dir(index_dir)
+    source = open_dir(source_dir, readonly=True)
+    if stores_content(source) == (profile == 'debug'):
+        return None
+
+    staged = stage_generation(index_dir, profile)
+    target = open_dir(staged)
+    snippets = SnippetStore(staged) if profile == 'lean' else None
+    old_snippets = None if stores_content(source) else SnippetStore(source_dir, readonly=True)
+    count = 0
+    writer = target.writer()
+    try:
+        with source.searcher() as searcher:
+            for fields in searcher.all_stored_fields():
+                fields = dict(fields)
+                content = fields.pop('content', None)
+                if content is None:
+                    content = old_snippets.get(fields['url'])
+                if snippets is not None:
+                    snippets.put(fields['url'], content)
+                writer.add_document(content=content, **fields)
+                count += 1
+        if snippets is not None:
+            snippets.commit()
+        writer.commit()
+    except BaseException:
+        writer.cancel()
+        raise
+    finally:
+        if snippets is not None:
+            snippets.close()
+        if old_snippets is not None:
+            old_snippets.close()
+    publish_generation(index_dir, staged)
+    return count
+
+
+class SearchPage:
+    """
+    One page of search results: iterates over (url, title, teaser) tuples
+    and knows the total number of hits across all pages, and the index
+    generation they came from (see SearchIndex.generation_tag).
+    """
+
+    def __init__(self, hits, total, page, per_page, generation=None):
+        self.hits = hits
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+        self.generation = generation
+
+    @property
+    def offset(self):
+        """Rank of the first hit on this page, counting from 0"""
+        return (self.page - 1) * self.per_page
+
+    @property
+    def page_count(self):
+        return -(-self.total // self.per_page)
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.page_count
+
+    def __iter__(self):
+        return iter(self.hits)
+
+    def __len__(self):
+        return len(self.hits)
+
+    def __getitem__(self, i):
+        return self.hits[i]
+
+
+class LinkWeighting(scoring.BM25F):
+    """BM25F with each page's score multiplied by its boost, `boosts[docnum]`"""
+
+    use_final = True
+
+    def __init__(self, boosts, **kwargs):
+        super().__init__(**kwargs)
+        self.boosts = boosts
+
+    def final(self, searcher, docnum, score):
+        return score * self.boosts[docnum]
+
+
+class SearchIndex:
+    """
+    Read-only handle on the crawler's index, for serving searches.
+
+    Opening it creates no files and takes no locks, so any number of
+    processes can search while a crawl writes. Segment files are memory
+    mapped and shared through the page cache. Each searcher is a snapshot
+    of one index generation: commits and generation swaps become visible
+    only when the searcher is refreshed, which happens between searches,
+    never during one.
+
+    Scores combine BM25F with the pages' PageRank from the link graph the
+    crawler stores with the index, weighted by `link_weight`.
+
+    Raises EmptyIndexError if no index has been built yet.
+    """
+
+    def __init__(self, index_dir, refresh_interval=1.0, result_ttl=300,
+                 link_weight=LINK_WEIGHT):
+        self.index_dir = index_dir
+        self.refresh_interval = refresh_interval
+        self.link_weight = link_weight
+        self._dir = live_dir(index_dir)
+        self.ix = self._open(self._dir)
+        self.snippets = self._open_snippets(self.ix, self._dir)
+
+        # Search state shared by all searches: one searcher, reopened when
+        # the index changes, and caches of parsed queries and result pages
+        self._searcher = None
+        self._parser = None
+        self._search_lock = threading.Lock()
+        self._last_refresh_check = 0.0
+        self.searcher_refreshes = 0
+        self.query_cache = LRUCache(maxsize=1024)
+        self.result_cache = LRUCache(maxsize=256, ttl=result_ttl)
+        # Completions for the search box, and the generation they are of
+        self.suggester = Suggester()
+        self._suggest_lock = threading.Lock()
+        self._suggest_generation = None
+        self._suggest_checked = 0.0
+        # The link graph, the file state it was loaded from, and the
+        # boosts of each segment's pages: segments never change, so only
+        # new ones are looked up when the searcher is refreshed
+        self._graph = None
+        self._graph_stamp = None
+        self._segment_boosts = {}
+
+    @staticmethod
+    def _open(path):
+        if not exists_in(path):
+            raise EmptyIndexError(f"No index in {path}")
+        return FileStorage(path, supports_mmap=True, readonly=True).open_index()
+
+    @staticmethod
+    def _open_snippets(ix, path):
+        if stores_content(ix) or not SnippetStore.exists(path):
+            return None
+        return SnippetStore(path, readonly=True)
+
+    def invalidate(self):
+        """Make the next search look for a new generation straight away"""
+        self._last_refresh_check = 0.0
+
+    def _swap(self, path):
+        # A rebuild published a new generation: search that from now on
+        self.ix = self._open(path)
+        self._dir = path
+        if self.snippets is not None:
+            self.snippets.close()
+        self.snippets = self._open_snippets(self.ix, path)
+        self._searcher = self._weighted(self.ix.searcher())
+        self._parser = None
+        self.query_cache.clear()
+        self.result_cache.clear()
+
+    def current_searcher(self):
+        """
+        Return the shared searcher, reopened if the index has changed.
+
+        The index is checked for a new generation at most once every
+        `refresh_interval` seconds. Reopening reuses the readers of
+        segments that did not change, and clears the caches, whose keys
+        include the index generation anyway. Call with the search lock
+        held.
+        """
+        now = time.monotonic()
+        if self._searcher is None:
+            self._searcher = self._weighted(self.ix.searcher())
+        elif now - self._last_refresh_check >= self.refresh_interval:
+            path = live_dir(self.index_dir)
+            if path != self._dir:
+                self._swap(path)
+                self.searcher_refreshes += 1
+            elif not self._searcher.up_to_date():
+                self._searcher = self._weighted(self._searcher.refresh())
+                self.searcher_refreshes += 1
+                self.query_cache.clear()
+                self.result_cache.clear()
+        else:
+            return self._searcher
+        self._last_refresh_check = now
+        return self._searcher
+
+    def _weighted(self, searcher):
+        """Make a new searcher boost pages by their links; call with the search lock held"""
+        boosts = self._link_boosts(searcher.reader())
+        if boosts is not None:
+            searcher.weighting = LinkWeighting(boosts)
+        return searcher
+
+    def _link_boosts(self, reader):
+        # Every page's boost by global docnum, or None without a ranked graph
+        path = os.path.join(self._dir, GRAPH_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not self.link_weight:
+            return None
+        stamp = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp != self._graph_stamp:
+            self._graph = LinkGraph.load(path)
+            self._graph_stamp = stamp
+            self._segment_boosts = {}
+        if self._graph.scores is None:
+            return None
+
+        boosts = array('f', [1.0]) * reader.doc_count_all()
+        segments = {}
+        for leaf, offset in reader.leaf_readers():
+            if not hasattr(leaf, 'segment'):
+                # An empty index
+                continue
+            key = leaf.segment().segment_id()
+            if key in self._segment_boosts:
+                segments[key] = self._segment_boosts[key]
+            else:
+                segments[key] = self._segment_link_boosts(leaf)
+            boosts[offset:offset + len(segments[key])] = segments[key]
+        self._segment_boosts = segments
+        return boosts
+
+    def _segment_link_boosts(self, leaf):
+        boosts = array('f', [1.0]) * leaf.doc_count_all()
+        pages = sorted((fields['url'], docnum) for docnum, fields in leaf.iter_docs())
+        scores = self._graph.scores_of(url for url, _ in pages)
+        for (_, docnum), score in zip(pages, scores):
+            boosts[docnum] = score ** self.link_weight
+        return boosts
+
+    def _generation_tag(self, searcher):
+        return f"{os.path.basename(self._dir)}.{searcher.reader().generation()}"
+
+    def generation_tag(self):
+        """
+        A string naming the index contents being searched, which changes
+        whenever a commit or a rebuild becomes visible. Search results
+        depend on nothing else, so it makes a good HTTP ETag.
+        """
+        with self._search_lock:
+            return self._generation_tag(self.current_searcher())
+
+    def suggest(self, query, limit=DEFAULT_SUGGESTIONS):
+        """
+        Completions of a partly typed query, as (text, weight) pairs.
+
+        Like searches, suggestions look for index changes at most every
+        `refresh_interval` seconds, and catch up by reading only the
+        segments that changed. Every other call is a lookup in memory
+        that waits for no lock, not even for searches in progress.
+        """
+        now = time.monotonic()
+        if now - self._suggest_checked >= self.refresh_interval:
+            with self._suggest_lock:
+                if now - self._suggest_checked >= self.refresh_interval:
+                    reader = None
+                    with self._search_lock:
+                        generation = self._generation_tag(self.current_searcher())
+                        if generation != self._suggest_generation:
+                            # A reader of its own, as the shared searcher's
+                            # is only safe to use with the lock held
+                            reader = self.ix.reader()
+                    if reader is not None:
+                        try:
+                            self.suggester.update(reader)
+                        finally:
+                            reader.close()
+                        self._suggest_generation = generation
+                    self._suggest_checked = time.monotonic()
+        return self.suggester.suggest(query, limit)
+
+    def index_status(self):
+        """Number of documents and generation of the index being searched"""
+        with self._search_lock:
+            searcher = self.current_searcher()
+            return {'documents': searcher.doc_count(),
+                    'generation': searcher.reader().generation(),
+                    'directory': os.path.basename(self._dir)}
+
+    def parse_query(self, query_str):
+        """Parse a query string, reusing earlier parses of the same string"""
+        query = self.query_cache.get(query_str)
+        if query is None:
+            # Search in both title and content
+            if self._parser is None:
+                self._parser = MultifieldParser(["title", "content"], self.ix.schema)
+            with QUERY_PARSE_SECONDS.time():
+                query = self._parser.parse(query_str)
+            self.query_cache.put(query_str, query)
+        return query
+
+    def search(self, query_str, page=1, per_page=DEFAULT_PER_PAGE, teasers=True):
+        """
+        Search the index for pages matching the query.
+        Returns one page of results as a SearchPage of
+        (url, title, teaser) tuples.
+
+        Only the hits up to the end of the requested page are collected,
+        and teasers are highlighted for the hits on that page alone,
+        reading just their texts from the snippet store. With
+        teasers=False nothing is highlighted and every teaser is None.
+        Pages are cached per query, page and index generation, so a
+        commit to the index invalidates them.
+        """
+        with SEARCH_SECONDS.time():
+            with self._search_lock:
+                return self._search(self.current_searcher(), query_str, page,
+                                    per_page, teasers)
+
+    def search_many(self, query_strs, page=1, per_page=DEFAULT_PER_PAGE, teasers=True):
+        """
+        Run several searches, see search(), and return their SearchPages.
+
+        The lock is taken and the searcher checked for changes once for
+        all of them, so every page comes from the same index generation.
+        """
+        with self._search_lock:
+            searcher = self.current_searcher()
+            pages = []
+            for query_str in query_strs:
+                with SEARCH_SECONDS.time():
+                    pages.append(self._search(searcher, query_str, page, per_page, teasers))
+            return pages
+
+    @staticmethod
+    def _set_highlighter(results):
+        results.fragmenter = highlight.ContextFragmenter(maxchars=200, surround=100)
+        results.formatter = highlight.HtmlFormatter(tagname="b", classname="highlight", termclass="term")
+
+    @staticmethod
+    def _hits(results, snippets, teasers):
+        """(url, title, teaser) tuples for some of a search's hits"""
+        if not teasers:
+            return [(hit['url'], hit.get('title', 'Untitled'), None) for hit in results]
+        with HIGHLIGHT_SECONDS.time():
+            if snippets is None:
+                # Texts are stored in the index (or nowhere, for teaser-less hits)
+                texts = {hit['url']: hit.get('content', '') for hit in results}
+            else:
+                texts = snippets.get_many(hit['url'] for hit in results)
+            return [
+                (hit['url'],
+                 hit.get('title', 'Untitled'),
+                 hit.highlights("content", text=texts.get(hit['url'], ''))
+                 )
+                    for hit in results]
+
+    def _search(self, searcher, query_str, page, per_page, teasers):
+        # Call with the search lock held
+        query_str = " ".join(query_str.split())
+        page = max(page, 1)
+        key = (query_str, page, per_page, teasers, self._dir,
+               searcher.reader().generation())
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        query = self.parse_query(query_str)
+        results = searcher.search_page(query, page, pagelen=per_page)
+        log.debug("Found %d results for %r", results.total, query_str)
+        self._set_highlighter(results.results)
+        hits = self._hits(results, self.snippets, teasers)
+        result = SearchPage(hits, results.total, max(results.pagenum, 1), per_page,
+                            self._generation_tag(searcher))
+        self.result_cache.put(key, result)
+        return result
+
+    def iter_results(self, query_str, teasers=False, chunk=100):
+        """
+        Yield (url, title, teaser) for every page matching the query, best
+        first, for exports too large for one SearchPage.
+
+        The hits are read `chunk` at a time from a searcher of their own,
+        so the export sees one generation throughout and doesn't hold up
+        other searches while its consumer reads. Nothing is cached.
+        """
+        with self._search_lock:
+            self.current_searcher()
+            ix, directory = self.ix, self._dir
+            query = self.parse_query(" ".join(query_str.split()))
+            searcher = self._weighted(ix.searcher())
+        snippets = None
+        try:
+            if teasers and not stores_content(ix):
+                snippets = self._open_snippets(ix, directory)
+            results = searcher.search(query, limit=None)
+            self._set_highlighter(results)
+            for start in range(0, len(results), chunk):
+                yield from self._hits(results[start:start + chunk], snippets, teasers)
+        finally:
+            if snippets is not None:
+                snippets.close()
+            searcher.close()
+
+    def cache_stats(self):
+        """Hit and miss counters of the search caches"""
+        return {
+            'query_cache': self.query_cache.stats(),
+            'result_cache': self.result_cache.stats(),
+            'searcher_refreshes': self.searcher_refreshes,
+        }
@@ -0,0 +1,160 @@
+import multiprocessing
+import queue
+import traceback
+import zlib
+
+from whoosh.filedb.filestore import FileStorage
+from whoosh.writing import SegmentWriter
+
+# Documents sent to a shard worker at once, and batches queued per worker
+# before add_document() waits for it to catch up
+BATCH_SIZE = 100
+QUEUED_BATCHES = 4
+# Seconds between checks that the workers are still alive
+POLL_INTERVAL = 1.0
+
+
+def shard_of(key, shards):
+    """The shard of a document key; stable across processes and runs"""
+    return zlib.crc32(key.encode('utf-8')) % shards
+
+
+def _write_shard(shard, folder, indexname, schema, jobs, results):
+    """
+    Worker process: add the batches of documents from `jobs` to a new
+    segment in the index directory, and report the segment, or the
+    error, on `results` once a None comes in.
+    """
+    try:
+        ix = FileStorage(folder).open_index(indexname)
+        # The parent's writer holds the lock, and may have added fields
+        writer = SegmentWriter(ix, _lk=False)
+        writer.schema = schema
+        while True:
+            batch = jobs.get()
+            if batch is None:
+                break
+            for fields in batch:
+                writer.add_document(**fields)
+        if writer.docnum:
+            segment = writer._finalize_segment()
+        else:
+            writer._close_segment()
+            segment = None
+        # The temporary directory is shared with the parent's writer,
+        # which removes it when it is done
+        results.put((shard, segment, None))
+    except BaseException:
+        results.put((shard, None, traceback.format_exc()))
+
+
+class ShardedWriter(SegmentWriter):
+    """
+    Index writer that analyzes documents on `shards` worker processes.
+
+    Documents are partitioned by a hash of their `key` field, so all
+    versions of a page go to the same worker, and each worker writes its
+    share into a segment of its own in the index directory. Tokenizing
+    and building postings, which is most of the cost of indexing,
+    therefore runs on as many cores as there are shards, while this
+    process holds the write lock, applies deletions and commits.
+
+    On commit the workers' segments join the index next to the existing
+    ones, and are searched together with them; the merge policy then
+    merges them like any other segments, and `commit(optimize=True)`
+    merges everything into one. Updating a document deletes earlier
+    versions in committed segments only, as whoosh's writer does.
+    Workers are spawned on the first document, so a writer that only
+    deletes costs nothing extra.
+    """
+
+    def __init__(self, ix, shards, key='url', batch_size=BATCH_SIZE, **kwargs):
+        super().__init__(ix, **kwargs)
+        self.shards = shards
+        self.key = key
+        self.batch_size = batch_size
+        self._batches = [[] for _ in range(shards)]
+        # (process, job queue) per shard, once started
+        self._workers = None
+        self._results = None
+
+    def _start_workers(self):
+        context = multiprocessing.get_context('spawn')
+        self._results = context.Queue()
+        self._workers = []
+        for shard in range(self.shards):
+            jobs = context.Queue(QUEUED_BATCHES)
+            process = context.Process(
+                target=_write_shard, daemon=True,
+                args=(shard, self.storage.folder, self.indexname, self.schema, jobs,
+                      self._results))
+            process.start()
+            self._workers.append((process, jobs))
+
+    def _put(self, shard, message):
+        process, jobs = self._workers[shard]
+        while True:
+            try:
+                jobs.put(message, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if not process.is_alive():
+                    raise RuntimeError(f"Shard worker {shard} exited with "
+                                       f"code {process.exitcode}")
+
+    def add_document(self, **fields):
+        self._check_state()
+        if self._workers is None:
+            self._start_workers()
+        shard = shard_of(fields[self.key], self.shards)
+        batch = self._batches[shard]
+        batch.append(fields)
+        if len(batch) >= self.batch_size:
+            self._put(shard, batch)
+            self._batches[shard] = []
+
+    def _finish_workers(self):
+        """Send the last batches, and return the workers' segments in shard order"""
+        if self._workers is None:
+            return []
+        for shard, batch in enumerate(self._batches):
+            if batch:
+                self._put(shard, batch)
+            self._put(shard, None)
+        self._batches = [[] for _ in range(self.shards)]
+
+        segments = {}
+        while len(segments) < self.shards:
+            try:
+                shard, segment, error = self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                for shard, (process, _) in enumerate(self._workers):
+                    # A worker that reported has exit code 0
+                    if shard not in segments and process.exitcode not in (None, 0):
+                        raise RuntimeError(f"Shard worker {shard} exited with "
+                                           f"code {process.exitcode}")
+                continue
+            if error is not None:
+                raise RuntimeError(f"Shard worker {shard} failed:\n{error}")
+            segments[shard] = segment
+        for process, _ in self._workers:
+            process.join()
+        self._workers = None
+        return [segments[shard] for shard in sorted(segments) if segments[shard] is not None]
+
+    def commit(self, mergetype=None, optimize=None, merge=None):
+        self._check_state()
+        # Appended after the existing segments, so the document numbers
+        # of pending deletions stay valid
+        self.segments = self.segments + self._finish_workers()
+        super().commit(mergetype, optimize, merge)
+
+    def cancel(self):
+        if self._workers is not None:
+            for process, _ in self._workers:
+                process.terminate()
+            for process, _ in self._workers:
+                process.join()
+            self._workers = None
+        # The next commit's clean-up removes any segment files they left
+        super().cancel()
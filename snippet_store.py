@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import zlib
+
+# File holding a generation's page texts, next to its Whoosh segments
+SNIPPET_FILE = 'snippets.db'
+
+
+class SnippetStore:
+    """
+    zlib-compressed page texts keyed by URL, for highlighting.
+
+    The search index does not store page content; teasers are built
+    from this store instead, reading only the pages being shown. The
+    store is an SQLite file in the index directory, so readers in other
+    processes can open it while a crawl writes. Writes become visible
+    when `commit()` is called.
+    """
+
+    def __init__(self, index_dir, readonly=False):
+        self.path = os.path.join(index_dir, SNIPPET_FILE)
+        if readonly:
+            # A read-only connection can't create the file by accident
+            uri = f"file:{self.path}?mode=ro"
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS snippets "
+                             "(url TEXT PRIMARY KEY, text BLOB NOT NULL)")
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, SNIPPET_FILE))
+
+    def put(self, url, text):
+        self._db.execute("INSERT OR REPLACE INTO snippets VALUES (?, ?)",
+                         (url, zlib.compress(text.encode('utf-8'))))
+
+    def delete(self, url):
+        self._db.execute("DELETE FROM snippets WHERE url = ?", (url,))
+
+    def get(self, url, default=""):
+        row = self._db.execute("SELECT text FROM snippets WHERE url = ?",
+                               (url,)).fetchone()
+        if row is None:
+            return default
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def get_many(self, urls):
+        """Return {url: text} for those of `urls` that are stored"""
+        urls = list(urls)
+        if not urls:
+            return {}
+        marks = ",".join("?" * len(urls))
+        rows = self._db.execute(
+            f"SELECT url, text FROM snippets WHERE url IN ({marks})", urls)
+        return {url: zlib.decompress(text).decode('utf-8') for url, text in rows}
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM snippets").fetchone()[0]
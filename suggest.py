@@ -0,0 +1,144 @@
+import heapq
+from bisect import bisect_left
+from collections import Counter
+
+# Suggestions returned unless the caller asks for another number
+DEFAULT_SUGGESTIONS = 10
+# Best suggestions are kept ready for every prefix up to this long: short
+# prefixes match much of the vocabulary, longer ones few enough terms
+# to rank on the fly
+PRECOMPUTED_PREFIX = 2
+# Terms shorter than this are never suggested
+MIN_TERM_LENGTH = 2
+
+
+def _top(weights, start, stop, limit):
+    """Indexes of the `limit` heaviest entries between start and stop"""
+    return heapq.nlargest(limit, range(start, stop), key=weights.__getitem__)
+
+
+class Suggester:
+    """
+    Prefix completions for the search box, from the index's own words.
+
+    Content terms are weighted by the number of pages containing them,
+    and page titles by the number of pages carrying them, so common
+    words and titles come first. All completions sit in one sorted list
+    of keys; the completions of a prefix are a contiguous slice of it,
+    found with two bisections. The best completions of short prefixes
+    are kept ready, so no lookup ranks more than a small slice.
+
+    Counts are kept per segment, and `update()` only reads the segments
+    that are new or had pages deleted since the last update; merging
+    the counts is all that is left to do for the rest. Whoosh keeps
+    counting a deleted page's terms until its segment is merged, so
+    term weights can run a little high in between; titles are exact.
+    """
+
+    def __init__(self, limit=DEFAULT_SUGGESTIONS):
+        self.limit = limit
+        # (segment id, deleted count) -> (term counts, title counts)
+        self._segments = {}
+        # Sorted lowercase keys, the text and weight of each, and the
+        # best entries of every short prefix; replaced as a whole, so
+        # lookups never need a lock
+        self._table = ([], [], [], {})
+
+    @staticmethod
+    def _count(segment_reader):
+        terms = Counter()
+        field = segment_reader.schema['content']
+        for term, info in segment_reader.iter_field('content'):
+            term = field.from_bytes(term)
+            if len(term) >= MIN_TERM_LENGTH and not term.isdigit():
+                terms[term] = info.doc_frequency()
+        titles = Counter(fields['title'] for fields in segment_reader.all_stored_fields()
+                         if fields.get('title'))
+        return terms, titles
+
+    def update(self, reader):
+        """
+        Catch up with an index reader; return whether anything changed.
+        Only the segments not seen before are read.
+        """
+        segments = {}
+        for segment_reader, _ in reader.leaf_readers():
+            if not hasattr(segment_reader, 'segment'):
+                # An empty index
+                continue
+            segment = segment_reader.segment()
+            key = (segment.segment_id(), segment.deleted_count())
+            if key in self._segments:
+                segments[key] = self._segments[key]
+            else:
+                segments[key] = self._count(segment_reader)
+        if segments.keys() == self._segments.keys():
+            return False
+        self._segments = segments
+        self._build()
+        return True
+
+    def _build(self):
+        terms, titles = Counter(), Counter()
+        for segment_terms, segment_titles in self._segments.values():
+            terms.update(segment_terms)
+            titles.update(segment_titles)
+        entries = {term: (term, count) for term, count in terms.items()}
+        for title, count in titles.items():
+            key = title.lower()
+            # A title that is also a term adds its pages to the term's
+            if key in entries:
+                count += entries[key][1]
+            entries[key] = (title, count)
+
+        keys = sorted(entries)
+        texts = [entries[key][0] for key in keys]
+        weights = [entries[key][1] for key in keys]
+        precomputed = {}
+        for length in range(1, PRECOMPUTED_PREFIX + 1):
+            for prefix in {key[:length] for key in keys if len(key) >= length}:
+                start, stop = self._range(keys, prefix)
+                precomputed[prefix] = _top(weights, start, stop, self.limit)
+        self._table = (keys, texts, weights, precomputed)
+
+    @staticmethod
+    def _range(keys, prefix):
+        start = bisect_left(keys, prefix)
+        # Every key with the prefix sorts before the prefix followed by
+        # the highest code point
+        return start, bisect_left(keys, prefix + '\U0010ffff', start)
+
+    def complete(self, prefix, limit=None):
+        """Return up to `limit` (completion, weight) pairs, heaviest first"""
+        limit = limit or self.limit
+        keys, texts, weights, precomputed = self._table
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        ready = precomputed.get(prefix) if limit <= self.limit else None
+        if ready is not None:
+            best = ready[:limit]
+        else:
+            start, stop = self._range(keys, prefix)
+            best = _top(weights, start, stop, limit)
+        return [(texts[i], weights[i]) for i in best]
+
+    def suggest(self, query, limit=None):
+        """
+        Suggestions for what is being typed into the search box, as
+        (text, weight) pairs: titles starting with the query, and the
+        query with its last word completed.
+        """
+        limit = limit or self.limit
+        words = query.split()
+        if not words:
+            return []
+        suggestions = dict(self.complete(" ".join(words), limit))
+        if len(words) > 1:
+            head = " ".join(words[:-1])
+            for term, weight in self.complete(words[-1], limit):
+                suggestions.setdefault(f"{head} {term}", weight)
+        return heapq.nlargest(limit, suggestions.items(), key=lambda item: item[1])
+
+    def __len__(self):
+        return len(self._table[0])
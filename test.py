@@ -1,8 +1,36 @@
 import unittest
 from crawler import WebCrawler
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from frontier import Frontier, normalize_url
+from checkpoint import save_checkpoint, load_checkpoint
+from politeness import HostScheduler, RobotsCache
+from fetcher import SkippedPage, fetch_page, has_binary_extension, make_session
+from parsing import parse_page, parse_document, available_backends, extract_fields
+from dedup import DuplicateIndex, minhash, similarity
+from compact_index import CompactIndex, gallop, intersect
+import link_graph
+from link_graph import GRAPH_FILE, LinkGraph, LinkGraphBuilder, pagerank
+from ranking import BM25
+import random
+from types import SimpleNamespace
+from whoosh.index import LockError, EmptyIndexError, create_in, open_dir
+import whoosh_crawler
+from search_index import (SearchIndex, live_dir, migrate, make_schema, stage_generation,
+                          publish_generation)
+from maintenance import (TieredMerge, MERGE_POLICIES, segment_stats,
+                         optimize_due, optimize)
+from metrics import PAGES_FETCHED, Registry, SamplingProfiler
+from suggest import Suggester
+from shard_writer import ShardedWriter, shard_of
+import app as search_app
+import manage
+import json
+from http.server import HTTPServer, BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+import gzip
 import threading
+import tempfile
+import shutil
 import os
+import time
 
 # Create simple test HTML files
 TEST_PAGES = {
@@ -33,7 +61,7 @@ TEST_PAGES = {
     """
 }
 
-class TestWebCrawler(unittest.TestCase):
+class TestServerMixin:
     @classmethod
     def setUpClass(cls):
         # Create test HTML files
@@ -58,7 +86,9 @@ class TestWebCrawler(unittest.TestCase):
         cls.server.server_close()
         for filename in TEST_PAGES.keys():
             os.remove(filename)
-    
+
+
+class TestWebCrawler(TestServerMixin, unittest.TestCase):
     def setUp(self):
         self.crawler = WebCrawler(self.base_url + 'index.html')
         self.crawler.crawl()
@@ -89,10 +119,1126 @@ class TestWebCrawler(unittest.TestCase):
         results2 = self.crawler.search(['python'])
         self.assertEqual(results1, results2)
     
+    def test_search_does_not_modify_index(self):
+        """Test that looking up unknown words adds nothing to the index"""
+        terms = len(self.crawler.index)
+        self.crawler.search(['python', 'nonexistent'])
+        self.assertEqual(len(self.crawler.index), terms)
+    
     def test_empty_search(self):
         """Test searching with empty list"""
         results = self.crawler.search([])
         self.assertEqual(results, [])
 
+    def test_every_backend(self):
+        """Test that every parser backend crawls and indexes the same"""
+        for backend in available_backends():
+            crawler = WebCrawler(self.base_url + 'index.html', parser=backend)
+            crawler.crawl()
+            self.assertEqual(crawler.visited_urls, self.crawler.visited_urls)
+            self.assertEqual(crawler.search(['python']), self.crawler.search(['python']))
+        with self.assertRaises(ValueError):
+            WebCrawler(self.base_url + 'index.html', parser='regex')
+        with self.assertRaises(ValueError):
+            whoosh_crawler.WebCrawler(self.base_url + 'index.html', parser='regex')
+
+    def test_saved_index(self):
+        """Test that a saved index answers searches without crawling"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.bin')
+            self.crawler.save_index(path)
+            crawler = WebCrawler(self.base_url + 'index.html')
+            crawler.load_index(path)
+            self.assertEqual(crawler.rank(['python', 'web'], match_all=False),
+                             self.crawler.rank(['python', 'web'], match_all=False))
+            self.assertEqual(crawler.page_titles, self.crawler.page_titles)
+
+class TestFrontier(unittest.TestCase):
+    def test_normalize_url(self):
+        """Test that equivalent URLs normalize to the same string"""
+        self.assertEqual(normalize_url('HTTP://Example.com:80/a/?b=2&a=1#top'),
+                         'http://example.com/a?a=1&b=2')
+        self.assertEqual(normalize_url('https://example.com:443'),
+                         'https://example.com/')
+        self.assertEqual(normalize_url('http://example.com:8080/'),
+                         'http://example.com:8080/')
+        self.assertEqual(normalize_url('http://example.com/a;jsessionid=F00?'
+                                       'utm_source=feed&id=3&PHPSESSID=1'),
+                         'http://example.com/a?id=3')
+        self.assertEqual(normalize_url('http://[::1]:8000/a?x&b=1'),
+                         'http://[::1]:8000/a?b=1&x')
+
+    def test_queues_url_as_found(self):
+        """Test that the URL handed out keeps its trailing slash for resolving links"""
+        frontier = Frontier()
+        frontier.add('http://example.com/docs/#top')
+        self.assertFalse(frontier.add('http://example.com/docs'))
+        self.assertEqual(frontier.pop(), ('http://example.com/docs/', 0))
+
+    def test_deduplicates_at_enqueue(self):
+        """Test that a URL is only queued once"""
+        frontier = Frontier()
+        self.assertTrue(frontier.add('http://example.com/a'))
+        self.assertFalse(frontier.add('http://example.com/a#section'))
+        self.assertEqual(len(frontier), 1)
+        self.assertEqual(frontier.pop(), ('http://example.com/a', 0))
+        self.assertFalse(frontier.add('http://example.com/a'))
+        self.assertEqual(frontier.stats(), {
+            'size': 0, 'seen': 1, 'hosts': 0, 'enqueued': 1, 'dequeued': 1,
+            'duplicates': 2})
+
+    def test_interleaves_hosts(self):
+        """Test that hosts take turns, each in its own queue order"""
+        frontier = Frontier()
+        frontier.extend(['http://a.com/1', 'http://a.com/2', 'http://a.com/3',
+                         'http://b.com/1', 'http://c.com/1'])
+        self.assertEqual([frontier.pop()[0] for _ in range(5)], [
+            'http://a.com/1', 'http://b.com/1', 'http://c.com/1',
+            'http://a.com/2', 'http://a.com/3'])
+
+    def test_by_depth(self):
+        """Test that shallow URLs come out first in depth order"""
+        frontier = Frontier(by_depth=True)
+        frontier.add('http://example.com/deep', 3)
+        frontier.add('http://example.com/shallow', 1)
+        frontier.add('http://example.com/shallow2', 1)
+        self.assertEqual([frontier.pop()[0] for _ in range(3)], [
+            'http://example.com/shallow', 'http://example.com/shallow2',
+            'http://example.com/deep'])
+
+
+class TestPoliteness(unittest.TestCase):
+    def robots(self, status, text=''):
+        def fetch(url, **kwargs):
+            self.fetched.append(url)
+            return SimpleNamespace(status_code=status, text=text)
+        self.fetched = []
+        return RobotsCache(fetch)
+
+    def test_robots_rules(self):
+        """Test that robots.txt is fetched once per host and obeyed"""
+        robots = self.robots(200, "User-agent: *\nDisallow: /private\nCrawl-delay: 2\n")
+        self.assertFalse(robots.allowed('http://example.com/private/page'))
+        self.assertTrue(robots.allowed('http://example.com/public'))
+        self.assertEqual(robots.crawl_delay('http://example.com/'), 2.0)
+        self.assertEqual(self.fetched, ['http://example.com/robots.txt'])
+
+        scheduler = HostScheduler(rate=10, robots=robots)
+        scheduler.acquire('http://example.com/a')
+        self.assertEqual(scheduler.stats()['http://example.com']['interval'], 2.0)
+
+    def test_robots_missing_or_forbidden(self):
+        """Test that a missing robots.txt allows all, a forbidden one nothing"""
+        self.assertTrue(self.robots(404).allowed('http://example.com/a'))
+        self.assertFalse(self.robots(403).allowed('http://example.com/a'))
+
+    def test_token_bucket(self):
+        """Test that each host gets `burst` requests, then one per interval"""
+        scheduler = HostScheduler(rate=10, burst=2)
+        self.assertEqual(scheduler.acquire('http://a.com/1'), 0)
+        self.assertEqual(scheduler.acquire('http://a.com/2'), 0)
+        self.assertAlmostEqual(scheduler.acquire('http://a.com/3'), 0.1, places=2)
+        # Other hosts are not held up
+        self.assertEqual(scheduler.acquire('http://b.com/1'), 0)
+
+    def test_backoff(self):
+        """Test that 429 slows a host down and healthy responses speed it up"""
+        scheduler = HostScheduler(rate=10, burst=2)
+        scheduler.record('http://a.com/1', 429, 0.01, wait=3)
+        scheduler.record('http://a.com/2', 429, 0.01)
+        # Requests already in flight don't compound the backoff
+        self.assertEqual(scheduler.stats()['http://a.com']['interval'], 0.5)
+        self.assertGreater(scheduler.acquire('http://a.com/3'), 2.5)
+        for _ in range(10):
+            scheduler.record('http://a.com/1', 200, 0.01)
+        self.assertAlmostEqual(scheduler.stats()['http://a.com']['interval'], 0.1)
+
+    def test_latency_slowdown(self):
+        """Test that a slow host is slowed down once per interval, if paced"""
+        scheduler = HostScheduler(rate=10)
+        unpaced = HostScheduler(rate=None)
+        for s in (scheduler, unpaced):
+            s.record('http://a.com/1', 200, 0.01)
+            for _ in range(5):
+                s.record('http://a.com/1', 200, 1.0)
+        self.assertAlmostEqual(scheduler.stats()['http://a.com']['interval'], 0.15)
+        self.assertEqual(unpaced.stats()['http://a.com']['interval'], 0.0)
+
+
+class FetchHandler(BaseHTTPRequestHandler):
+    """Serves the odd responses fetch_page has to cope with"""
+    requests = []
+
+    def respond(self, body):
+        self.requests.append((self.command, self.path))
+        content_type = 'text/html; charset=utf-8'
+        headers = {}
+        if self.path == '/page.html':
+            body = gzip.compress('<p>gezippt café</p>'.encode('utf-8'))
+            headers['Content-Encoding'] = 'gzip'
+        elif self.path == '/latin.html':
+            content_type = 'text/html'
+            body = '<meta charset="iso-8859-1"><p>café</p>'.encode('latin-1')
+        elif self.path == '/big.html':
+            body = b'<p>' + b'x' * 5000 + b'</p>'
+        elif self.path == '/data.dat':
+            content_type = 'application/octet-stream'
+            body = b'\0' * 5000
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if self.path != '/big.html':
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.respond(b'')
+
+    def do_HEAD(self):
+        self.respond(b'')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('localhost', 0), FetchHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://localhost:{cls.server.server_port}'
+        cls.session = make_session()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FetchHandler.requests.clear()
+
+    def test_decodes_gzip_and_charsets(self):
+        """Test that bodies are decompressed and decoded with their charset"""
+        page = fetch_page(self.session, self.base_url + '/page.html')
+        self.assertEqual(page.text, '<p>gezippt café</p>')
+        page = fetch_page(self.session, self.base_url + '/latin.html')
+        self.assertIn('café', page.text)
+
+    def test_size_limit(self):
+        """Test that pages over the limit are skipped, with or without a length"""
+        with self.assertRaises(SkippedPage):
+            fetch_page(self.session, self.base_url + '/big.html', max_bytes=1000)
+        with self.assertRaises(SkippedPage):
+            fetch_page(self.session, self.base_url + '/data.dat', max_bytes=1000)
+
+    def test_content_type_checked_before_body(self):
+        """Test that a HEAD check keeps non-HTML bodies from being downloaded"""
+        with self.assertRaises(SkippedPage):
+            fetch_page(self.session, self.base_url + '/data.dat', head_check=True)
+        self.assertEqual(FetchHandler.requests, [('HEAD', '/data.dat')])
+        # HTML extensions go straight to GET
+        fetch_page(self.session, self.base_url + '/page.html', head_check=True)
+        self.assertEqual(FetchHandler.requests[-1], ('GET', '/page.html'))
+
+    def test_binary_extensions(self):
+        """Test that links to binary files are recognised before queueing"""
+        self.assertTrue(has_binary_extension('http://example.com/report.PDF'))
+        self.assertTrue(has_binary_extension('http://example.com/a/photo.jpg?size=2'))
+        self.assertFalse(has_binary_extension('http://example.com/pdf/index.html'))
+        self.assertFalse(has_binary_extension('http://example.com/about'))
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_round_trip(self):
+        """Test that a saved checkpoint restores frontier and visited set"""
+        frontier = Frontier()
+        frontier.extend(['http://example.com/a', 'http://example.com/b'], 1)
+        frontier.add('http://example.com/skipped.pdf')
+        frontier.pop()
+        visited = {'http://example.com/'}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state.ckpt')
+            save_checkpoint(path, frontier, visited,
+                            in_flight=[('http://example.com/c', 2)])
+            restored, restored_visited = load_checkpoint(path)
+        self.assertEqual(sorted(restored), [
+            ('http://example.com/b', 1), ('http://example.com/c', 2),
+            ('http://example.com/skipped.pdf', 0)])
+        self.assertEqual(restored_visited, visited)
+        self.assertIn('http://example.com/a', restored)
+
+
+class TestParsing(unittest.TestCase):
+    def test_backends_agree(self):
+        """Test that every installed parser backend extracts the same page"""
+        html = ('<html><head><title> Title </title><script>var x;</script></head>'
+                '<body><p>Hello <b>world</b></p><a href="a.html">A</a></body></html>')
+        for backend in available_backends():
+            self.assertEqual(parse_page(html, 'http://example.com/dir/', backend),
+                             ('Title', 'Title Hello world A',
+                              ['http://example.com/dir/a.html']))
+
+
+    def test_nested_text_counted_once(self):
+        """Test that text in nested containers is extracted once"""
+        html = ('<title>Page</title>' + '<div>' * 10 + '<h2>Intro</h2>'
+                '<p>python <a href="x.html">link</a></p>' + '</div>' * 10 +
+                '<article>web</article>')
+        for backend in available_backends():
+            fields, links = extract_fields(html, 'http://example.com/', backend)
+            self.assertEqual(fields, {'title': 'Page', 'headings': 'Intro',
+                                      'main': 'web', 'body': 'python link'})
+            self.assertEqual(links, ['http://example.com/x.html'])
+        with self.assertRaises(ValueError):
+            extract_fields(html, 'http://example.com/', 'regex')
+
+        crawler = WebCrawler('http://example.com/', region_weights={'title': 3})
+        self.assertEqual(crawler.count_words(fields), {
+            'page': 3, 'intro': 1, 'web': 1, 'python': 1, 'link': 1})
+
+
+    def test_canonical_link(self):
+        """Test that rel=canonical is found by every backend"""
+        html = ('<head><link rel="alternate" href="/feed">'
+                '<link rel="Canonical" href="/article?id=1"></head><p>Text</p>')
+        for backend in available_backends():
+            self.assertEqual(parse_document(html, 'http://example.com/print', backend)[3],
+                             'http://example.com/article?id=1')
+            self.assertIsNone(parse_document('<p>Text</p>', 'http://example.com/',
+                                             backend)[3])
+
+
+def article(seed, words=300):
+    """A page worth of made-up words, the same for the same seed"""
+    rng = random.Random(seed)
+    return ' '.join(f"word{rng.randrange(2000)}" for _ in range(words))
+
+
+class TestDedup(unittest.TestCase):
+    def test_minhash_similarity(self):
+        """Test that MinHash tells near-duplicates from different texts"""
+        text = article(1)
+        words = text.split()
+        words[150] = 'changed'
+        near = 'Printed on 1 May ' + ' '.join(words)
+        self.assertEqual(similarity(minhash(text), minhash(text)), 1.0)
+        self.assertGreater(similarity(minhash(text), minhash(near)), 0.8)
+        self.assertLess(similarity(minhash(text), minhash(article(2))), 0.2)
+        self.assertIsNone(minhash(''))
+        self.assertIsNone(minhash('Home news help'))
+
+    def test_duplicate_index(self):
+        """Test that only near-duplicates other than the page itself are found"""
+        index = DuplicateIndex()
+        index.add('a', minhash(article(1)))
+        index.add('b', minhash(article(2)))
+        self.assertEqual(index.find(minhash(article(1) + ' footer')), 'a')
+        self.assertIsNone(index.find(minhash(article(1)), exclude='a'))
+        self.assertIsNone(index.find(minhash(article(3))))
+        index.remove('a')
+        self.assertIsNone(index.find(minhash(article(1))))
+        self.assertEqual(len(index), 1)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        """Test the Prometheus text format of counters and histograms"""
+        registry = Registry()
+        pages = registry.counter('pages_total', "Pages")
+        seconds = registry.histogram('seconds', "Time", buckets=(0.1, 1.0))
+        pages.inc(3)
+        for value in (0.05, 0.5, 5):
+            seconds.observe(value)
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE pages_total counter", lines)
+        self.assertIn("pages_total 3", lines)
+        self.assertIn('seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("seconds_sum 5.55", lines)
+
+    def test_sampling_profiler(self):
+        """Test that the profiler sees the function the thread is running"""
+        def busy_loop():
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                pass
+        profiler = SamplingProfiler(interval=0.001).start()
+        busy_loop()
+        profiler.stop()
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('busy_loop', profiler.collapsed())
+
+
+class TestCompactIndex(unittest.TestCase):
+    def test_postings_across_compactions(self):
+        """Test that postings stay sorted and complete across both tiers"""
+        index = CompactIndex()
+        index.add_document('http://example.com/a', {'python': 2, 'web': 1})
+        index.add_document('http://example.com/b', {'web': 300})
+        index.compact()
+        index.add_document('http://example.com/c', {'python': 1})
+        self.assertEqual(list(index.postings('python')[0]), [0, 2])
+        self.assertEqual(index.terms(), ['python', 'web'])
+        index.compact()
+
+        self.assertEqual(list(index.postings('python')[0]), [0, 2])
+        self.assertEqual(list(index.postings('python')[1]), [2, 1])
+        self.assertEqual(index.frequency('web', 'http://example.com/b'), 300)
+        self.assertEqual(index.frequency('web', 'http://example.com/c'), 0)
+        self.assertEqual(index.doc_frequency('missing'), 0)
+        self.assertNotIn('missing', index)
+        self.assertEqual(index.posting_count(), 4)
+
+    def test_save_and_load(self):
+        """Test that a mapped index answers like the one that was saved"""
+        index = CompactIndex()
+        index.add_document('http://example.com/a', {'python': 2, 'café': 1})
+        index.compact()
+        index.add_document('http://example.com/b', {'python': 1, 'web': 70000})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'index.bin')
+            index.save(path, {'titles': {'http://example.com/a': 'A'}})
+            loaded = CompactIndex.load(path)
+
+            self.assertEqual(list(loaded.terms()), ['café', 'python', 'web'])
+            self.assertEqual(list(loaded.postings('python')[0]), [0, 1])
+            self.assertEqual(loaded.frequency('web', 'http://example.com/b'), 70000)
+            self.assertEqual(list(loaded.match_all(['python', 'café'])), [0])
+            self.assertEqual(BM25(loaded).top_k(['python', 'web'], match_all=False),
+                             BM25(index).top_k(['python', 'web'], match_all=False))
+            self.assertEqual(loaded.metadata['titles'], {'http://example.com/a': 'A'})
+
+            # Adding to a loaded index leaves the file alone
+            loaded.add_document('http://example.com/c', {'web': 1})
+            self.assertEqual(list(loaded.postings('web')[0]), [1, 2])
+            self.assertEqual(len(CompactIndex.load(path).urls), 2)
+
+    def test_gallop(self):
+        """Test that galloping finds the first position >= target"""
+        seq = [1, 3, 5, 7, 9, 11, 13]
+        for lo in range(len(seq)):
+            for target in range(15):
+                expected = next((i for i in range(lo, len(seq)) if seq[i] >= target),
+                                len(seq))
+                self.assertEqual(gallop(seq, target, lo), expected)
+
+    def test_intersect(self):
+        """Test intersection of short and long sorted postings"""
+        long_list = list(range(0, 10000, 3))
+        self.assertEqual(list(intersect([long_list, [3, 4, 9, 9999]])), [3, 9, 9999])
+        self.assertEqual(list(intersect([long_list, list(range(0, 10000, 2))])),
+                         list(range(0, 10000, 6)))
+        self.assertEqual(list(intersect([long_list, [], [3]])), [])
+
+
+class TestLinkGraph(unittest.TestCase):
+    def build(self):
+        builder = LinkGraphBuilder()
+        builder.add_page('hub', ['a', 'b', 'hub', 'a'])
+        builder.add_page('a', ['b'])
+        builder.add_page('b', ['elsewhere'])
+        builder.add_page('c', ['hub'])
+        builder.add_page('gone', ['hub'])
+        builder.remove_page('gone')
+        # Pages added again keep only their new links
+        builder.add_page('a', ['hub'])
+        builder.add_page('b', ['hub'])
+        return builder
+
+    def test_build(self):
+        """Test that the graph holds the latest links between kept pages"""
+        graph = self.build().build()
+        self.assertEqual(list(graph.urls), ['a', 'b', 'c', 'hub'])
+        self.assertEqual([list(graph.links(page)) for page in range(len(graph))],
+                         [[3], [3], [3], [0, 1]])
+
+    def test_pagerank(self):
+        """Test that PageRank favours linked pages, with or without NumPy"""
+        graph = self.build().build()
+        ranks = pagerank(graph.offsets, graph.targets)
+        self.assertAlmostEqual(sum(ranks), 1.0)
+        self.assertEqual(max(range(4), key=ranks.__getitem__), 3)
+        self.assertLess(ranks[2], ranks[0])
+        if link_graph.np is not None:
+            numpy = link_graph.np
+            link_graph.np = None
+            try:
+                for expected, rank in zip(ranks, pagerank(graph.offsets, graph.targets)):
+                    self.assertAlmostEqual(expected, rank)
+            finally:
+                link_graph.np = numpy
+
+    def test_save_load_and_replay(self):
+        """Test the saved graph and the links saved at checkpoints"""
+        graph = self.build().build()
+        scores = list(graph.rank())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, GRAPH_FILE)
+            graph.save(path)
+            loaded = LinkGraph.load(path)
+            self.assertEqual(list(loaded.urls), list(graph.urls))
+            self.assertEqual(list(loaded.targets), list(graph.targets))
+            self.assertEqual(list(loaded.scores), scores)
+            self.assertEqual(loaded.score('hub'), scores[3])
+            self.assertEqual(loaded.score('missing'), 1.0)
+            self.assertEqual(list(loaded.scores_of(['a', 'b2', 'hub'])),
+                             [scores[0], 1.0, scores[3]])
+
+            log_path = os.path.join(tmp, 'links.log')
+            builder = LinkGraphBuilder.from_graph(loaded)
+            builder.add_page('d', ['a'])
+            builder.save_batches(log_path)
+            builder.add_page('a', ['d'])
+            builder.save_batches(log_path)
+            resumed = LinkGraphBuilder.from_graph(loaded)
+            resumed.replay(log_path)
+            self.assertEqual(list(resumed.build().targets),
+                             list(builder.build().targets))
+            self.assertEqual(len(resumed), 5)
+
+
+class TestBM25(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.index = CompactIndex()
+        for page in range(300):
+            words = rng.choices(['a', 'b', 'c', 'd', 'e', 'f'], [30, 20, 10, 5, 2, 1], k=20)
+            self.index.add_document(f'http://example.com/{page}',
+                                    {word: words.count(word) for word in set(words)})
+        self.index.compact()
+        self.scorer = BM25(self.index)
+
+    def exhaustive(self, words, k, match_all):
+        """Score every document and sort, the result pruning must match"""
+        scores = {}
+        for doc_id in range(len(self.index.urls)):
+            matched = [w for w in words if self.index.frequency(w, self.index.urls[doc_id])]
+            if not matched or (match_all and len(matched) < len(words)):
+                continue
+            scores[doc_id] = sum(
+                self.scorer._score(self.scorer.term(w)[0],
+                                   self.index.frequency(w, self.index.urls[doc_id]), doc_id)
+                for w in sorted(matched))
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+    def test_top_k_matches_exhaustive_scoring(self):
+        """Test that pruned top-k retrieval returns the exact top k"""
+        for words in (['a'], ['a', 'f'], ['c', 'd', 'e'], ['a', 'b', 'c', 'x']):
+            for match_all in (True, False):
+                for k in (1, 5, 50):
+                    expected = self.exhaustive(words, k, match_all)
+                    actual = self.scorer.top_k(words, k, match_all)
+                    # Equal scores may be summed in a different order, so
+                    # compare scores rather than the order of tied documents
+                    all_scores = dict(self.exhaustive(words, 1000, match_all))
+                    self.assertEqual(len(actual), len(expected))
+                    for (doc, score), (_, expected_score) in zip(actual, expected):
+                        self.assertAlmostEqual(score, expected_score)
+                        self.assertAlmostEqual(score, all_scores[doc])
+
+    def test_rank_prefers_frequent_terms(self):
+        """Test that a page repeating a word ranks above one mentioning it"""
+        crawler = WebCrawler('http://example.com/')
+        crawler.index.add_document('http://example.com/once', {'python': 1, 'web': 5})
+        crawler.index.add_document('http://example.com/often', {'python': 5, 'web': 1})
+        self.assertEqual(crawler.search(['python']),
+                         ['http://example.com/often', 'http://example.com/once'])
+        self.assertEqual(crawler.search(['python'], limit=1), ['http://example.com/often'])
+
+
+class TestWhooshCrawler(TestServerMixin, unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.crawler = whoosh_crawler.WebCrawler(
+            self.base_url + 'index.html', self.index_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_async_crawl_matches_sequential(self):
+        """Test that the async crawl indexes the same pages"""
+        self.crawler.crawl_async(concurrency=4, per_host=2, parse_workers=1)
+        self.assertEqual(len(self.crawler.visited_urls), len(TEST_PAGES))
+        results = self.crawler.search('python')
+        self.assertEqual(len(results), 2)
+
+    def test_async_commit_failure(self):
+        """Test that a failed final commit fails the crawl and publishes nothing"""
+        self.crawler.crawl()
+        live = live_dir(self.index_dir)
+        def commit(writer):
+            raise OSError("disk full")
+        self.crawler.commit = commit
+        with self.assertRaises(OSError):
+            self.crawler.rebuild(use_async=True, parse_workers=0)
+        self.assertEqual(live_dir(self.index_dir), live)
+        # The failed writer let go of the lock
+        self.crawler.cancel(self.crawler.open_writer())
+
+    def test_async_setup_failure(self):
+        """Test that a crawl failing before it starts leaves the lock free"""
+        self.crawler.crawl()
+        def load_links():
+            raise OSError("corrupt links log")
+        self.crawler.load_links = load_links
+        with self.assertRaises(OSError):
+            self.crawler.crawl_async(parse_workers=0)
+        self.crawler.cancel(self.crawler.open_writer())
+
+    def test_crawl_metrics(self):
+        """Test that a crawl counts the pages it fetched"""
+        before = PAGES_FETCHED.value
+        self.crawler.crawl()
+        self.assertEqual(PAGES_FETCHED.value - before, len(TEST_PAGES))
+
+    def test_paged_search(self):
+        """Test that search returns one page of hits and the total"""
+        self.crawler.crawl()
+        first = self.crawler.search('about', page=1, per_page=2)
+        second = self.crawler.search('about', page=2, per_page=2)
+        self.assertEqual((len(first), first.total, first.page_count), (2, 3, 2))
+        self.assertTrue(first.has_next)
+        self.assertEqual((len(second), second.offset), (1, 2))
+        self.assertFalse(second.has_next)
+        urls = {url for url, _, _ in first} | {url for url, _, _ in second}
+        self.assertEqual(len(urls), 3)
+
+    def test_search_index_is_read_only(self):
+        """Test that SearchIndex needs a built index and never locks"""
+        empty_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, empty_dir)
+        with self.assertRaises(EmptyIndexError):
+            SearchIndex(empty_dir)
+        self.assertEqual(os.listdir(empty_dir), [])
+
+        self.crawler.crawl()
+        reader = SearchIndex(self.index_dir)
+        self.assertEqual(reader.search('python').total, 2)
+        self.assertEqual(reader.index_status()['documents'], len(TEST_PAGES))
+        # The writer lock is still free for the build job
+        self.crawler.commit(self.crawler.open_writer())
+
+    def test_rebuild_swaps_generation(self):
+        """Test that readers keep their snapshot until a rebuild is published"""
+        self.crawler.crawl()
+        reader = SearchIndex(self.index_dir, refresh_interval=0)
+        before = reader.index_status()['directory']
+
+        # A search during the rebuild still sees the old generation
+        searched = []
+        real_crawl = self.crawler.crawl
+        def crawl(timeout):
+            real_crawl(timeout)
+            searched.append(reader.search('python').total)
+        self.crawler.crawl = crawl
+        self.crawler.rebuild()
+
+        self.assertEqual(searched, [2])
+        self.assertNotEqual(reader.index_status()['directory'], before)
+        self.assertEqual(reader.search('python').total, 2)
+        self.assertEqual(reader.index_status()['documents'], len(TEST_PAGES))
+
+    def test_publish_keeps_running_builds(self):
+        """Test that publishing never removes a generation still being written"""
+        running = stage_generation(self.index_dir)
+        build = open_dir(running).writer()
+        try:
+            generations = []
+            for _ in range(3):
+                generations.append(stage_generation(self.index_dir))
+                publish_generation(self.index_dir, generations[-1])
+            self.assertTrue(os.path.isdir(running))
+            self.assertFalse(os.path.isdir(generations[0]))
+
+            # A published generation someone still writes to stays as well
+            optimizing = open_dir(generations[1]).writer()
+            publish_generation(self.index_dir, stage_generation(self.index_dir))
+            self.assertTrue(os.path.isdir(generations[1]))
+            optimizing.cancel()
+            publish_generation(self.index_dir, stage_generation(self.index_dir))
+            self.assertFalse(os.path.isdir(generations[1]))
+            self.assertTrue(os.path.isdir(running))
+        finally:
+            build.cancel()
+
+    def test_lean_schema_snippets(self):
+        """Test that teasers come from the snippet store, not stored content"""
+        self.crawler.crawl()
+        reader = SearchIndex(self.index_dir)
+        self.assertFalse(reader.ix.schema['content'].stored)
+        self.assertEqual(len(reader.snippets), len(TEST_PAGES))
+        teasers = [teaser for _, _, teaser in reader.search('python')]
+        self.assertTrue(all('<b class="highlight' in teaser for teaser in teasers))
+
+    def test_migrate_debug_index(self):
+        """Test that migrating moves stored content into the snippet store"""
+        debug_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, debug_dir)
+        crawler = whoosh_crawler.WebCrawler(self.base_url + 'index.html',
+                                            debug_dir, profile='debug')
+        crawler.crawl()
+        before = SearchIndex(debug_dir).search('python')
+
+        self.assertEqual(migrate(debug_dir), len(TEST_PAGES))
+        self.assertIsNone(migrate(debug_dir))
+        after = SearchIndex(debug_dir).search('python')
+        self.assertEqual(list(after), list(before))
+
+    def test_skips_duplicates(self):
+        """Test that tracking URLs, canonical copies and near-duplicates are skipped"""
+        pages = {
+            'dups.html': '<a href="story.html?utm_source=feed">A</a>'
+                         '<a href="story.html">B</a><a href="print.html">C</a>'
+                         '<a href="copy.html">D</a><a href="other.html">E</a>'
+                         '<a href="contact.html">F</a><a href="about.html">G</a>'
+                         '<a href="empty.html">H</a><a href="blank.html">I</a>',
+            'story.html': '<p>%s</p>' % article(1),
+            'print.html': ('<link rel="canonical" href="story.html">'
+                           '<p>Print view %s</p>' % article(1)),
+            'copy.html': '<p>Copied %s</p>' % article(1),
+            'other.html': '<p>%s</p>' % article(2),
+            # Too little text to call them copies of each other
+            'contact.html': '<p>Home news help</p>',
+            'about.html': '<p>Home news help</p>',
+            'empty.html': '<img src="photo.jpg">',
+            'blank.html': '',
+        }
+        for name, html in pages.items():
+            with open(name, 'w') as f:
+                f.write(html)
+            self.addCleanup(os.remove, name)
+
+        crawler = whoosh_crawler.WebCrawler(self.base_url + 'dups.html', self.index_dir)
+        crawler.crawl()
+        with crawler.ix.searcher() as searcher:
+            urls = sorted(fields['url'] for fields in searcher.all_stored_fields())
+        self.assertEqual(urls, [self.base_url + name for name in
+                                ('about.html', 'blank.html', 'contact.html', 'dups.html',
+                                 'empty.html', 'other.html', 'story.html')])
+        self.assertEqual(crawler.dedup_stats, {'canonical': 1, 'near_duplicate': 1})
+
+    def test_link_graph(self):
+        """Test that the crawl ranks pages by links and search uses it"""
+        self.crawler.crawl()
+        graph = LinkGraph.load(os.path.join(live_dir(self.index_dir), GRAPH_FILE))
+        self.assertEqual(len(graph), len(TEST_PAGES))
+        self.assertEqual(graph.edge_count, 4)
+        index_url = self.base_url + 'index.html'
+        self.assertEqual(max(graph.urls, key=graph.score), index_url)
+
+        # 'about' is on every page; the page all others link to wins
+        # once links count enough
+        boosted = SearchIndex(self.index_dir, link_weight=5)
+        self.assertEqual(boosted.search('about')[0][0], index_url)
+        plain = SearchIndex(self.index_dir, link_weight=0)
+        self.assertNotEqual(plain.search('about')[0][0], index_url)
+
+    def test_search_cache(self):
+        """Test that repeated searches hit the cache until the index changes"""
+        self.crawler.crawl()
+        first = self.crawler.search('python')
+        self.assertIs(self.crawler.search('  python '), first)
+        self.assertEqual(self.crawler.cache_stats()['result_cache']['hits'], 1)
+
+        writer = self.crawler.open_writer()
+        writer.add_document(url=self.base_url + 'new.html', content='python')
+        self.crawler.commit(writer)
+        self.assertEqual(self.crawler.search('python').total, 3)
+        self.assertEqual(self.crawler.cache_stats()['searcher_refreshes'], 1)
+
+    def test_resume_from_checkpoint(self):
+        """Test that a crawl with a checkpoint only fetches what is left"""
+        self.crawler.crawl()
+        frontier = Frontier()
+        frontier.extend([self.base_url + 'index.html',
+                         self.base_url + 'page1.html'])
+        frontier.pop()
+        frontier.pop()
+        frontier.add(self.base_url + 'page2.html', 1)
+        save_checkpoint(self.crawler.checkpoint_path, frontier,
+                        {self.base_url + 'index.html', self.base_url + 'page1.html'})
+
+        crawler = whoosh_crawler.WebCrawler(
+            self.base_url + 'index.html', self.index_dir)
+        self.assertTrue(crawler.resumed)
+        crawler.crawl()
+        self.assertEqual(crawler.frontier.dequeued, 1)
+        self.assertEqual(len(crawler.visited_urls), len(TEST_PAGES))
+        self.assertFalse(os.path.exists(crawler.checkpoint_path))
+
+    def test_resume_rebuild(self):
+        """Test that an interrupted rebuild resumes in its staging directory"""
+        self.crawler.checkpoint_every = 1
+        save = self.crawler.save_checkpoint
+        def interrupt(*args, **kwargs):
+            save(*args, **kwargs)
+            raise KeyboardInterrupt
+        self.crawler.save_checkpoint = interrupt
+        with self.assertRaises(KeyboardInterrupt):
+            self.crawler.rebuild()
+        staged = self.crawler.interrupted_rebuild()
+        self.assertIsNotNone(staged)
+
+        crawler = whoosh_crawler.WebCrawler(
+            self.base_url + 'index.html', self.index_dir)
+        crawler.rebuild()
+        self.assertEqual(live_dir(self.index_dir), staged)
+        self.assertEqual(crawler.frontier.dequeued, len(TEST_PAGES) - 1)
+        self.assertEqual(crawler.ix.doc_count(), len(TEST_PAGES))
+        self.assertIsNone(crawler.interrupted_rebuild())
+
+    def test_ready_during_first_build(self):
+        """Test that nothing is published until the first build is done"""
+        ready = []
+        def probe(*args, **kwargs):
+            search_app._index = None
+            ready.append(search_app.app.test_client().get('/ready').status_code)
+        index_dir = search_app.INDEX_DIR
+        self.addCleanup(setattr, search_app, 'INDEX_DIR', index_dir)
+        self.addCleanup(setattr, search_app, '_index', search_app._index)
+        search_app.INDEX_DIR = self.index_dir
+        self.crawler.checkpoint_every = 1
+        save = self.crawler.save_checkpoint
+        self.crawler.save_checkpoint = lambda *args: (save(*args), probe())
+        self.crawler.rebuild()
+        probe()
+        self.assertEqual(ready, [503] * len(TEST_PAGES) + [200])
+
+    def test_periodic_checkpoints(self):
+        """Test that pages are committed while the crawl is running"""
+        self.crawler.checkpoint_every = 1
+        committed = []
+        save = self.crawler.save_checkpoint
+        def record(*args, **kwargs):
+            save(*args, **kwargs)
+            committed.append(self.crawler.ix.doc_count())
+        self.crawler.save_checkpoint = record
+        self.crawler.crawl()
+        self.assertEqual(committed, [1, 2, 3])
+
+    def test_writer_lock_is_respected(self):
+        """Test that a second writer fails instead of stealing the lock"""
+        self.crawler.crawl()
+        writer = self.crawler.open_writer()
+        try:
+            crawler = whoosh_crawler.WebCrawler(
+                self.base_url + 'index.html', self.index_dir)
+            with self.assertRaises(LockError):
+                crawler.open_writer()
+        finally:
+            writer.cancel()
+
+    def test_checkpoint_waits_for_lock(self):
+        """Test that a crawl waits for a writer taken between checkpoints"""
+        self.crawler.checkpoint_every = 1
+        save = self.crawler.save_checkpoint
+        def lock_briefly(*args, **kwargs):
+            save(*args, **kwargs)
+            # As `manage.py maintain` does while optimizing
+            other = self.crawler.ix.writer()
+            threading.Timer(0.3, other.cancel).start()
+        self.crawler.save_checkpoint = lock_briefly
+        self.crawler.crawl()
+        self.assertEqual(self.crawler.ix.doc_count(), 3)
+
+    def test_recrawl_unchanged(self):
+        """Test that a recrawl of an unchanged site reindexes nothing"""
+        self.crawler.crawl()
+        stats = self.crawler.recrawl()
+        self.assertEqual(stats, {'unchanged': 3, 'updated': 0, 'added': 0,
+                                 'deleted': 0})
+
+    def test_recrawl_changed_and_deleted(self):
+        """Test that changed pages are updated and missing pages deleted"""
+        with open('extra.html', 'w') as f:
+            f.write('<a href="index.html">Index</a><p>old gardening</p>')
+        try:
+            self.crawler = whoosh_crawler.WebCrawler(
+                self.base_url + 'extra.html', self.index_dir)
+            self.crawler.crawl()
+            with open('page1.html') as f:
+                page1 = f.read()
+            stat = os.stat('page1.html')
+            with open('page1.html', 'w') as f:
+                f.write(page1.replace('python', 'gardening'))
+            os.utime('page1.html', (stat.st_atime, stat.st_mtime + 10))
+            os.remove('extra.html')
+
+            crawler = whoosh_crawler.WebCrawler(
+                self.base_url + 'extra.html', self.index_dir)
+            stats = crawler.recrawl()
+            self.assertEqual(stats, {'unchanged': 2, 'updated': 1, 'added': 0,
+                                     'deleted': 1})
+            self.assertEqual([url for url, _, _ in crawler.search('gardening')],
+                             [self.base_url + 'page1.html'])
+            graph = LinkGraph.load(os.path.join(live_dir(self.index_dir), GRAPH_FILE))
+            self.assertIsNone(graph.find(self.base_url + 'extra.html'))
+            self.assertEqual(len(graph), len(TEST_PAGES))
+        finally:
+            with open('page1.html', 'w') as f:
+                f.write(page1)
+            if os.path.exists('extra.html'):
+                os.remove('extra.html')
+
+    def test_directory_links(self):
+        """Test that links on a directory page resolve inside the directory"""
+        os.makedirs('dirsite/docs', exist_ok=True)
+        self.addCleanup(shutil.rmtree, 'dirsite')
+        for path, html in (('dirsite/index.html', '<a href="docs/">Docs</a>'),
+                           ('dirsite/docs/index.html', '<a href="intro.html">Intro</a>'),
+                           ('dirsite/docs/intro.html', '<p>introduction</p>')):
+            with open(path, 'w') as f:
+                f.write(html)
+        intro = self.base_url + 'dirsite/docs/intro.html'
+
+        crawler = whoosh_crawler.WebCrawler(self.base_url + 'dirsite/index.html',
+                                            self.index_dir)
+        crawler.crawl()
+        self.assertIn(intro, crawler.visited_urls)
+        simple = WebCrawler(self.base_url + 'dirsite/index.html')
+        simple.crawl()
+        self.assertIn(intro, simple.visited_urls)
+
+    def test_sharded_crawl(self):
+        """Test that a crawl indexing on two processes finds the same pages"""
+        crawler = whoosh_crawler.WebCrawler(self.base_url + 'index.html',
+                                            self.index_dir, shards=2)
+        crawler.crawl()
+        self.assertEqual(crawler.ix.doc_count(), len(TEST_PAGES))
+        self.assertEqual(crawler.search('python').total, 2)
+        self.assertEqual(crawler.search('about').total, 3)
+
+
+class TestShardedWriter(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.ix = create_in(self.index_dir, make_schema())
+
+    def test_segment_per_shard(self):
+        """Test that each shard writes a segment and updates replace pages"""
+        writer = ShardedWriter(self.ix, 3, batch_size=7)
+        for i in range(50):
+            writer.add_document(url=f'http://example.com/{i}', title=f"Page {i}",
+                                content=f"shared words{i % 5}")
+        writer.commit(merge=False)
+        self.assertEqual(self.ix.doc_count(), 50)
+        self.assertEqual(segment_stats(self.ix)['segment_count'], 3)
+        self.assertEqual(shard_of('http://example.com/1', 3),
+                         shard_of('http://example.com/1', 3))
+
+        writer = ShardedWriter(self.ix, 2)
+        writer.update_document(url='http://example.com/1', title="Changed",
+                               content="changed")
+        writer.commit(optimize=True)
+        self.assertEqual(segment_stats(self.ix)['segment_count'], 1)
+        with self.ix.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 50)
+            self.assertEqual(searcher.document(url='http://example.com/1')['title'],
+                             "Changed")
+            self.assertEqual(len(list(searcher.documents(content='words1'))), 9)
+
+    def test_worker_error(self):
+        """Test that a failing worker fails the commit instead of losing pages"""
+        writer = ShardedWriter(self.ix, 2)
+        writer.add_document(url='http://example.com/a', missing_field="x")
+        with self.assertRaisesRegex(RuntimeError, 'missing_field'):
+            writer.commit()
+        writer.cancel()
+        self.assertEqual(self.ix.doc_count(), 0)
+
+
+class TestSearchApi(TestServerMixin, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index_dir = tempfile.mkdtemp()
+        whoosh_crawler.WebCrawler(cls.base_url + 'index.html', cls.index_dir).crawl()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.index_dir)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.index = SearchIndex(self.index_dir)
+        self.addCleanup(setattr, search_app, '_index', search_app._index)
+        search_app._index = self.index
+        self.client = search_app.app.test_client()
+
+    def test_search(self):
+        """Test paging, field selection and revalidation by ETag"""
+        response = self.client.get('/api/search?q=about&per_page=2&fields=url,title')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual((data['total'], data['page_count']), (3, 2))
+        self.assertEqual([set(hit) for hit in data['results']], [{'url', 'title'}] * 2)
+        self.assertTrue(response.cache_control.public)
+
+        again = self.client.get('/api/search?q=about&per_page=2&fields=url,title',
+                                headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(self.client.get('/api/search?q=about&fields=body').status_code, 400)
+        self.assertEqual(self.client.get('/api/search').status_code, 400)
+
+    def test_batch(self):
+        """Test that a batch returns one result per query, in order"""
+        response = self.client.post('/api/search/batch', json={
+            'queries': ['python', 'only'], 'fields': ['url']})
+        results = response.get_json()['results']
+        self.assertEqual([result['total'] for result in results], [2, 1])
+        self.assertEqual(results[1]['results'], [{'url': self.base_url + 'page2.html'}])
+        self.assertEqual(self.client.post('/api/search/batch', json={}).status_code, 400)
+
+    def test_api_errors_are_json(self):
+        """Test that API errors are answered with JSON, not an HTML page"""
+        for fields in ([1, 'url'], 5, ['body']):
+            response = self.client.post('/api/search/batch', json={
+                'queries': ['python'], 'fields': fields})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('fields', response.get_json()['error'])
+        response = self.client.get('/api/search/batch')
+        self.assertEqual(response.status_code, 405)
+        self.assertIn('error', response.get_json())
+
+        def broken(*args, **kwargs):
+            raise ValueError("broken")
+        self.index.search = broken
+        response = self.client.get('/api/search?q=python')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.get_json(), {'error': 'internal error'})
+
+    def test_suggest(self):
+        """Test that /suggest completes the last word of the query"""
+        data = self.client.get('/suggest?q=python%20prog').get_json()
+        self.assertEqual(data['suggestions'], ['python programming'])
+        self.assertEqual(self.client.get('/suggest?q=').get_json()['suggestions'], [])
+
+    def test_stream(self):
+        """Test that stream=1 sends every hit as a line of JSON"""
+        response = self.client.get('/api/search?q=about&stream=1')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        hits = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(hits), 3)
+        self.assertTrue(all(hit['teaser'] for hit in hits))
+
+
+class TestSuggester(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.ix = create_in(self.index_dir, make_schema())
+        self.suggester = Suggester()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def add_pages(self, pages):
+        writer = self.ix.writer()
+        for url, title, content in pages:
+            writer.update_document(url=url, title=title, content=content)
+        writer.commit(mergetype=MERGE_POLICIES['none'])
+        with self.ix.reader() as reader:
+            return self.suggester.update(reader)
+
+    def test_suggest(self):
+        """Test that completions are ranked by how many pages have them"""
+        self.add_pages([
+            ("http://a.com/1", "Python Tutorial", "python web crawling"),
+            ("http://a.com/2", "Pythonic code", "python programs"),
+            ("http://a.com/3", "Web pages", "web programs pyramid"),
+        ])
+        suggestions = self.suggester.suggest("py")
+        self.assertEqual(suggestions[0], ("python", 2))
+        self.assertEqual(set(suggestions[1:]), {
+            ("pyramid", 1), ("Python Tutorial", 1), ("Pythonic code", 1)})
+        self.assertEqual(self.suggester.suggest("Python T"), [("Python Tutorial", 1)])
+        self.assertIn(("web programs", 2), self.suggester.suggest("web pro"))
+        self.assertEqual(self.suggester.suggest("zz"), [])
+
+    def test_incremental_update(self):
+        """Test that an update only reads segments it hasn't seen"""
+        self.add_pages([("http://a.com/1", "One", "python")])
+        counted = []
+        count = self.suggester._count
+        self.suggester._count = lambda reader: counted.append(reader) or count(reader)
+        self.assertTrue(self.add_pages([("http://a.com/2", "Two", "python pyramid")]))
+        self.assertEqual(len(counted), 1)
+        self.assertEqual(self.suggester.suggest("py")[0], ("python", 2))
+        with self.ix.reader() as reader:
+            self.assertFalse(self.suggester.update(reader))
+        # Replacing a page rereads the segment it was deleted from
+        self.add_pages([("http://a.com/2", "Deux", "pyramid")])
+        self.assertEqual(len(counted), 3)
+        self.assertEqual(self.suggester.suggest("tw"), [])
+        self.assertEqual(self.suggester.suggest("de"), [("Deux", 1)])
+
+
+class TestMaintenance(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.ix = create_in(self.index_dir, make_schema())
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def commit_pages(self, first, count, mergetype):
+        writer = self.ix.writer()
+        for i in range(first, first + count):
+            writer.update_document(url=f"http://example.com/{i}", content=f"page {i}")
+        writer.commit(mergetype=mergetype)
+
+    def test_tiered_merge_bounds_segments(self):
+        """Test that many small commits don't pile up segments"""
+        policy = TieredMerge(factor=4, min_docs=10)
+        for i in range(50):
+            self.commit_pages(i * 5, 5, policy)
+        stats = segment_stats(self.ix)
+        self.assertEqual(stats['documents'], 250)
+        self.assertLessEqual(stats['segment_count'], 3 * 4)
+
+        unmerged = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, unmerged)
+        self.ix = create_in(unmerged, make_schema())
+        for i in range(50):
+            self.commit_pages(i * 5, 5, MERGE_POLICIES['none'])
+        self.assertEqual(segment_stats(self.ix)['segment_count'], 50)
+
+    def test_optimize(self):
+        """Test that optimizing leaves one segment without deleted documents"""
+        for i in range(3):
+            self.commit_pages(0, 10, MERGE_POLICIES['none'])
+        stats = segment_stats(self.ix)
+        self.assertEqual((stats['segment_count'], stats['deleted']), (3, 20))
+        self.assertTrue(optimize_due(stats, max_segments=10))
+
+        optimize(self.ix)
+        stats = segment_stats(self.ix)
+        self.assertEqual((stats['segment_count'], stats['deleted']), (1, 0))
+        self.assertFalse(optimize_due(stats))
+        with self.ix.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 10)
+
+    def test_maintain_survives_lock(self):
+        """Test that maintain tries again when a crawl holds the lock"""
+        calls = []
+        def locked(args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            raise LockError("locked")
+        run_optimize = manage.run_optimize
+        manage.run_optimize = locked
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                manage.maintain(SimpleNamespace(interval=0))
+        finally:
+            manage.run_optimize = run_optimize
+        self.assertEqual(len(calls), 3)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
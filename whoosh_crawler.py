@@ -1,155 +1,828 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
+import asyncio
+import hashlib
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+import multiprocessing
 import os
-from pathlib import Path
 
-from whoosh.index import create_in, open_dir
-from whoosh.fields import Schema, TEXT, ID, STORED
-from whoosh.qparser import MultifieldParser
-from whoosh import highlight
+from fetcher import (AsyncFetcher, SkippedPage, make_session, polite_get,
+                     has_binary_extension, is_html_type, DEFAULT_TIMEOUT,
+                     MAX_BODY_BYTES)
+from politeness import DEFAULT_RATE, HostScheduler, RobotsCache
+from frontier import Frontier, normalize_url
+from checkpoint import save_checkpoint, load_checkpoint
+from parsing import (parse_page, parse_document, available_backends, default_backend,
+                     default_workers)
+from dedup import DuplicateIndex, minhash
+from link_graph import GRAPH_FILE, LinkGraph, LinkGraphBuilder
+from search_index import (SearchIndex, DEFAULT_PER_PAGE, GENERATION_PREFIX,
+                          LINK_WEIGHT, make_schema, stores_content, live_dir,
+                          stage_generation, publish_generation, is_locked,
+                          is_published)
+from snippet_store import SnippetStore
+from shard_writer import ShardedWriter
+from maintenance import MERGE_POLICIES
+from metrics import ERRORS, INDEX_WRITE_SECONDS, PARSE_SECONDS
+
+from whoosh.index import open_dir, exists_in, EmptyIndexError
+
+# Crawl state saved next to the index while a crawl is running
+CHECKPOINT_FILE = 'crawl_state.ckpt'
+# Links found since the last checkpoint, appended next to it
+LINKS_LOG_SUFFIX = '.links'
+# Seconds to wait for the write lock when reopening the writer after a
+# checkpoint; `manage.py maintain` may be optimizing the index meanwhile
+REOPEN_LOCK_TIMEOUT = 600
+
+log = logging.getLogger(__name__)
+
+
+def parse_and_sign(html_content, current_url, backend):
+    """
+    Parse a page and compute its MinHash in one call, so that a parse
+    pool does both. Returns (title, text, links, canonical, signature,
+    seconds taken), the time for the caller's metrics: a pool process
+    has its own.
+    """
+    start = time.perf_counter()
+    title, content, links, canonical = parse_document(html_content, current_url, backend)
+    signature = minhash(content)
+    return (title, content, links, canonical, signature,
+            time.perf_counter() - start)
+
+
+def _resolve(future, result):
+    # The waiting coroutine may have been cancelled in the meantime
+    if not future.done():
+        future.set_result(result)
+
+
+def _fail(future, error):
+    if not future.done():
+        future.set_exception(error)
+
 
 class WebCrawler:
-    def __init__(self, start_url, index_dir="whoosh_index"):
+    def __init__(self, start_url, index_dir="whoosh_index", by_depth=False,
+                 checkpoint_every=500, checkpoint_interval=300, lock_timeout=0,
+                 parser=None, refresh_interval=1.0, result_ttl=300, profile='lean',
+                 merge_policy='tiered', rate=DEFAULT_RATE, obey_robots=True,
+                 max_bytes=MAX_BODY_BYTES, head_check=False, dedup=True,
+                 link_weight=LINK_WEIGHT, shards=1):
         # Initialize the crawler with a start URL
         self.start_url = start_url
         self.base_domain = urlparse(start_url).netloc
         self.visited_urls = set()
+        # URLs still to crawl, deduplicated when they are queued
+        self.frontier = Frontier(by_depth=by_depth)
+
+        # Commit and save crawl state every N pages or T seconds
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        # Seconds to wait for another process's writer before giving up
+        self.lock_timeout = lock_timeout
+        # How commits merge segments, see maintenance.MERGE_POLICIES
+        self.merge_policy = MERGE_POLICIES.get(merge_policy, merge_policy)
+        # Worker processes that analyze pages into segments of their own,
+        # see shard_writer.ShardedWriter; 1 writes on this process
+        self.shards = shards
+        # HTML parser backend, see parsing.available_backends()
+        self.parser = parser or default_backend()
+        if self.parser not in available_backends():
+            raise ValueError(f"Parser backend not available: {self.parser}")
+        # Paces requests per host (`rate` per second) and applies robots.txt
+        self.scheduler = HostScheduler(
+            rate, robots=RobotsCache() if obey_robots else None)
+        # Largest page read, and whether to HEAD URLs that may not be HTML
+        self.max_bytes = max_bytes
+        self.head_check = head_check
+        # MinHash signatures of the pages indexed so far, to skip near
+        # duplicates, or None to index every page under its own URL
+        self.duplicates = DuplicateIndex() if dedup else None
+        self.dedup_stats = {'canonical': 0, 'near_duplicate': 0}
+        # Links between the pages crawled, ranked when the crawl is done
+        # and stored with the index for SearchIndex to blend into scores
+        self.links = None
+
+        # Searches go through a read-only SearchIndex, opened on first use
+        self.refresh_interval = refresh_interval
+        self.result_ttl = result_ttl
+        # How much PageRank counts next to BM25F, see SearchIndex
+        self.link_weight = link_weight
+        self._search_index = None
         
         # Create Whoosh schema and index
         self.index_dir = index_dir
-        if not os.path.exists(index_dir):
-            os.makedirs(index_dir)
-            
-        self.schema = Schema(
-            url=ID(stored=True, unique=True),
-            title=TEXT(stored=True),
-            content=TEXT(stored=True, chars=True)  # Store content for debugging
-        )
-        
-        # Try to open existing index or create new one
-        if os.path.exists(os.path.join(index_dir, 'MAIN_WRITELOCK')):
-            os.remove(os.path.join(index_dir, 'MAIN_WRITELOCK'))
-        
-        if len(os.listdir(index_dir)) > 0:
-            self.ix = open_dir(index_dir)
-        else:
-            self.ix = create_in(index_dir, self.schema)
+        self.checkpoint_path = os.path.join(index_dir, CHECKPOINT_FILE)
+        self.resumed = False
+        # Schema profile of new indexes; existing ones keep their own
+        self.profile = profile
+        self.schema = make_schema(profile)
+        self.snippets = None
+
+        # Open the live index if one was built. Until then there is none:
+        # the first crawl builds it in a staging generation, published
+        # when the crawl is done, so readers never see it half-built. The
+        # write lock is an OS-level lock that dies with its process, so a
+        # leftover lock file is harmless and must not be deleted: it may
+        # belong to a live crawl.
+        self.ix = None
+        path = live_dir(index_dir)
+        if exists_in(path):
+            self.open_index(path)
+
+        # Pick up where an interrupted crawl left off
+        self.resumed = os.path.exists(self.checkpoint_path)
+        if self.resumed:
+            self.frontier, self.visited_urls = load_checkpoint(
+                self.checkpoint_path, by_depth)
+            log.info("Resuming crawl: %d URLs queued, %d visited",
+                     len(self.frontier), len(self.visited_urls))
     
     def is_valid_url(self, url):
-        """Check if URL belongs to the same domain and hasn't been visited"""
+        """
+        Check if URL belongs to the same domain, hasn't been visited and
+        isn't a file type that can't be HTML
+        """
         parsed = urlparse(url)
         return (parsed.netloc == self.base_domain and 
-                url not in self.visited_urls)
+                url not in self.visited_urls and
+                not has_binary_extension(url))
     
     def extract_text_and_links(self, html_content, current_url):
         """Extract text content and links from HTML"""
-        soup = BeautifulSoup(html_content, 'html.parser')
-        
-        # Get the page title
-        title = soup.find('title')
-        title_text = title.get_text().strip() if title else ""
-        
-        # Extract text content (excluding script and style elements)
-        for script in soup(['script', 'style']):
-            script.decompose()
-        text_content = soup.get_text(' ', strip=True)  # Use space separator and strip whitespace
-        
-        # Extract all links and convert to absolute URLs
-        links = []
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href:
-                absolute_url = urljoin(current_url, href)
-                links.append(absolute_url)
-        
-        return title_text, text_content, links
+        return parse_page(html_content, current_url, self.parser)
     
-    def crawl(self):
-        """Start crawling from the initial URL"""
-        urls_to_visit = [self.start_url]
-        writer = self.ix.writer()
+    def is_html(self, response):
+        """Check whether a response carries an HTML page"""
+        return response.ok and is_html_type(response.headers.get('content-type', ''))
+
+    def page_validators(self, response):
+        """Collect the fields used to tell whether a page changed"""
+        return {
+            'etag': response.headers.get('etag', ''),
+            'last_modified': response.headers.get('last-modified', ''),
+            'content_hash': hashlib.sha1(response.content).hexdigest(),
+        }
+
+    def open_index(self, path):
+        """Write to the index in `path`, and to its snippet store if it has one"""
+        self.ix = open_dir(path)
+        if self.snippets is not None:
+            self.snippets.close()
+        self.snippets = None if stores_content(self.ix) else SnippetStore(path)
+
+    def open_writer(self, timeout=None):
+        """
+        Open an index writer, adding fields missing from older indexes.
+
+        Raises whoosh.index.LockError if another process holds the write
+        lock for longer than `timeout` seconds, `lock_timeout` by default,
+        and EmptyIndexError if no index has been built yet.
+        """
+        if self.ix is None:
+            raise EmptyIndexError(f"No index built in {self.index_dir}")
+        if timeout is None:
+            timeout = self.lock_timeout
+        if self.shards > 1:
+            writer = ShardedWriter(self.ix, self.shards, timeout=timeout)
+        else:
+            writer = self.ix.writer(timeout=timeout)
+        for name, field in self.schema.items():
+            if name not in writer.schema:
+                writer.add_field(name, field)
+        return writer
+
+    def reopen_writer(self):
+        """
+        Open the writer again after a checkpoint's commit. Another process
+        may have taken the lock in between, so this waits for it longer
+        than `lock_timeout` rather than abort a crawl that has started.
+        """
+        return self.open_writer(max(self.lock_timeout, REOPEN_LOCK_TIMEOUT))
+
+    def commit(self, writer):
+        """Commit a writer and make the next search look for the new generation"""
+        # Texts first, so every page a search can find has its snippet
+        if self.snippets is not None:
+            self.snippets.commit()
+        writer.commit(mergetype=self.merge_policy)
+        if self._search_index is not None:
+            self._search_index.invalidate()
+
+    def cancel(self, writer):
+        """Throw away a writer's uncommitted pages"""
+        if self.snippets is not None:
+            self.snippets.rollback()
+        if not writer.is_closed:
+            writer.cancel()
+
+    def delete_page(self, writer, url):
+        """Remove a page from the index"""
+        writer.delete_by_term('url', url)
+        if self.snippets is not None:
+            self.snippets.delete(url)
+
+    def load_signatures(self, fields):
+        """Start the duplicate index over from indexed pages' stored fields"""
+        if self.duplicates is None:
+            return
+        self.duplicates = DuplicateIndex()
+        for page in fields:
+            if page.get('minhash'):
+                self.duplicates.add(page['url'], page['minhash'])
+
+    def deduplicate(self, current_url, canonical, signature):
+        """
+        Decide under which URL to index a fetched page.
+
+        A page whose rel=canonical names another page of the site is
+        indexed under that URL, which is then never fetched itself;
+        if that page was already queued or crawled this one is skipped.
+        A page whose shingles mostly match those of a page already
+        indexed is skipped as well, unless it has too little text for a
+        signature. Returns the URL to index the page under, or None to
+        skip it.
+        """
+        if self.duplicates is None:
+            return current_url
+        if canonical and urlparse(canonical).netloc == self.base_domain:
+            canonical = normalize_url(canonical)
+            if canonical != normalize_url(current_url):
+                if canonical in self.frontier or canonical in self.visited_urls:
+                    self.dedup_stats['canonical'] += 1
+                    return None
+                self.frontier.mark_seen(canonical)
+                self.visited_urls.add(canonical)
+                current_url = canonical
+        if signature is None:
+            # Too short to compare; drop any signature an earlier version had
+            self.duplicates.remove(current_url)
+            return current_url
+        original = self.duplicates.find(signature, exclude=current_url)
+        if original is not None:
+            log.debug("Skipping %s: duplicate of %s", current_url, original)
+            self.dedup_stats['near_duplicate'] += 1
+            return None
+        self.duplicates.add(current_url, signature)
+        return current_url
+
+    def index_page(self, writer, current_url, html, validators=None, update=False,
+                   base_url=None):
+        """
+        Parse one page and add it to the index unless it duplicates one.
+        Links are resolved against `base_url`, the URL the page was
+        fetched from, if given. Returns the URL it was indexed under
+        (None if it was skipped) and its outgoing links.
+        """
+        title, content, links, canonical, signature, seconds = parse_and_sign(
+            html, base_url or current_url, self.parser)
+        PARSE_SECONDS.observe(seconds)
+        url = self.deduplicate(current_url, canonical, signature)
+        if url is not None:
+            self.add_page(writer, url, title, content, validators, update, signature)
+        return url, links
+
+    def add_page(self, writer, current_url, title, content, validators=None,
+                 update=False, signature=None):
+        """Add an already parsed page to the index"""
+        log.debug("Indexing %s (%s)", current_url, title)
+
+        with INDEX_WRITE_SECONDS.time():
+            # The lean schema leaves the text to the snippet store
+            if self.snippets is not None:
+                self.snippets.put(current_url, content)
+
+            # update_document replaces an earlier version of the same URL
+            add = writer.update_document if update else writer.add_document
+            add(
+                url=current_url,
+                title=title,
+                content=content,
+                minhash=signature,
+                **(validators or {})
+            )
+
+    @property
+    def links_log_path(self):
+        return self.checkpoint_path + LINKS_LOG_SUFFIX
+
+    def load_links(self):
+        """
+        Start the link graph from the one stored with the index, plus,
+        when resuming, the links saved at the interrupted crawl's
+        checkpoints
+        """
+        path = os.path.join(self.ix.storage.folder, GRAPH_FILE)
+        if os.path.exists(path):
+            self.links = LinkGraphBuilder.from_graph(LinkGraph.load(path))
+        else:
+            self.links = LinkGraphBuilder()
+        if os.path.exists(self.links_log_path):
+            if self.resumed:
+                self.links.replay(self.links_log_path)
+            else:
+                os.remove(self.links_log_path)
+
+    def record_links(self, url, links):
+        """Record an indexed page's links to pages of the same site"""
+        self.links.add_page(url, [
+            normalize_url(link) for link in links
+            if urlparse(link).netloc == self.base_domain and not has_binary_extension(link)])
+
+    def save_links(self):
+        """
+        Rank the link graph and store it with the index. Called before
+        the final commit, so the generation it creates includes it.
+        """
+        start = time.monotonic()
+        graph = self.links.build()
+        graph.rank()
+        graph.save(os.path.join(self.ix.storage.folder, GRAPH_FILE))
+        log.info("Ranked %d pages with %d links in %.2fs",
+                 len(graph), graph.edge_count, time.monotonic() - start)
+
+    def checkpoint_due(self, pages, since):
+        """Check whether `pages` indexed since time `since` need committing"""
+        return pages > 0 and (
+            pages >= self.checkpoint_every or
+            time.monotonic() - since >= self.checkpoint_interval)
+
+    def save_checkpoint(self, in_flight=()):
+        """Save the frontier and visited set next to the index"""
+        save_checkpoint(self.checkpoint_path, self.frontier,
+                        self.visited_urls, in_flight)
+        self.links.save_batches(self.links_log_path)
+
+    def finish_crawl(self):
+        """Drop the checkpoint once a crawl has run to completion"""
+        for path in (self.checkpoint_path, self.links_log_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.resumed = False
+
+    def crawl(self, timeout=DEFAULT_TIMEOUT):
+        """
+        Start crawling from the initial URL.
+
+        Pages are committed to the index and the crawl state is saved every
+        `checkpoint_every` pages or `checkpoint_interval` seconds, so a crawl
+        that is killed resumes from its last checkpoint when run again.
+        Without a built index this is the first build, see rebuild().
+        """
+        if self.ix is None:
+            return self.rebuild(timeout)
+        self.frontier.add(self.start_url)
+        with self.ix.searcher() as searcher:
+            self.load_signatures(searcher.all_stored_fields())
+        self.load_links()
+        session = make_session()
+        writer = self.open_writer()
+        pages, since = 0, time.monotonic()
         
         try:
-            while urls_to_visit:
-                current_url = urls_to_visit.pop(0)
-                
-                if not self.is_valid_url(current_url):
-                    continue
+            while self.frontier:
+                fetch_url, depth = self.frontier.pop()
+                current_url = normalize_url(fetch_url)
                     
                 try:
                     # Fetch and process the page
-                    response = requests.get(current_url)
+                    response = polite_get(session, self.scheduler, fetch_url,
+                                          timeout=timeout, max_bytes=self.max_bytes,
+                                          head_check=self.head_check)
                     
                     # Only process HTML responses
-                    if 'text/html' not in response.headers.get('content-type', '').lower():
+                    if not self.is_html(response):
                         continue
                         
                     self.visited_urls.add(current_url)
                     
-                    # Extract text and links
-                    title, content, links = self.extract_text_and_links(
-                        response.text, current_url)
-                    
-                    print(f"Indexing {current_url}")  # Debug print
-                    print(f"Title: {title}")  # Debug print
-                    
-                    # Add document to index
-                    writer.add_document(
-                        url=current_url,
-                        title=title,
-                        content=content
-                    )
+                    # Extract text and links, and add the page to the index.
+                    # A resumed crawl may refetch pages committed after its
+                    # last checkpoint, so it replaces rather than adds.
+                    url, links = self.index_page(writer, current_url, response.text,
+                                                 self.page_validators(response),
+                                                 update=self.resumed,
+                                                 base_url=response.url)
+                    if url is not None:
+                        self.record_links(url, links)
                     
                     # Add new links to visit
-                    new_links = [url for url in links if url not in self.visited_urls]
-                    urls_to_visit.extend(new_links)
+                    new_links = [url for url in links if self.is_valid_url(url)]
+                    self.frontier.extend(new_links, depth + 1)
                     
+                except SkippedPage as e:
+                    log.debug("Skipping %s", e)
+                    continue
                 except Exception as e:
-                    print(f"Error processing {current_url}: {e}")
+                    ERRORS.inc()
+                    log.warning("Error processing %s: %s", current_url, e)
+                    continue
+
+                pages += 1
+                if self.checkpoint_due(pages, since):
+                    self.commit(writer)
+                    self.save_checkpoint()
+                    writer = self.reopen_writer()
+                    pages, since = 0, time.monotonic()
             
-            writer.commit()
-            print("Indexing complete!")  # Debug print
+            self.save_links()
+            self.commit(writer)
+            self.finish_crawl()
+            log.info("Indexing complete")
             
         except Exception as e:
-            writer.cancel()
+            self.cancel(writer)
             raise e
-    
-    def search(self, query_str):
+        finally:
+            session.close()
+
+    def recrawl(self, timeout=DEFAULT_TIMEOUT):
         """
-        Search the index for pages matching the query.
-        Returns list of (url, title, teaser) tuples.
+        Refresh an existing index instead of rebuilding it.
+
+        Every known page is requested with If-None-Match/If-Modified-Since.
+        Pages that answer 304, or whose content hash did not change, are
+        neither parsed nor reindexed. Changed pages replace their old
+        document, pages that are gone are deleted, and links found on
+        changed pages are followed to pick up new pages.
+
+        Returns a dict counting unchanged, updated, added and deleted pages.
+        Without a built index, the site is crawled into a first one.
         """
+        if self.ix is None:
+            self.rebuild(timeout)
+            return {'unchanged': 0, 'updated': 0, 'added': self.ix.doc_count(),
+                    'deleted': 0}
         with self.ix.searcher() as searcher:
-            # Search in both title and content
-            parser = MultifieldParser(["title", "content"], self.ix.schema)
-            query = parser.parse(query_str)
-            
-            results = searcher.search(query, limit=None)  # No limit on results
-            print(f"Found {len(results)} results for '{query_str}'")  # Debug print
-            print(results)  # Debug print
+            known = {fields['url']: fields for fields in searcher.all_stored_fields()}
+
+        stats = {'unchanged': 0, 'updated': 0, 'added': 0, 'deleted': 0}
+        # Start from a clean slate in case this crawler crawled before
+        self.visited_urls = set()
+        self.frontier = Frontier(by_depth=self.frontier.by_depth)
+        self.frontier.add(self.start_url)
+        self.frontier.extend(known)
+        self.load_signatures(known.values())
+        self.load_links()
+        session = make_session()
+        writer = self.open_writer()
+
+        try:
+            while self.frontier:
+                fetch_url, depth = self.frontier.pop()
+                current_url = normalize_url(fetch_url)
+                previous = known.get(current_url)
+
+                headers = {}
+                if previous and previous.get('etag'):
+                    headers['If-None-Match'] = previous['etag']
+                if previous and previous.get('last_modified'):
+                    headers['If-Modified-Since'] = previous['last_modified']
+
+                try:
+                    response = polite_get(session, self.scheduler, fetch_url,
+                                          headers=headers, timeout=timeout,
+                                          max_bytes=self.max_bytes,
+                                          head_check=self.head_check)
+
+                    if response.status_code in (404, 410):
+                        if previous:
+                            self.delete_page(writer, current_url)
+                            self.links.remove_page(current_url)
+                            stats['deleted'] += 1
+                        continue
+
+                    if response.status_code == 304:
+                        self.visited_urls.add(current_url)
+                        stats['unchanged'] += 1
+                        continue
+
+                    if response.status_code != 200 or not self.is_html(response):
+                        continue
+
+                    self.visited_urls.add(current_url)
+                    validators = self.page_validators(response)
+                    if previous and previous.get('content_hash') == validators['content_hash']:
+                        stats['unchanged'] += 1
+                        continue
+
+                    url, links = self.index_page(writer, current_url, response.text,
+                                                 validators, update=previous is not None,
+                                                 base_url=response.url)
+                    if url is None:
+                        # It now duplicates another page
+                        if previous:
+                            self.delete_page(writer, current_url)
+                            self.links.remove_page(current_url)
+                            stats['deleted'] += 1
+                    else:
+                        self.record_links(url, links)
+                        stats['updated' if previous else 'added'] += 1
+
+                    new_links = [url for url in links if self.is_valid_url(url)]
+                    self.frontier.extend(new_links, depth + 1)
+
+                except SkippedPage:
+                    # Pages robots.txt now forbids, or that stopped being
+                    # HTML pages we read, leave the index
+                    if previous:
+                        self.delete_page(writer, current_url)
+                        self.links.remove_page(current_url)
+                        stats['deleted'] += 1
+                except Exception as e:
+                    ERRORS.inc()
+                    log.warning("Error processing %s: %s", current_url, e)
+
+            if stats['updated'] or stats['added'] or stats['deleted']:
+                self.save_links()
+                self.commit(writer)
+            else:
+                self.cancel(writer)
+            log.info("Recrawl complete: %s", stats)
+            return stats
+
+        except Exception as e:
+            self.cancel(writer)
+            raise e
+        finally:
+            session.close()
+
+    def crawl_async(self, concurrency=16, per_host=4, timeout=DEFAULT_TIMEOUT,
+                    parse_workers=None):
+        """
+        Crawl with many requests in flight at once.
+
+        The crawl is a pipeline of three stages. Pages are fetched by an
+        asyncio event loop, at most `concurrency` at a time and at most
+        `per_host` per host. They are parsed by a pool of `parse_workers`
+        processes (one per core by default, 0 to parse on a thread) and
+        written to the index by a separate consumer thread. The stages are
+        connected by bounded queues, so a slow stage throttles the ones
+        before it instead of piling up pages in memory. Without a built
+        index this is the first build, see rebuild().
+        """
+        if self.ix is None:
+            return self.rebuild(timeout, use_async=True, concurrency=concurrency,
+                                per_host=per_host, parse_workers=parse_workers)
+        asyncio.run(self._crawl_async(concurrency, per_host, timeout,
+                                      parse_workers))
+
+    async def _crawl_async(self, concurrency, per_host, timeout, parse_workers):
+        loop = asyncio.get_running_loop()
+        # Load the crawl state before the writer thread takes the lock:
+        # only the try block below would let it go on an error
+        self.frontier.add(self.start_url)
+        with self.ix.searcher() as searcher:
+            self.load_signatures(searcher.all_stored_fields())
+        self.load_links()
+        if parse_workers is None:
+            parse_workers = default_workers()
+        if parse_workers:
+            # Spawn rather than fork: the crawl already runs threads
+            parse_pool = ProcessPoolExecutor(
+                parse_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            parse_pool = ThreadPoolExecutor(1)
+        # Pages handed to the parse pool at once, queued or being parsed
+        parse_slots = asyncio.Semaphore(max(parse_workers, 1) * 2)
+        fetcher = AsyncFetcher(concurrency, per_host, timeout, self.scheduler,
+                               self.max_bytes, self.head_check)
+        # Messages for the index writer; bounded for backpressure
+        pages = queue.Queue(maxsize=concurrency * 2)
+        consumer = threading.Thread(
+            target=self._consume_pages, args=(loop, pages, self.open_writer()),
+            daemon=True)
+        consumer.start()
+
+        async def send(*message):
+            await loop.run_in_executor(None, pages.put, message)
+
+        async def visit(url):
+            try:
+                response = await fetcher.fetch(url)
+                if not self.is_html(response):
+                    return []
+                key = normalize_url(url)
+                self.visited_urls.add(key)
+                validators = self.page_validators(response)
+                async with parse_slots:
+                    parsed = await loop.run_in_executor(
+                        parse_pool, parse_and_sign, response.text, response.url,
+                        self.parser)
+                title, content, links, canonical, signature, seconds = parsed
+                PARSE_SECONDS.observe(seconds)
+                # Decided here, on the event loop, so visits finishing at
+                # the same time can't both pass as originals
+                indexed_url = self.deduplicate(key, canonical, signature)
+                if indexed_url is not None:
+                    self.record_links(indexed_url, links)
+                    await send('page', indexed_url, title, content, validators,
+                               signature)
+                return links
+            except SkippedPage as e:
+                log.debug("Skipping %s", e)
+                return []
+            except Exception as e:
+                ERRORS.inc()
+                log.warning("Error processing %s: %s", url, e)
+                return []
+
+        # Visit task -> (url, depth) of the page it fetches
+        pending = {}
+        visits, since = 0, time.monotonic()
+        try:
+            while self.frontier or pending:
+                # Keep enough visits scheduled to saturate the fetcher
+                while self.frontier and len(pending) < concurrency * 4:
+                    url, depth = self.frontier.pop()
+                    pending[asyncio.ensure_future(visit(url))] = (url, depth)
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    _, depth = pending.pop(task)
+                    self.frontier.extend(
+                        [url for url in task.result() if self.is_valid_url(url)],
+                        depth + 1)
+
+                visits += len(done)
+                if self.checkpoint_due(visits, since):
+                    # Every finished visit was sent to the writer before this
+                    # request, so the commit covers them; unfinished visits
+                    # are saved as still queued.
+                    committed = loop.create_future()
+                    await send('commit', committed)
+                    await committed
+                    self.save_checkpoint(in_flight=pending.values())
+                    visits, since = 0, time.monotonic()
+            await loop.run_in_executor(None, self.save_links)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await send('stop', False, None)
+            await loop.run_in_executor(None, consumer.join)
+            raise
+        finally:
+            fetcher.close()
+            parse_pool.shutdown()
+
+        # Only a crawl whose pages are all committed is complete
+        stopped = loop.create_future()
+        await send('stop', True, stopped)
+        await loop.run_in_executor(None, consumer.join)
+        await stopped
+        self.finish_crawl()
+        log.info("Indexing complete")
+
+    def _consume_pages(self, loop, pages, writer):
+        """
+        Write parsed pages to the index on the consumer thread.
+
+        Handles ('page', url, title, content, validators, signature) messages,
+        ('commit', future) checkpoint requests, and a final
+        ('stop', commit, future) message. The futures get the outcome of
+        the commit, or of the last commit or cancel; a stop future may be
+        None when nobody waits for it.
+        """
+        while True:
+            kind, *args = pages.get()
+            if kind == 'page':
+                url, title, content, validators, signature = args
+                try:
+                    self.add_page(writer, url, title, content, validators,
+                                  update=self.resumed, signature=signature)
+                except Exception as e:
+                    ERRORS.inc()
+                    log.warning("Error processing %s: %s", url, e)
+            elif kind == 'commit':
+                try:
+                    self.commit(writer)
+                    writer = self.reopen_writer()
+                    loop.call_soon_threadsafe(_resolve, args[0], None)
+                except Exception as e:
+                    loop.call_soon_threadsafe(_fail, args[0], e)
+            elif kind == 'stop':
+                commit, stopped = args
+                try:
+                    if commit:
+                        self.commit(writer)
+                    else:
+                        self.cancel(writer)
+                except Exception as e:
+                    # Release the lock; the crawl fails with the error
+                    try:
+                        self.cancel(writer)
+                    except Exception:
+                        log.exception("Error cancelling the index writer")
+                    if stopped is None:
+                        log.error("Error closing the index writer: %s", e)
+                    else:
+                        loop.call_soon_threadsafe(_fail, stopped, e)
+                else:
+                    if stopped is not None:
+                        loop.call_soon_threadsafe(_resolve, stopped, None)
+                return
+    
+    def interrupted_rebuild(self):
+        """
+        The staging directory of a rebuild that stopped after a checkpoint
+        and that no other process is writing to, the latest if several,
+        or None
+        """
+        if not os.path.isdir(self.index_dir):
+            return None
+        live = live_dir(self.index_dir)
+        found = []
+        for entry in os.listdir(self.index_dir):
+            path = os.path.join(self.index_dir, entry)
+            checkpoint = os.path.join(path, CHECKPOINT_FILE)
+            if (entry.startswith(GENERATION_PREFIX) and path != live and
+                    os.path.exists(checkpoint) and not is_published(path) and
+                    exists_in(path) and not is_locked(path)):
+                found.append((os.path.getmtime(checkpoint), path))
+        return max(found)[1] if found else None
+
+    def rebuild(self, timeout=DEFAULT_TIMEOUT, use_async=False, **async_options):
+        """
+        Crawl the site from scratch into a new index generation.
+
+        The new index is built in a staging directory while readers keep
+        searching the current one, if any, and is swapped in atomically
+        once the crawl is complete. The crawl state is checkpointed in
+        the staging directory, so an interrupted rebuild resumes from
+        there the next time.
+        """
+        staged = self.interrupted_rebuild()
+        if staged is None:
+            staged = stage_generation(self.index_dir, self.profile)
+        live_ix = self.ix
+        self.open_index(staged)
+        # Keep the rebuild's crawl state out of the live index's way
+        live_checkpoint = self.checkpoint_path
+        self.checkpoint_path = os.path.join(staged, CHECKPOINT_FILE)
+        self.resumed = os.path.exists(self.checkpoint_path)
+        if self.resumed:
+            self.frontier, self.visited_urls = load_checkpoint(
+                self.checkpoint_path, self.frontier.by_depth)
+            log.info("Resuming rebuild in %s: %d URLs queued, %d visited",
+                     os.path.basename(staged), len(self.frontier),
+                     len(self.visited_urls))
+        else:
+            self.visited_urls = set()
+            self.frontier = Frontier(by_depth=self.frontier.by_depth)
+        try:
+            if use_async:
+                self.crawl_async(timeout=timeout, **async_options)
+            else:
+                self.crawl(timeout)
+        except BaseException:
+            # Writes go to the live index again, never to the staged one
+            if live_ix is None:
+                self.ix = None
+            else:
+                self.open_index(live_ix.storage.folder)
+            raise
+        finally:
+            self.checkpoint_path = live_checkpoint
+        publish_generation(self.index_dir, staged)
+        if self._search_index is not None:
+            self._search_index.invalidate()
+        log.info("Published new index generation %s", os.path.basename(staged))
 
-            # Set up the highlighter
-            results.fragmenter = highlight.ContextFragmenter(maxchars=200, surround=100)
-            results.formatter = highlight.HtmlFormatter(tagname="b", classname="highlight", termclass="term")
+    def search_index(self):
+        """The read-only SearchIndex used by this crawler's searches"""
+        if self._search_index is None:
+            self._search_index = SearchIndex(
+                self.index_dir, self.refresh_interval, self.result_ttl, self.link_weight)
+        return self._search_index
 
+    def search(self, query_str, page=1, per_page=DEFAULT_PER_PAGE):
+        """Search the index; see SearchIndex.search"""
+        return self.search_index().search(query_str, page, per_page)
 
-            return [
-                (hit['url'],
-                 hit.get('title', 'Untitled'),
-                 hit.highlights("content")
-                 )
-                    for hit in results]
+    def cache_stats(self):
+        """Hit and miss counters of the search caches"""
+        return self.search_index().cache_stats()
 
 def main():
     """Example usage of the WebCrawler with Whoosh"""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
     # Create crawler
     start_url = "https://vm009.rz.uos.de/crawl/index.html"
     crawler = WebCrawler(start_url)
     
     # Printing for debugging
-    print("Starting crawl...")
-    crawler.crawl()
+    if '--recrawl' in sys.argv[1:]:
+        print("Refreshing index...")
+        crawler.recrawl()
+    else:
+        print("Starting crawl...")
+        crawler.crawl()
     print(f"Crawl complete. Visited {len(crawler.visited_urls)} pages")
     
     # Test search
@@ -164,7 +837,7 @@ def main():
         results = crawler.search(query)
         
         # Display results
-        print(f"\nFound {len(results)} pages:")
+        print(f"\nFound {results.total} pages, showing the first {len(results)}:")
         for url, title, teaser in results:
             print(f"  - {title}")
             print(f"    {url}")